@@ -0,0 +1,253 @@
+'''
+Benchmarks detect(...), get_pivots(...), duplicate marking and plot(...) on synthetic OHLC
+random walks of several sizes, and writes the measurements to a JSON file so that two
+commits can be compared.
+
+  python benchmark.py --output before.json
+  git checkout <other commit> -- pytrendline
+  python benchmark.py --output after.json --compare before.json
+
+Only the library is checked out from the other commit, so this script and its fixtures stay
+the same. Older commits lack some of the options used here (engines, concurrency modes), so
+the signatures of the checked out library are inspected and missing options are skipped.
+
+Each measurement reports the best wall time over --repeat runs, the peak memory traced by
+tracemalloc during one extra run, and for detect(...) the number of candidate (i, j) pairs
+scanned per second.
+'''
+import argparse
+import importlib
+import inspect
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import pytrendline
+from pytrendline import structs
+from fixtures.testcases import get_random_walk_candlestick_data
+
+# Parts of the checked out library that older commits do not have, None when missing
+detect_module = importlib.import_module('pytrendline.detect')
+resolve_config = getattr(detect_module, 'resolve_config', None)
+mark_duplicates = getattr(detect_module, '_mark_duplicates', None)
+try:
+  from pytrendline import kernels
+except ImportError:
+  kernels = None
+
+DETECT_PARAMS = inspect.signature(pytrendline.detect).parameters
+GET_PIVOTS_PARAMS = inspect.signature(pytrendline.get_pivots).parameters
+
+# Commits without an engine parameter only have the python loop
+VALID_ENGINES = getattr(structs, 'VALID_SCAN_ENGINES', ['python'])
+
+DEFAULT_SIZES = [100, 500, 2000, 10000]
+TREND_TYPES = [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE, structs.TrendlineTypes.BOTH]
+
+# Scan modes benchmarked for detect(...). The full scan is O(N^3), so it only runs up to
+# --max-full-scan-bars candles
+SCAN_MODES = {
+  'full': {},
+  'all_pivots': {'all_pts_must_be_pivots': True},
+}
+
+# Concurrency modes benchmarked for detect(...) with TrendlineTypes.BOTH, next to the sequential run
+CONCURRENCY_MODES = [structs.ConcurrencyModes.THREADS, structs.ConcurrencyModes.PROCESSES] if 'concurrency' in DETECT_PARAMS else []
+
+def random_walk_candles(num_candles):
+  return get_random_walk_candlestick_data('1m', num_candles, 0)
+
+def engine_kwargs(params, engine):
+  # The engine argument, for the functions of the checked out library that take one
+  return {'engine': engine} if 'engine' in params else {}
+
+def measure(func, repeat):
+  # Best wall time over repeat runs, then one more run under tracemalloc for peak memory
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best == None else min(best, elapsed)
+
+  tracemalloc.start()
+  func()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return result, best, peak
+
+def num_candidate_pairs(results, num_candles, scan_mode):
+  # Number of (i, j) pairs the scan starts from, before any pruning
+  total = 0
+  for tt in [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE]:
+    pivots_key = tt.lower() + '_pivots'
+    if pivots_key not in results:
+      continue
+    n = len(results[pivots_key]) if scan_mode == 'all_pivots' else num_candles
+    total += n * (n - 1) // 2
+  return total
+
+def run_benchmarks(sizes, engine, repeat, max_full_scan_bars, skip_plot):
+  records = []
+
+  # Warm up once so that compiled kernels are loaded before anything is timed
+  pytrendline.detect(candlestick_data=random_walk_candles(50), trend_type=structs.TrendlineTypes.BOTH, **engine_kwargs(DETECT_PARAMS, engine))
+
+  def record(entry_point, num_candles, elapsed, peak, **extra):
+    row = {
+      'entry_point': entry_point,
+      'num_candles': num_candles,
+      'engine': engine,
+      'wall_time_s': elapsed,
+      'peak_memory_bytes': peak,
+    }
+    row.update(extra)
+    records.append(row)
+    print("{:<18} {:>6} candles {:<40} {:>10.4f}s {:>10.1f} KiB".format(
+      entry_point, num_candles, ' '.join('{}={}'.format(k, v) for k, v in extra.items() if k != 'candidates_per_s'),
+      elapsed, peak / 1024.0
+    ))
+
+  for num_candles in sizes:
+    candles = random_walk_candles(num_candles)
+    # Older commits resolve the config inside _mark_duplicates
+    config = resolve_config(candles, {}) if resolve_config != None else {}
+
+    for tt in [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE]:
+      _, elapsed, peak = measure(lambda: pytrendline.get_pivots(candles, tt, 0, **engine_kwargs(GET_PIVOTS_PARAMS, engine)), repeat)
+      record('get_pivots', num_candles, elapsed, peak, trend_type=tt)
+
+    plot_results = None
+    for scan_mode, flags in SCAN_MODES.items():
+      if scan_mode == 'full' and num_candles > max_full_scan_bars:
+        continue
+
+      for tt in TREND_TYPES:
+        results, elapsed, peak = measure(
+          lambda: pytrendline.detect(candlestick_data=candles, trend_type=tt, **engine_kwargs(DETECT_PARAMS, engine), **flags),
+          repeat
+        )
+        num_pairs = num_candidate_pairs(results, num_candles, scan_mode)
+        num_trendlines = sum(len(results[k]) for k in results if k.endswith('_trendlines'))
+        record(
+          'detect', num_candles, elapsed, peak,
+          trend_type=tt, scan_mode=scan_mode, candidate_pairs=num_pairs, trendlines=num_trendlines,
+          candidates_per_s=num_pairs / elapsed if elapsed > 0 else None,
+        )
+
+        if tt == structs.TrendlineTypes.BOTH:
+          plot_results = results
+          both_elapsed = elapsed
+
+      # The two passes of BOTH run concurrently, the speedup is relative to the sequential run above.
+      # THREADS only overlaps them with the numba engine, whose kernels release the GIL
+      for concurrency in CONCURRENCY_MODES:
+        run = lambda: pytrendline.detect(
+          candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, engine=engine, concurrency=concurrency, **flags
+        )
+        # Starts the reused worker pool before anything is timed
+        pytrendline.detect(
+          candlestick_data=random_walk_candles(50), trend_type=structs.TrendlineTypes.BOTH, engine=engine, concurrency=concurrency
+        )
+        _, elapsed, peak = measure(run, repeat)
+        record(
+          'detect', num_candles, elapsed, peak,
+          trend_type=structs.TrendlineTypes.BOTH, scan_mode=scan_mode, concurrency=concurrency,
+          speedup=round(both_elapsed / elapsed, 2) if elapsed > 0 else None,
+        )
+
+    # Duplicate marking on the trendlines found by the last scan mode that ran
+    for tt in [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE]:
+      if mark_duplicates == None:
+        break
+      trends_df = plot_results[tt.lower() + '_trendlines']
+      _, elapsed, peak = measure(
+        lambda: mark_duplicates(trends_df.copy(), candles, tt, config),
+        repeat
+      )
+      record('mark_duplicates', num_candles, elapsed, peak, trend_type=tt, trendlines=len(trends_df))
+
+    if not skip_plot:
+      with tempfile.TemporaryDirectory() as filedir:
+        _, elapsed, peak = measure(lambda: pytrendline.plot(results=plot_results, filedir=filedir, filename='bench.html'), repeat)
+      record('plot', num_candles, elapsed, peak)
+
+  return records
+
+def environment_info():
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+  except Exception:
+    commit = None
+
+  return {
+    'git_commit': commit,
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'pandas': pd.__version__,
+    'platform': platform.platform(),
+    'cpu_count': os.cpu_count(),
+  }
+
+def record_key(row):
+  return tuple((k, row[k]) for k in ['entry_point', 'num_candles', 'engine', 'trend_type', 'scan_mode', 'concurrency'] if k in row)
+
+def compare(baseline_path, records):
+  # Prints the wall time and peak memory of each measurement relative to the baseline file
+  with open(baseline_path) as f:
+    baseline = {record_key(row): row for row in json.load(f)['records']}
+
+  print("\nCompared to {} (ratio > 1 is slower / larger):".format(baseline_path))
+  for row in records:
+    old = baseline.get(record_key(row))
+    if old == None:
+      continue
+    time_ratio = row['wall_time_s'] / old['wall_time_s'] if old['wall_time_s'] > 0 else float('nan')
+    memory_ratio = row['peak_memory_bytes'] / old['peak_memory_bytes'] if old['peak_memory_bytes'] > 0 else float('nan')
+    print("{:<60} time x{:.2f}  memory x{:.2f}".format(
+      ' '.join(str(v) for _, v in record_key(row)), time_ratio, memory_ratio
+    ))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark pytrendline on synthetic random walks")
+  parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES), help="comma separated candle counts")
+  parser.add_argument(
+    '--engine',
+    default='numba' if getattr(kernels, 'HAS_NUMBA', False) else 'numpy' if 'numpy' in VALID_ENGINES else 'python',
+    choices=VALID_ENGINES,
+    help="defaults to numba when it is installed, numpy otherwise, or python on commits without engines"
+  )
+  parser.add_argument('--repeat', type=int, default=1, help="timed runs per measurement, the best one is kept")
+  parser.add_argument('--max-full-scan-bars', type=int, default=500, help="largest size to run without pivot requirements")
+  parser.add_argument('--skip-plot', action='store_true')
+  parser.add_argument('--output', default='benchmark_results.json')
+  parser.add_argument('--compare', default=None, help="earlier output file to compare against")
+  args = parser.parse_args(argv)
+
+  sizes = [int(s) for s in args.sizes.split(',') if s]
+
+  # Bokeh and pandas deprecation warnings would drown the report
+  warnings.simplefilter('ignore')
+
+  records = run_benchmarks(sizes, args.engine, args.repeat, args.max_full_scan_bars, args.skip_plot)
+
+  with open(args.output, 'w') as f:
+    json.dump({'environment': environment_info(), 'records': records}, f, indent=2)
+  print("\nResults saved in {}".format(args.output))
+
+  if args.compare != None:
+    compare(args.compare, records)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -37,6 +37,25 @@ def get_candlestick_df(csv_string):
   return df
 
 
+def get_random_walk_candlestick_data(time_interval, num_candles, seed):
+  # Prices are rounded to one decimal so that exact touches and score ties occur
+  rng = np.random.RandomState(seed)
+  close = 100 + np.cumsum(rng.normal(0, 1, num_candles))
+  open_ = np.concatenate([close[:1], close[:-1]])
+  df = pd.DataFrame({
+    'Date': pd.date_range('2020-01-01 09:30', periods=num_candles, freq='1min'),
+    'Open': np.round(open_, 1),
+    'High': np.round(np.maximum(open_, close) + rng.uniform(0, 1, num_candles), 1),
+    'Low': np.round(np.minimum(open_, close) - rng.uniform(0, 1, num_candles), 1),
+    'Close': np.round(close, 1),
+  })
+  return structs.CandlestickData(
+    df=df,
+    time_interval=time_interval,
+    datetime_col="Date"
+  )
+
+
 # Trendline exists, but not detected due to breakout
 NO_TREND_DUE_BREAKOUT_5m = get_candlestick_data('5m', '''
 Date                         Idx     Low     High     Open   Close   Volume
@@ -180,4 +199,7 @@ Date           Idx     Low     High   Open   Close   Volume
 2019-07-25     3       200     300    240    260     100000
 2019-07-26     4       200     300    240    260     100000
 2019-07-27     5       180     320    240    260     100000
-''')
\ No newline at end of file
+''')
+
+# Random walk with enough structure for many overlapping lines, used to compare implementations
+RANDOM_WALK_1m = get_random_walk_candlestick_data('1m', 40, seed=2)
@@ -1,4 +1,8 @@
-from .structs import TrendlineTypes, CandlestickData
+from .structs import TrendlineTypes, ScanEngines, ConcurrencyModes, ResultFormats, PlotResources, DetectStats, CandlestickData
 from .plot import plot
 from .detect import get_pivots, detect
-__all__ = ['TrendlineTypes', 'CandlestickData', 'get_pivots', 'detect', 'plot']
\ No newline at end of file
+from .results import CompactTrendlines
+from .stream import StreamingDetector, SlidingWindowDetector
+from .batch import detect_many, plot_many
+from .store import CandleStore
+__all__ = ['TrendlineTypes', 'ScanEngines', 'ConcurrencyModes', 'ResultFormats', 'PlotResources', 'DetectStats', 'CandlestickData', 'get_pivots', 'detect', 'CompactTrendlines', 'StreamingDetector', 'SlidingWindowDetector', 'detect_many', 'plot_many', 'CandleStore', 'plot']
\ No newline at end of file
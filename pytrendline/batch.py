@@ -0,0 +1,352 @@
+import os
+import re
+import html
+import sys
+import pickle
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import structs
+from .detect import detect
+from .results import CompactTrendlines
+from .plot import plot, css_hack, _shared_resources
+
+# detect(...) keyword arguments shared by every symbol of a batch, set once per worker process
+_worker_detect_kwargs = {}
+
+# out_dir and plot(...) keyword arguments shared by every symbol of a plot_many batch, set
+# once per worker process
+_worker_plot_kwargs = {}
+
+def detect_many(
+  candlestick_data_by_symbol=None,
+  workers=None,
+  progress=None,
+  **detect_kwargs,
+):
+  '''
+  Runs detect(...) for every CandlestickData in candlestick_data_by_symbol (a dict of
+  symbol -> CandlestickData) over a pool of worker processes. Every keyword argument
+  other than workers and progress is passed on to detect(...).
+
+  Candles are sent to the workers as plain numpy arrays rather than pickled dataframes.
+  A failing symbol does not stop the batch: its error is reported through progress and
+  returned in the errors dict.
+
+  progress, if given, is called as progress(symbol, num_done, num_total, error) after
+  each symbol finishes, where error is None on success.
+
+  Returns (results, errors), where results maps each successful symbol to the output of
+  detect(...) and errors maps each failed symbol to its traceback string.
+  '''
+  if candlestick_data_by_symbol == None or type(candlestick_data_by_symbol) != dict:
+    raise Exception("candlestick_data_by_symbol argument for detect_many needs to be a dict of symbol to CandlestickData")
+
+  if workers == None:
+    workers = os.cpu_count() or 1
+
+  results = {}
+  errors = {}
+  num_total = len(candlestick_data_by_symbol)
+
+  def report(symbol, result, error):
+    if error == None:
+      result['candlestick_data'] = candlestick_data_by_symbol[symbol]
+      for value in result.values():
+        if isinstance(value, CompactTrendlines):
+          value.candlestick_data = result['candlestick_data']
+      results[symbol] = result
+    else:
+      errors[symbol] = error
+    if progress != None:
+      progress(symbol, len(results) + len(errors), num_total, error)
+
+  # Run in this process when there is nothing to gain from a pool
+  if workers <= 1 or num_total <= 1:
+    _init_worker(detect_kwargs)
+    for symbol, candlestick_data in candlestick_data_by_symbol.items():
+      report(symbol, *_detect_one(candlestick_data))
+    return results, errors
+
+  # detect_kwargs are handed to each worker once through the pool initializer
+  mp_context = _pool_context('detect_many', detect_kwargs)
+  with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker, initargs=(detect_kwargs,)) as executor:
+    futures = {}
+    for symbol, candlestick_data in candlestick_data_by_symbol.items():
+      try:
+        futures[executor.submit(_detect_packed, _pack_candlestick_data(candlestick_data))] = symbol
+      except Exception:
+        report(symbol, None, traceback.format_exc())
+
+    for future in as_completed(futures):
+      symbol = futures[future]
+      try:
+        result, error = future.result()
+      except Exception:
+        result, error = None, traceback.format_exc()
+      report(symbol, result, error)
+
+  return results, errors
+
+def _pool_context(caller, kwargs):
+  '''
+  Multiprocessing context of the worker pools. On Linux, while this process runs no other
+  thread, workers are forked and inherit the pool initializer arguments, so kwargs may hold
+  config lambdas. Forking is not safe on macOS, nor once other threads run (such as the
+  pools of ConcurrencyModes), so workers are otherwise started with forkserver where it is
+  available and spawn elsewhere. Both pickle kwargs, which are checked to be picklable before
+  any worker starts
+  '''
+  start_methods = multiprocessing.get_all_start_methods()
+  if sys.platform.startswith('linux') and 'fork' in start_methods and threading.active_count() == 1:
+    return multiprocessing.get_context('fork')
+
+  try:
+    pickle.dumps(kwargs)
+  except Exception as e:
+    raise Exception(
+      "{} arguments must be picklable when workers > 1 and workers cannot be forked (outside Linux, or while "
+      "other threads run), use module level functions instead of lambdas in config or pass workers=1 ({})".format(caller, e)
+    )
+  return multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+
+def _init_worker(detect_kwargs):
+  global _worker_detect_kwargs
+  _worker_detect_kwargs = detect_kwargs
+
+def _detect_one(candlestick_data):
+  try:
+    return detect(candlestick_data=candlestick_data, **_worker_detect_kwargs), None
+  except Exception:
+    return None, traceback.format_exc()
+
+def _detect_packed(packed):
+  try:
+    candlestick_data = _unpack_candlestick_data(packed)
+  except Exception:
+    return None, traceback.format_exc()
+
+  result, error = _detect_one(candlestick_data)
+  # The parent process already holds the candles, so avoid sending them back
+  if result != None:
+    del result['candlestick_data']
+    for value in result.values():
+      if isinstance(value, CompactTrendlines):
+        value.candlestick_data = None
+  return result, error
+
+def _pack_candlestick_data(candlestick_data):
+  if type(candlestick_data) != structs.CandlestickData:
+    raise Exception("candlestick_data input provided is of invalid type. See README for instructions")
+
+  df = candlestick_data.df
+  columns = []
+  for name in df.columns:
+    series = df[name]
+    # Timezone aware datetimes would become an object array, send them as UTC nanoseconds instead
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+      columns.append((name, series.dt.tz_convert('UTC').to_numpy(dtype='datetime64[ns]'), series.dt.tz))
+    else:
+      columns.append((name, series.to_numpy(), None))
+
+  return {
+    'time_interval': candlestick_data.time_interval,
+    'index': np.asarray(df.index),
+    'columns': columns,
+  }
+
+def _unpack_candlestick_data(packed):
+  data = {}
+  for name, values, tz in packed['columns']:
+    if tz != None:
+      data[name] = pd.DatetimeIndex(values).tz_localize('UTC').tz_convert(tz)
+    else:
+      data[name] = values
+
+  # The frame is only used by this worker, so there is no need to copy it again
+  df = pd.DataFrame(data, index=packed['index'])
+  return structs.CandlestickData(df=df, time_interval=packed['time_interval'], datetime_col="Date", copy=False)
+
+def plot_many(
+  results_by_symbol=None,
+  out_dir='.',
+  workers=None,
+  progress=None,
+  index_page_size=500,
+  **plot_kwargs,
+):
+  '''
+  Writes the plot(...) of every output of detect(...) in results_by_symbol (a dict of
+  symbol -> results, as returned by detect_many) to out_dir/<symbol>.html over a pool of
+  worker processes, along with an index page (out_dir/index.html, continued in
+  index-2.html, index-3.html... every index_page_size symbols) linking every symbol sorted
+  by its best trendline score. Every keyword argument other than workers, progress and
+  index_page_size is passed on to plot(...). resources defaults to PlotResources.SHARED,
+  so BokehJS is copied to out_dir once for the whole batch.
+
+  Like detect_many, a failing symbol does not stop the batch and progress, if given, is
+  called as progress(symbol, num_done, num_total, error) after each symbol finishes.
+
+  Returns (index_path, errors), where errors maps each failed symbol to its traceback string.
+  '''
+  if results_by_symbol == None or type(results_by_symbol) != dict:
+    raise Exception("results_by_symbol argument for plot_many needs to be a dict of symbol to output of detect(...)")
+
+  if type(index_page_size) != int or index_page_size < 1:
+    raise Exception("index_page_size argument for plot_many must be a positive integer, received {}".format(index_page_size))
+
+  if workers == None:
+    workers = os.cpu_count() or 1
+
+  plot_kwargs.setdefault('resources', structs.PlotResources.SHARED)
+  os.makedirs(out_dir, exist_ok=True)
+  # Copy BokehJS before starting the workers rather than having them race for it
+  if plot_kwargs['resources'] == structs.PlotResources.SHARED:
+    _shared_resources(out_dir)
+
+  filenames = {}
+  errors = {}
+  num_total = len(results_by_symbol)
+
+  def report(symbol, error):
+    if error != None:
+      errors[symbol] = error
+    if progress != None:
+      progress(symbol, len(filenames) + len(errors), num_total, error)
+
+  for symbol in results_by_symbol:
+    filenames[symbol] = _report_filename(symbol, filenames.values())
+
+  worker_plot_kwargs = dict(plot_kwargs, filedir=out_dir)
+
+  if workers <= 1 or num_total <= 1:
+    _init_plot_worker(worker_plot_kwargs)
+    for symbol, results in results_by_symbol.items():
+      report(symbol, _plot_one(results, filenames[symbol]))
+  else:
+    mp_context = _pool_context('plot_many', worker_plot_kwargs)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_plot_worker, initargs=(worker_plot_kwargs,)) as executor:
+      futures = {}
+      for symbol, results in results_by_symbol.items():
+        try:
+          futures[executor.submit(_plot_packed, _pack_results(results), filenames[symbol])] = symbol
+        except Exception:
+          report(symbol, traceback.format_exc())
+
+      for future in as_completed(futures):
+        symbol = futures[future]
+        try:
+          error = future.result()
+        except Exception:
+          error = traceback.format_exc()
+        report(symbol, error)
+
+  plotted = {symbol: filename for symbol, filename in filenames.items() if symbol not in errors}
+  return _write_index_pages(out_dir, results_by_symbol, plotted, errors, index_page_size), errors
+
+def _report_filename(symbol, taken):
+  # Symbols may contain characters that are not safe in file names, such as "BRK/B"
+  base = re.sub(r'[^A-Za-z0-9._-]', '_', str(symbol)) or '_'
+  filename = base + '.html'
+  suffix = 2
+  while filename in taken or re.match(r'index(-\d+)?\.html$', filename):
+    filename = '{}_{}.html'.format(base, suffix)
+    suffix += 1
+  return filename
+
+def _init_plot_worker(plot_kwargs):
+  global _worker_plot_kwargs
+  _worker_plot_kwargs = plot_kwargs
+
+def _plot_one(results, filename):
+  try:
+    plot(results=results, filename=filename, **_worker_plot_kwargs)
+    return None
+  except Exception:
+    return traceback.format_exc()
+
+def _pack_results(results):
+  if type(results) != dict or 'candlestick_data' not in results:
+    raise Exception("results for plot_many need to be output of detect(...)")
+
+  # Candles are sent as arrays, and compact trendlines without their reference to them
+  packed = {}
+  for key, value in results.items():
+    if key == 'candlestick_data':
+      packed[key] = _pack_candlestick_data(value)
+    elif isinstance(value, CompactTrendlines):
+      packed[key] = CompactTrendlines(
+        value.trend_type, value.columns, value.point_offsets, value.point_indices,
+        value.global_max_or_mins, value.index, None,
+      )
+    else:
+      packed[key] = value
+  return packed
+
+def _plot_packed(packed, filename):
+  try:
+    results = dict(packed)
+    results['candlestick_data'] = _unpack_candlestick_data(packed['candlestick_data'])
+    for value in results.values():
+      if isinstance(value, CompactTrendlines):
+        value.candlestick_data = results['candlestick_data']
+  except Exception:
+    return traceback.format_exc()
+
+  return _plot_one(results, filename)
+
+def _best_score(results):
+  # Highest trendline score of a detect(...) output, None when it has no trendline
+  best = None
+  for key in ['support_trendlines', 'resistance_trendlines']:
+    trendlines = results.get(key)
+    if trendlines is None or len(trendlines) == 0:
+      continue
+    if isinstance(trendlines, CompactTrendlines):
+      score = trendlines.columns['score'].max()
+    else:
+      score = trendlines['score'].max()
+    best = float(score) if best == None else max(best, float(score))
+  return best
+
+def _write_index_pages(out_dir, results_by_symbol, filenames, errors, page_size):
+  rows = [(symbol, _best_score(results_by_symbol[symbol]), filename) for symbol, filename in filenames.items()]
+  # Best score first, symbols without trendlines last
+  rows.sort(key=lambda row: (row[1] == None, -(row[1] or 0)))
+
+  num_pages = max(1, (len(rows) + page_size - 1) // page_size)
+  page_names = ['index.html'] + ['index-{}.html'.format(page) for page in range(2, num_pages + 1)]
+
+  for page in range(num_pages):
+    with open(os.path.join(out_dir, page_names[page]), 'w') as outfile:
+      outfile.write('<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n')
+      outfile.write('<title>pytrendline results ({}/{})</title>\n'.format(page + 1, num_pages))
+      outfile.write('<style class="custom" type="text/css">{}</style>\n'.format(css_hack))
+      outfile.write('</head>\n<body>\n<h1>Trendline results</h1>\n')
+
+      outfile.write('<table class="dataframe">\n<tr><th>#</th><th>Symbol</th><th>Best score</th></tr>\n')
+      for rank, (symbol, score, filename) in enumerate(rows[page * page_size:(page + 1) * page_size], page * page_size + 1):
+        outfile.write('<tr><td>{}</td><td><a href="{}">{}</a></td><td>{}</td></tr>\n'.format(
+          rank, html.escape(filename, quote=True), html.escape(str(symbol)), '' if score == None else '%.3f' % score
+        ))
+      outfile.write('</table>\n')
+
+      if page > 0:
+        outfile.write('<a href="{}">Previous</a>\n'.format(page_names[page - 1]))
+      if page < num_pages - 1:
+        outfile.write('<a href="{}">Next</a>\n'.format(page_names[page + 1]))
+
+      if page == 0 and len(errors) > 0:
+        outfile.write('<h2>Failed symbols</h2>\n<ul>\n')
+        for symbol in errors:
+          outfile.write('<li>{}</li>\n'.format(html.escape(str(symbol))))
+        outfile.write('</ul>\n')
+
+      outfile.write('</body>\n</html>\n')
+
+  return os.path.join(out_dir, page_names[0])
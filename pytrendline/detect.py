@@ -1,9 +1,24 @@
 import numpy as np
 import pandas as pd
 import sys
+import time
+import bisect
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
 
 from . import util
 from . import structs
+from . import kernels
+from .results import (
+  TRENDS_DF_SCHEMA,
+  TRENDS_DF_COLUMNS,
+  COMPACT_COLUMNS,
+  COMPACT_MARK_COLUMNS,
+  CompactTrendlines,
+  _build_trends_df,
+  _fill_trendline_dates,
+)
 
 DEFAULT_CONFIG = {
   # For some price at date t, what difference must be exceeded between p_t-1 and p_t+1
@@ -26,8 +41,10 @@ DEFAULT_CONFIG = {
   # How much does a trendline break into any candle for it to be considered a break-out
   "breakout_tolerance": lambda candles: util.avg_candle_range(candles) * 0.08,
 
-  # Scores a detected trendline given a slice of distance from trend to price, slope, and candlesticks
-  "scoring_function": lambda candles, err_distances, num_points, slope: (util.avg_candle_range(candles) / util.mean(err_distances)) * (2.5 ** num_points),
+  # Scores a detected trendline given a slice of distance from trend to price, slope, and candlesticks.
+  # The mean distance is floored so that lines through exactly aligned points, which have no
+  # distance at all, are still ranked by their number of points rather than all scoring inf
+  "scoring_function": lambda candles, err_distances, num_points, slope: (util.avg_candle_range(candles) / max(util.mean(err_distances), util.avg_candle_range(candles) * 1e-9)) * (2.5 ** num_points),
 
   # Max and min allowable slope angle for both resistance and support lines
   # By default set to allow all angles but min or max can be set to 0 to only allow possitive / negative slopes
@@ -38,18 +55,105 @@ DEFAULT_CONFIG = {
 
   # Max and min allowable last price point for both resistance and support lines
   # By default set to be 1.5X of last candle closing price for max and 0.667x for min 
-  'max_allowable_support_last_price': lambda candles: candles.df.Close.iloc[-1] * 1.5,
-  'min_allowable_support_last_price': lambda candles: candles.df.Close.iloc[-1] * 0.667,
-  'max_allowable_resistance_last_price': lambda candles: candles.df.Close.iloc[-1] * 1.5,
-  'min_allowable_resistance_last_price': lambda candles: candles.df.Close.iloc[-1] * 0.667,
+  'max_allowable_support_last_price': lambda candles: candles.last_close() * 1.5,
+  'min_allowable_support_last_price': lambda candles: candles.last_close() * 0.667,
+  'max_allowable_resistance_last_price': lambda candles: candles.last_close() * 1.5,
+  'min_allowable_resistance_last_price': lambda candles: candles.last_close() * 0.667,
 }
 
+class ResolvedConfig():
+  '''
+  Config thresholds evaluated for one set of candlestick data. detect builds this once per call
+  and shares it with get_pivots, the candidate scan and _mark_duplicates, so that every
+  config lambda runs a single time. Keys missing from config fall back to DEFAULT_CONFIG
+  '''
+  def __init__(self, candlestick_data, config=DEFAULT_CONFIG):
+    self.candlestick_data = candlestick_data
+    self.avg_candle_range = util.avg_candle_range(candlestick_data)
+
+    for key, default in DEFAULT_CONFIG.items():
+      value = config.get(key, default)
+      # The scoring function is evaluated per trendline, so it is kept as a callable
+      if key != "scoring_function":
+        value = value(candlestick_data)
+      setattr(self, key, value)
+
+  def score(self, err_distances, num_points, slope):
+    return self.scoring_function(self.candlestick_data, err_distances, num_points, slope)
+
+  def slope_limits(self, trend_type):
+    if trend_type == structs.TrendlineTypes.SUPPORT:
+      return self.min_allowable_support_slope, self.max_allowable_support_slope
+    return self.min_allowable_resistance_slope, self.max_allowable_resistance_slope
+
+  def last_price_limits(self, trend_type):
+    if trend_type == structs.TrendlineTypes.SUPPORT:
+      return self.min_allowable_support_last_price, self.max_allowable_support_last_price
+    return self.min_allowable_resistance_last_price, self.max_allowable_resistance_last_price
+
+def resolve_config(candlestick_data, config):
+  if isinstance(config, ResolvedConfig):
+    return config
+  return ResolvedConfig(candlestick_data, config)
+
+def _pivot_mask(prices, trend_type, separation_thres, grouping_thres, scan_from_index=0):
+  '''
+  Marks which points in prices are pivots. For every interior point, the neighbour compared
+  against on each side is found by stepping over the run of near-equal prices next to it
+  (at most max_number_continuous_pivots - 1 steps). Run lengths are found for all points at
+  once with cumulative min/max over the positions where a run is broken. First and last
+  points are always pivots.
+
+  prices start at candle scan_from_index. get_pivots has always bounded the steps after a
+  point by comparing its candle index, not its position in prices, against len(prices) - 1,
+  so runs stop scan_from_index points before the end. The same bound is kept here
+  '''
+  max_number_continuous_pivots = 6
+
+  n = len(prices)
+  is_pivot = np.zeros(n, dtype=bool)
+  is_pivot[0] = is_pivot[-1] = True
+  if n < 3: return is_pivot
+
+  positions = np.arange(n)
+  interior = positions[1:-1]
+
+  # grouped[t] is True when prices t and t+1 are close enough to be part of the same run
+  grouped = np.abs(np.diff(prices)) < grouping_thres
+  next_break = np.minimum.accumulate(np.where(grouped, n - 1, positions[:-1])[::-1])[::-1]
+  last_break = np.maximum.accumulate(np.where(grouped, -1, positions[:-1]))
+
+  right_steps = np.minimum(next_break[interior] - interior, np.maximum(n - 2 - scan_from_index - interior, 0))
+  right_steps = np.minimum(right_steps, max_number_continuous_pivots - 1)
+  left_steps = np.minimum((interior - 1) - last_break[interior - 1], interior - 1)
+  left_steps = np.minimum(left_steps, max_number_continuous_pivots - 1)
+
+  pcur = prices[interior]
+  pnext = prices[interior + 1 + right_steps]
+  pprev = prices[interior - 1 - left_steps]
+
+  if trend_type == structs.TrendlineTypes.RESISTANCE:
+    is_extreme = ~((pprev > pcur) | (pnext > pcur))
+  elif trend_type == structs.TrendlineTypes.SUPPORT:
+    is_extreme = ~((pprev < pcur) | (pnext < pcur))
+  else:
+    is_extreme = np.ones(len(interior), dtype=bool)
+
+  prev_gap = np.abs(pcur - pprev)
+  next_gap = np.abs(pcur - pnext)
+  is_separated = ((prev_gap > separation_thres * (1/4)) & (next_gap > separation_thres * (3/4))) | \
+    ((prev_gap > separation_thres * (3/4)) & (next_gap > separation_thres * (1/4)))
+
+  is_pivot[1:-1] = is_extreme & is_separated
+  return is_pivot
+
 def get_pivots(
   candlestick_data=None,
   trend_type=None,
   scan_from_index=None,
   config=DEFAULT_CONFIG,
-  debug=False
+  debug=False,
+  engine=structs.ScanEngines.PYTHON,
 ):
   if candlestick_data == None:
     raise Exception("No candlestick data provided")
@@ -61,52 +165,18 @@ def get_pivots(
   elif type(trend_type) != str:
     raise Exception("trend_type input provided is of invalid type. See README for instructions")
 
-  separation_thres = config.get('pivot_seperation_threshold', DEFAULT_CONFIG['pivot_seperation_threshold'])(candlestick_data)
-  grouping_thres = config.get('pivot_grouping_threshold', DEFAULT_CONFIG['pivot_grouping_threshold'])(candlestick_data)
-
-  col = "Low" if trend_type == structs.TrendlineTypes.SUPPORT else "High"  
-  pseries = candlestick_data.df[col][scan_from_index:]
-  pivots = set([])
-  max_number_continuous_pivots = 6
-
-  first_index = pseries.index[0]
-  last_index = pseries.index[-1]
-
-  for i in range(first_index+1,last_index):
-    pcur = pseries[i]
-    pprev = pseries[i-1]
-
-    j = 1
-    while j < max_number_continuous_pivots and (i + j) < len(pseries) - 1:
-      if abs(pseries[i + j - 1] - pseries[i + j]) < grouping_thres:
-        j += 1
-      else:
-        break
-
-    pnext = pseries[i + j]
-
-    j = 1
-    while j < max_number_continuous_pivots and (i - j) > first_index:
-      if abs(pseries[i - j + 1] - pseries[i - j]) < grouping_thres:
-        j += 1
-      else:
-        break
-    
-    pprev = pseries[i - j]
+  config = resolve_config(candlestick_data, config)
+  separation_thres = config.pivot_seperation_threshold
+  grouping_thres = config.pivot_grouping_threshold
 
-    if trend_type == structs.TrendlineTypes.RESISTANCE and \
-      (pprev > pcur or pnext > pcur): continue
-    elif trend_type == structs.TrendlineTypes.SUPPORT and \
-      (pprev < pcur or pnext < pcur): continue
+  prices = _trend_prices(candlestick_data, trend_type)[scan_from_index:]
+  first_index = candlestick_data.df.index[scan_from_index or 0]
 
-    if abs(pcur - pprev) > separation_thres * (1/4) and abs(pcur - pnext) > separation_thres * (3/4):
-      pivots.add(i)
-    elif abs(pcur - pprev) > separation_thres * (3/4) and abs(pcur - pnext) > separation_thres * (1/4):
-      pivots.add(i)
-
-  # Always include last point and first point as pivots
-  pivots.add(first_index)
-  pivots.add(last_index)
+  if engine == structs.ScanEngines.NUMBA and kernels.HAS_NUMBA:
+    is_pivot = kernels.pivot_mask(prices, _kernel_trend_code(trend_type), float(separation_thres), float(grouping_thres), scan_from_index or 0)
+  else:
+    is_pivot = _pivot_mask(prices, trend_type, separation_thres, grouping_thres, scan_from_index or 0)
+  pivots = set((np.flatnonzero(is_pivot) + first_index).tolist())
 
   if debug:
     print(
@@ -114,7 +184,7 @@ def get_pivots(
       "Grouping Threshold = {}\n".format(grouping_thres) + \
       "Separation Threshold = {}\n".format(separation_thres) + \
       "Pivots found = {}\n".format(pivots) + \
-      "Percentage of pivots to total data points = {}\n".format(((len(pivots) / len(pseries))) * 100 )
+      "Percentage of pivots to total data points = {}\n".format(((len(pivots) / len(prices))) * 100 )
     )
     
   return pivots
@@ -143,8 +213,38 @@ def detect(
   config=DEFAULT_CONFIG,
 
   # Console print debugs
-  debug=False
+  debug=False,
+
+  # Specify which implementation scans candidate lines, see structs.ScanEngines
+  engine=structs.ScanEngines.PYTHON,
+
+  # Specify how the SUPPORT and RESISTANCE passes of TrendlineTypes.BOTH run, see structs.ConcurrencyModes
+  concurrency=structs.ConcurrencyModes.NONE,
+
+  # Return per-stage timings and counters of each pass as a structs.DetectStats
+  collect_stats=False,
+
+  # Specify how trendlines are returned, see structs.ResultFormats
+  result_format=structs.ResultFormats.DATAFRAME,
 ):
+  # Input validation
+  if candlestick_data == None:
+    raise Exception("No candlestick data provided")
+  elif type(candlestick_data) != structs.CandlestickData:
+    raise Exception("candlestick_data input provided is of invalid type. See README for instructions")
+
+  if engine not in structs.VALID_SCAN_ENGINES:
+    raise Exception("engine must be one of :\n{}".format(structs.VALID_SCAN_ENGINES))
+
+  if concurrency not in structs.VALID_CONCURRENCY_MODES:
+    raise Exception("concurrency must be one of :\n{}".format(structs.VALID_CONCURRENCY_MODES))
+
+  if result_format not in structs.VALID_RESULT_FORMATS:
+    raise Exception("result_format must be one of :\n{}".format(structs.VALID_RESULT_FORMATS))
+
+  # Evaluate config thresholds once, shared by both trend types
+  resolved_config = resolve_config(candlestick_data, config)
+
   def detect_wrapped(tt):
     '''
     The algorithm will fly through all N^2 pivot point pairs,
@@ -159,33 +259,27 @@ def detect(
         and mark the one with best score
 
     '''
-    # Input validation
-    if candlestick_data == None:
-      raise Exception("No candlestick data provided")
-    elif type(candlestick_data) != structs.CandlestickData:
-      raise Exception("candlestick_data input provided is of invalid type. See README for instructions")
+    setup = prepare_pass(tt)
+    stats, scan_args = setup[1], setup[-1]
+    return finish_pass(setup, _scan(*scan_args, stats=stats))
 
+  def prepare_pass(tt):
+    # Finds the pivots of a pass and the arguments of its scan, which are only arrays and
+    # numbers so that the scan can run in a worker process
+    # Input validation
     if tt == None:
       raise Exception("No trend_type data provided")
     elif type(tt) != str:
       raise Exception("trend_type input provided is of invalid type. See README for instructions")
 
+    stats = structs.DetectStats(tt) if collect_stats else None
+    pass_start = time.perf_counter()
+
     # Process config
-    max_allowable_error_pt_to_trend = config.get("max_allowable_error_pt_to_trend", DEFAULT_CONFIG["max_allowable_error_pt_to_trend"])(candlestick_data)
-    breakout_tolerance = config.get("breakout_tolerance", DEFAULT_CONFIG["breakout_tolerance"])(candlestick_data)
-    max_allowable_support_slope = config.get("max_allowable_support_slope", DEFAULT_CONFIG["max_allowable_support_slope"])(candlestick_data)
-    min_allowable_support_slope = config.get("min_allowable_support_slope", DEFAULT_CONFIG["min_allowable_support_slope"])(candlestick_data)
-    max_allowable_resistance_slope = config.get("max_allowable_resistance_slope", DEFAULT_CONFIG["max_allowable_resistance_slope"])(candlestick_data)
-    min_allowable_resistance_slope = config.get("min_allowable_resistance_slope", DEFAULT_CONFIG["min_allowable_resistance_slope"])(candlestick_data)
-    max_allowable_support_last_price = config.get("max_allowable_support_last_price", DEFAULT_CONFIG["max_allowable_support_last_price"])(candlestick_data)
-    min_allowable_support_last_price = config.get("min_allowable_support_last_price", DEFAULT_CONFIG["min_allowable_support_last_price"])(candlestick_data)
-    max_allowable_resistance_last_price = config.get("max_allowable_resistance_last_price", DEFAULT_CONFIG["max_allowable_resistance_last_price"])(candlestick_data)
-    min_allowable_resistance_last_price = config.get("min_allowable_resistance_last_price", DEFAULT_CONFIG["min_allowable_resistance_last_price"])(candlestick_data)
-
-    max_allowable_slope = max_allowable_support_slope if tt == structs.TrendlineTypes.SUPPORT else max_allowable_resistance_slope
-    min_allowable_slope = min_allowable_support_slope if tt == structs.TrendlineTypes.SUPPORT else min_allowable_resistance_slope
-    max_allowable_last_price = max_allowable_support_last_price if tt == structs.TrendlineTypes.SUPPORT else max_allowable_resistance_last_price
-    min_allowable_last_price = min_allowable_support_last_price if tt == structs.TrendlineTypes.SUPPORT else min_allowable_resistance_last_price
+    max_allowable_error_pt_to_trend = resolved_config.max_allowable_error_pt_to_trend
+    breakout_tolerance = resolved_config.breakout_tolerance
+    min_allowable_slope, max_allowable_slope = resolved_config.slope_limits(tt)
+    min_allowable_last_price, max_allowable_last_price = resolved_config.last_price_limits(tt)
 
     if scan_from_date != None:
       scan_from_index = candlestick_data.df.loc[candlestick_data.df["Date"] == scan_from_date]
@@ -195,196 +289,72 @@ def detect(
     col = "Low" if tt == structs.TrendlineTypes.SUPPORT else "High"  
     pseries = candlestick_data.df[col][scan_from_index:]
     pseries_sub = pseries[scan_from_index:]
+    num_candles = len(pseries)
+    # Prices by candle index, read from a cached array rather than through the series
+    prices = _trend_prices(candlestick_data, tt)
 
     last_index = len(candlestick_data.df) - 1
-    last_price = pseries[len(candlestick_data.df) - 1]
-    time_interval_min = candlestick_data.time_interval_min()
 
-    pivots = get_pivots(candlestick_data, tt, scan_from_index, config)
-    pivots_sorted = list(pivots)
-    pivots_sorted.sort()
+    pivots_start = time.perf_counter()
+    pivots = get_pivots(candlestick_data, tt, scan_from_index, resolved_config, engine=engine)
+    if stats is not None:
+      stats.timings['pivots'] = time.perf_counter() - pivots_start
 
-    avg_candle_range = util.avg_candle_range(candlestick_data)
+    avg_candle_range = resolved_config.avg_candle_range
 
-    # Threshold to decide max difference from a global max/min and consecutive best next global max/min to both be considered
-    max_or_min_capture_thres = avg_candle_range * 0.10
-    global_max_or_mins = []
-    if tt == structs.TrendlineTypes.RESISTANCE:
-      global_max_or_mins = util.find_maxs_or_mins_in_series(pseries_sub, "max", max_or_min_capture_thres)
-    else:
-      global_max_or_mins = util.find_maxs_or_mins_in_series(pseries_sub, "min", max_or_min_capture_thres)
-
-    # Trendlines is a pandas dataframe containing columns ( slice_of_points, num_points, slope, intercept, score)
-    trends_df = pd.DataFrame(columns=[
-      'id',
-      'trendtype',
-      'pointset_indeces',
-      'pointset_dates',
-      'starts_at_index',
-      'starts_at_date',
-      'ends_at_index',
-      'ends_at_date',
-      'is_breakout',
-      'breakout_index',
-      'breakout_date',
-      'num_points',
-      'm',
-      'b',
-      'slope',
-      'price_at_last_date',
-      'score',
-      'includes_global_max_or_min',
-      'global_maxs_or_mins',
-      'price_at_next_future_date',
-      'duplicate_group_id',
-      'is_best_from_duplicate_group',
-      'overall_rank',
-      'rank_within_group',
-    ])
-    
-    for i in range(0, len(pseries)):
-      # If we only specify using pivot points as start, skip non pivots
-      if (first_pt_must_be_pivot or all_pts_must_be_pivots) and i not in pivots:
-          continue
+    global_max_or_mins = _find_global_max_or_mins(pseries_sub, tt, avg_candle_range)
 
-      # Skip indeces after opts.scan_from_index
-      if scan_from_index > i:
-        continue
-
-      for j in range(i+1, len(pseries)):
-        # If we only specify using pivot points as end, skip non pivots
-        if (last_pt_must_be_pivot or all_pts_must_be_pivots) and j not in pivots:
-            continue
-
-        iprice = pseries[i]
-        jprice = pseries[j]
-
-        # Find the slope and intercept made formed by these two points
-        m, b = np.polyfit([i, j], [iprice, jprice], 1)
-
-        # Slope is found by considering time_interval_min as rightward unit and average candle range as upward unit
-        slope = m * avg_candle_range
-      
-        # Check if the estimated price at last date or slope is allowable
-        trend_price_at_last = m * last_index + b
-
-
-        if slope > max_allowable_slope or slope < min_allowable_slope:
-          continue
+    scan_args = (
+      prices, num_candles, scan_from_index, pivots, tt,
+      max_allowable_error_pt_to_trend, breakout_tolerance,
+      min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+      avg_candle_range, last_index, min_points_required,
+      first_pt_must_be_pivot, last_pt_must_be_pivot, all_pts_must_be_pivots, ignore_breakouts, engine,
+    )
+    return tt, stats, pass_start, pivots, global_max_or_mins, scan_args
 
-        if trend_price_at_last > max_allowable_last_price or trend_price_at_last < min_allowable_last_price:
-          continue
+  def finish_pass(setup, candidates):
+    tt, stats, pass_start, pivots, global_max_or_mins, _ = setup
+    prices = _trend_prices(candlestick_data, tt)
 
-        # Determine breakouts + count the number of points within this trendline
-        num_points = 2
-        points_in_trendline = [i, j]
-        prices_in_trendline = [m * i + b, m * j + b]
-        is_breakout = False
-        breakout_index = None
-        breakout_date = None
-
-        for k in range(i, len(pseries)):
-          if last_pt_must_be_pivot and k not in pivots:
-            continue
-
-          # Skip checking for the i or j case because these are already points in the set
-          if k == i or k == j:
-            continue
-
-          trend_price_at_k = m * k + b
-
-          # Determine if this trend is a breakout, if it hasn't been identified as one already
-          if not is_breakout:
-            if tt == structs.TrendlineTypes.RESISTANCE and trend_price_at_k < pseries[k] - breakout_tolerance or \
-                tt == structs.TrendlineTypes.SUPPORT and trend_price_at_k > pseries[k] + breakout_tolerance:
-
-              breakout_index = k
-              breakout_date = candlestick_data.df.iloc[i].Date
-              is_breakout = True
-            
-
-          if abs(trend_price_at_k - pseries[k]) < max_allowable_error_pt_to_trend:
-            num_points += 1
-            points_in_trendline.append(k)
-            prices_in_trendline.append(trend_price_at_k)
-
-        # Check if we have the minimum required number of points for trend
-        if num_points < min_points_required: continue
-
-        # Construct a "pointset_id" a unique identifier for this set of points
-        points_in_trendline.sort()
-        points_in_trendline_str = ('[' + str(points_in_trendline[0]))
-        for p in range(1, len(points_in_trendline)):
-          points_in_trendline_str += ("," + str(points_in_trendline[p]))
-        points_in_trendline_str += "]"
-        pointset_id = ("R" if tt == structs.TrendlineTypes.RESISTANCE else "S") + "-" + points_in_trendline_str
-
-        # Determine if trendline has max or min, and skip this line if we require our lines have global max or min
-        global_pt_found = False
-        for p in points_in_trendline:
-          if p in global_max_or_mins:
-            global_pt_found = True
-
-        if trendline_must_include_global_maxmin_pt and not global_pt_found:
-          continue
+    # Compact trendlines derive their dates when converted to a dataframe
+    is_compact = result_format == structs.ResultFormats.COMPACT
+    trend_columns = _collect_trendlines(
+      candlestick_data, tt, prices, candidates, global_max_or_mins, resolved_config,
+      ignore_breakouts, trendline_must_include_global_maxmin_pt, stats, compact=is_compact,
+    )
+    if is_compact:
+      trends_df = _finalize_compact_trendlines(trend_columns, candlestick_data, tt, resolved_config, global_max_or_mins, stats)
+    else:
+      trends_df = _finalize_trendlines(trend_columns, candlestick_data, tt, resolved_config, stats)
 
-        # We already have this pointset, just different order
-        if pointset_id in trends_df.id.values: continue
-
-        # We ignore this i,j pair if this is a breakout
-        if is_breakout and ignore_breakouts: continue
-
-        # Scoring
-        err_distances = []
-        for w in range(0,num_points):
-          point_index = points_in_trendline[w]
-          price_at_trendline = prices_in_trendline[w]
-          price_actual = pseries[point_index]
-          err_distances.append(abs(price_at_trendline - price_actual))
-        
-        score = config.get("scoring_function", DEFAULT_CONFIG["scoring_function"])(candlestick_data, err_distances, num_points, slope)
-        
-        trends_df.loc[len(trends_df.index)] = [
-            pointset_id,
-            tt,
-            points_in_trendline,
-            [candlestick_data.df.iloc[pt].Date for pt in points_in_trendline],
-            points_in_trendline[0],
-            candlestick_data.df.iloc[points_in_trendline[0]].Date,
-            points_in_trendline[-1],
-            candlestick_data.df.iloc[points_in_trendline[-1]].Date,
-            is_breakout,
-            breakout_index,
-            breakout_date,
-            num_points,
-            m,
-            b,
-            slope,
-            trend_price_at_last,
-            score,
-            global_pt_found,
-            global_max_or_mins,
-            trend_price_at_last + m,
-            None,
-            False,
-            None,
-            0]
-
-    # Mark which of the trendlines are duplicate
-    trends_df = _mark_duplicates(trends_df, candlestick_data, tt, config)
-    trends_df = trends_df.sort_values(by='score', ascending=False)
-
-    # Correct data types
-    trends_df["is_breakout"] = trends_df["is_breakout"].astype(bool)
-
-    return trends_df, pivots
+    if stats is not None:
+      _finish_stats(stats, engine == structs.ScanEngines.NUMBA and kernels.HAS_NUMBA, ignore_breakouts)
+      stats.timings['total'] = time.perf_counter() - pass_start
 
+    return trends_df, pivots, stats
 
   if trend_type == structs.TrendlineTypes.BOTH:
-    support_trendlines, support_pivots = detect_wrapped(structs.TrendlineTypes.SUPPORT)
-    resistance_trendlines, resistance_pivots = detect_wrapped(structs.TrendlineTypes.RESISTANCE)
+    # Both passes only read the candles and resolved config, so the support pass can run
+    # while this thread runs the resistance pass, see structs.ConcurrencyModes
+    if concurrency == structs.ConcurrencyModes.THREADS and engine == structs.ScanEngines.NUMBA and kernels.HAS_NUMBA:
+      support_future = _concurrency_pool(concurrency).submit(detect_wrapped, structs.TrendlineTypes.SUPPORT)
+      resistance_trendlines, resistance_pivots, resistance_stats = detect_wrapped(structs.TrendlineTypes.RESISTANCE)
+      support_trendlines, support_pivots, support_stats = support_future.result()
+    elif concurrency == structs.ConcurrencyModes.PROCESSES:
+      # Only the support scan runs in the worker, on arrays and numbers. Its lines are
+      # scored and marked here, where the config callables are
+      support_setup = prepare_pass(structs.TrendlineTypes.SUPPORT)
+      _, support_stats, _, _, _, support_scan_args = support_setup
+      support_future = _submit_pooled_scan(support_scan_args, collect_stats)
+      resistance_trendlines, resistance_pivots, resistance_stats = detect_wrapped(structs.TrendlineTypes.RESISTANCE)
+      support_candidates = _pooled_scan_result(support_future, support_stats)
+      support_trendlines, support_pivots, support_stats = finish_pass(support_setup, support_candidates)
+    else:
+      support_trendlines, support_pivots, support_stats = detect_wrapped(structs.TrendlineTypes.SUPPORT)
+      resistance_trendlines, resistance_pivots, resistance_stats = detect_wrapped(structs.TrendlineTypes.RESISTANCE)
 
-    return {
+    results = {
       'trend_type': trend_type,
       'candlestick_data': candlestick_data,
       'support_pivots': support_pivots,
@@ -392,28 +362,788 @@ def detect(
       'resistance_pivots': resistance_pivots,
       'resistance_trendlines': resistance_trendlines,
     }
+    if collect_stats:
+      results['support_stats'] = support_stats
+      results['resistance_stats'] = resistance_stats
+    return results
   elif trend_type == structs.TrendlineTypes.SUPPORT:
-    support_trendlines, support_pivots = detect_wrapped(structs.TrendlineTypes.SUPPORT)
+    support_trendlines, support_pivots, support_stats = detect_wrapped(structs.TrendlineTypes.SUPPORT)
 
-    return {
+    results = {
       'trend_type': trend_type,
       'candlestick_data': candlestick_data,
       'support_pivots': support_pivots,
       'support_trendlines': support_trendlines,
     }
+    if collect_stats:
+      results['support_stats'] = support_stats
+    return results
   else:
-    resistance_trendlines, resistance_pivots = detect_wrapped(structs.TrendlineTypes.RESISTANCE)
+    resistance_trendlines, resistance_pivots, resistance_stats = detect_wrapped(structs.TrendlineTypes.RESISTANCE)
 
-    return {
+    results = {
       'trend_type': trend_type,
       'candlestick_data': candlestick_data,
       'resistance_pivots': resistance_pivots,
       'resistance_trendlines': resistance_trendlines
     }
+    if collect_stats:
+      results['resistance_stats'] = resistance_stats
+    return results
+
+# Pools running the support pass of ConcurrencyModes.THREADS and the support scan of
+# ConcurrencyModes.PROCESSES, created on first use and reused by later detect calls
+_concurrency_pools = {}
+
+def _concurrency_pool(concurrency):
+  pool = _concurrency_pools.get(concurrency)
+  if pool is None:
+    if concurrency == structs.ConcurrencyModes.THREADS:
+      pool = ThreadPoolExecutor(max_workers=1)
+    else:
+      # The worker only ever receives arrays and numbers, so it is started from a fresh
+      # interpreter rather than forked from a process that may be running other threads
+      start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+      pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(start_method))
+    _concurrency_pools[concurrency] = pool
+  return pool
+
+def _submit_pooled_scan(scan_args, collect_stats):
+  return _concurrency_pool(structs.ConcurrencyModes.PROCESSES).submit(_pooled_scan, scan_args, collect_stats)
+
+def _pooled_scan(scan_args, collect_stats):
+  # Runs in the worker process of ConcurrencyModes.PROCESSES
+  stats = structs.DetectStats(scan_args[4]) if collect_stats else None
+  candidates = list(_scan(*scan_args, stats=stats))
+  return candidates, stats
+
+def _pooled_scan_result(future, stats):
+  '''
+  Waits for a scan submitted with _submit_pooled_scan and adds the worker's scan timings and
+  counters to stats. A pool whose worker died is dropped, so that the next call starts a new one
+  '''
+  try:
+    candidates, scan_stats = future.result()
+  except BrokenExecutor:
+    _concurrency_pools.pop(structs.ConcurrencyModes.PROCESSES, None)
+    raise
+
+  if stats is not None:
+    for name in ['scan', 'touch_counting']:
+      stats.timings[name] += scan_stats.timings[name]
+    for name in ['pairs_tested', 'pairs_pruned_slope', 'pairs_pruned_price', 'candidates', 'breakouts']:
+      stats.counters[name] += scan_stats.counters[name]
+  return iter(candidates)
+
+def _scan(
+  prices,
+  num_candles,
+  scan_from_index,
+  pivots,
+  trend_type,
+  max_allowable_error_pt_to_trend,
+  breakout_tolerance,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+  avg_candle_range,
+  last_index,
+  min_points_required,
+  first_pt_must_be_pivot,
+  last_pt_must_be_pivot,
+  all_pts_must_be_pivots,
+  ignore_breakouts,
+  engine,
+  stats=None,
+):
+  # Candidate lines of one pass from the scan engine picked by detect(..., engine=)
+  if engine == structs.ScanEngines.NUMBA and kernels.HAS_NUMBA:
+    return _scan_numba(
+      prices, num_candles, scan_from_index, pivots, trend_type,
+      max_allowable_error_pt_to_trend, breakout_tolerance,
+      min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+      avg_candle_range, last_index, min_points_required,
+      first_pt_must_be_pivot, last_pt_must_be_pivot, all_pts_must_be_pivots, ignore_breakouts,
+      stats,
+    )
+  elif engine in [structs.ScanEngines.NUMPY, structs.ScanEngines.NUMBA]:
+    return _scan_numpy(
+      prices[scan_from_index:], scan_from_index, pivots, trend_type,
+      max_allowable_error_pt_to_trend, breakout_tolerance,
+      min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+      avg_candle_range, last_index, min_points_required,
+      first_pt_must_be_pivot, last_pt_must_be_pivot, all_pts_must_be_pivots, ignore_breakouts,
+      stats,
+    )
+  return _scan_python(
+    prices, num_candles, scan_from_index, pivots, trend_type,
+    max_allowable_error_pt_to_trend, breakout_tolerance,
+    min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+    avg_candle_range, last_index, min_points_required,
+    first_pt_must_be_pivot, last_pt_must_be_pivot, all_pts_must_be_pivots, ignore_breakouts,
+    stats,
+  )
+
+def _scan_python(
+  prices,
+  num_candles,
+  scan_from_index,
+  pivots,
+  trend_type,
+  max_allowable_error_pt_to_trend,
+  breakout_tolerance,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+  avg_candle_range,
+  last_index,
+  min_points_required,
+  first_pt_must_be_pivot,
+  last_pt_must_be_pivot,
+  all_pts_must_be_pivots,
+  ignore_breakouts=False,
+  stats=None,
+):
+  '''
+  The i/j/k scan of the python engine. prices is indexed by candle index. Yields
+  (i, j, m, b, touches, breakout_index) for every line with enough points, in (i, j) order.
+  With ignore_breakouts, lines are dropped as soon as they break out, as _collect_trendlines
+  would discard them anyway
+  '''
+  pivots_sorted = [pivot for pivot in sorted(pivots) if pivot < num_candles]
+
+  # If we only specify using pivot points as start, only iterate over pivots
+  if first_pt_must_be_pivot or all_pts_must_be_pivots:
+    start_points = pivots_sorted
+  else:
+    start_points = range(0, num_candles)
+
+  for i in start_points:
+    # Skip indeces after opts.scan_from_index
+    if scan_from_index > i:
+      continue
+
+    # If we only specify using pivot points as end, only iterate over pivots after i
+    if last_pt_must_be_pivot or all_pts_must_be_pivots:
+      end_points = pivots_sorted[bisect.bisect_right(pivots_sorted, i):]
+    else:
+      end_points = range(i+1, num_candles)
+
+    # Same for the points checked for touches and breakouts
+    if last_pt_must_be_pivot:
+      check_points = pivots_sorted[bisect.bisect_left(pivots_sorted, i):]
+    else:
+      check_points = range(i, num_candles)
+
+    # Find the slope and intercept formed with every end point at once, and skip the
+    # end points whose line cannot pass the slope and last price limits
+    if len(end_points) == 0:
+      continue
+    if stats is not None:
+      scan_start = time.perf_counter()
+    end_points = np.asarray(end_points)
+    ms, bs, allowed = _prefilter_pairs(
+      i, prices[i], end_points, prices[end_points], avg_candle_range, last_index,
+      min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+    )
+    if stats is not None:
+      _count_pairs(
+        stats, ms, bs, avg_candle_range, last_index,
+        min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+      )
+
+    # Lines of this start point, yielded once it is done so that the time spent by the
+    # consumer is not counted as scan time
+    lines = []
+    for j, m, b in zip(end_points[allowed].tolist(), ms[allowed], bs[allowed]):
+      # Determine breakouts + collect the points within this trendline
+      if stats is not None:
+        touch_start = time.perf_counter()
+      touches = []
+      breakout_index = None
+
+      for k in check_points:
+        # Skip checking for the i or j case because these are already points in the set
+        if k == i or k == j:
+          continue
+
+        trend_price_at_k = prices[i] + m * (k - i)
+
+        # Determine if this trend is a breakout, if it hasn't been identified as one already
+        if breakout_index is None:
+          if trend_type == structs.TrendlineTypes.RESISTANCE:
+            excess = prices[k] - trend_price_at_k
+          elif trend_type == structs.TrendlineTypes.SUPPORT:
+            excess = trend_price_at_k - prices[k]
+          else:
+            excess = -np.inf
+          if excess > breakout_tolerance:
+            breakout_index = k
+            if ignore_breakouts: break
+
+        if abs(trend_price_at_k - prices[k]) < max_allowable_error_pt_to_trend:
+          touches.append(k)
+
+      if stats is not None:
+        stats.timings['touch_counting'] += time.perf_counter() - touch_start
+        stats.counters['breakouts'] += breakout_index is not None and (ignore_breakouts or 2 + len(touches) >= min_points_required)
+
+      if breakout_index is not None and ignore_breakouts: continue
+
+      # Check if we have the minimum required number of points for trend
+      if 2 + len(touches) < min_points_required: continue
+
+      lines.append((i, j, m, b, touches, breakout_index))
+
+    if stats is not None:
+      stats.timings['scan'] += time.perf_counter() - scan_start
+      stats.counters['candidates'] += len(lines)
+    yield from lines
+
+def _trend_prices(candlestick_data, trend_type):
+  return candlestick_data.lows() if trend_type == structs.TrendlineTypes.SUPPORT else candlestick_data.highs()
+
+def _find_global_max_or_mins(pseries, trend_type, avg_candle_range):
+  # Threshold to decide max difference from a global max/min and consecutive best next global max/min to both be considered
+  max_or_min_capture_thres = avg_candle_range * 0.10
+  if trend_type == structs.TrendlineTypes.RESISTANCE:
+    return util.find_maxs_or_mins_in_series(pseries, "max", max_or_min_capture_thres)
+  else:
+    return util.find_maxs_or_mins_in_series(pseries, "min", max_or_min_capture_thres)
+
+def _collect_trendlines(
+  candlestick_data,
+  tt,
+  prices,
+  candidates,
+  global_max_or_mins,
+  resolved_config,
+  ignore_breakouts,
+  trendline_must_include_global_maxmin_pt,
+  stats=None,
+  compact=False,
+):
+  '''
+  Applies the de-duplication, breakout and global max/min rules to the candidate lines
+  yielded by a scan, scores the ones that are kept, and returns them as column buffers.
+  prices is indexed by candle index and candidates are expected in (i, j) order. Date
+  columns are filled in for the kept lines only, once the loop is done.
+
+  With compact set, only the COMPACT_COLUMNS buffers are collected, and the points of the
+  kept lines go straight into the flat point_indices buffer delimited by point_offsets.
+  No ids, dates or per line point lists are built
+  '''
+  last_index = len(candlestick_data.df) - 1
+  if compact:
+    trend_columns = {name: [] for name, _ in COMPACT_COLUMNS}
+    trend_columns['point_offsets'] = [0]
+    trend_columns['point_indices'] = []
+    column_names = [name for name, _ in COMPACT_COLUMNS if name not in COMPACT_MARK_COLUMNS]
+  else:
+    trend_columns = {name: [] for name, _ in TRENDS_DF_SCHEMA}
+    column_names = TRENDS_DF_COLUMNS
+  columns = [trend_columns[name] for name in column_names]
+  global_points = set(global_max_or_mins)
+
+  # Sorted pointsets of the lines accepted so far, used to skip a pointset found again through another i,j pair
+  seen_pointsets = set()
+
+  for i, j, m, b, touches, breakout_index in candidates:
+    if stats is not None:
+      dedup_start = time.perf_counter()
+
+    num_points = 2 + len(touches)
+    # Touches are found in increasing order after i, so only j has to be put in place
+    points_in_trendline = [i] + touches
+    bisect.insort(points_in_trendline, j, 1)
+
+    # We already have this pointset, just different order
+    pointset_key = tuple(points_in_trendline)
+    is_seen = pointset_key in seen_pointsets
+
+    if stats is not None:
+      stats.timings['dedup'] += time.perf_counter() - dedup_start
+      stats.counters['pointset_duplicates'] += is_seen
+
+    if is_seen: continue
+
+    # We ignore this i,j pair if this is a breakout
+    is_breakout = breakout_index is not None
+    if is_breakout and ignore_breakouts: continue
+
+    # Determine if trendline has max or min, and skip this line if we require our lines have global max or min
+    global_pt_found = not global_points.isdisjoint(points_in_trendline)
+
+    if trendline_must_include_global_maxmin_pt and not global_pt_found:
+      continue
+
+    if stats is not None:
+      scoring_start = time.perf_counter()
+
+    slope = m * resolved_config.avg_candle_range
+    trend_price_at_last = m * last_index + b
+    prices_in_trendline = [m * pt + b for pt in [i, j] + touches]
+
+    # Scoring
+    err_distances = []
+    for w in range(0,num_points):
+      point_index = points_in_trendline[w]
+      price_at_trendline = prices_in_trendline[w]
+      price_actual = prices[point_index]
+      err_distances.append(abs(price_at_trendline - price_actual))
+
+    score = resolved_config.score(err_distances, num_points, slope)
+
+    if stats is not None:
+      stats.timings['scoring'] += time.perf_counter() - scoring_start
+
+    seen_pointsets.add(pointset_key)
+
+    if compact:
+      trend_columns['point_indices'].extend(points_in_trendline)
+      trend_columns['point_offsets'].append(len(trend_columns['point_indices']))
+      values = [
+        i,
+        points_in_trendline[-1],
+        is_breakout,
+        -1 if breakout_index is None else breakout_index,
+        num_points,
+        m,
+        b,
+        slope,
+        trend_price_at_last,
+        score,
+        global_pt_found,
+        trend_price_at_last + m,
+      ]
+    else:
+      # Construct a "pointset_id" a unique identifier for this set of points
+      pointset_id = ("R" if tt == structs.TrendlineTypes.RESISTANCE else "S") + "-[" + ",".join(str(p) for p in points_in_trendline) + "]"
+      values = [
+        pointset_id,
+        tt,
+        points_in_trendline,
+        None,
+        points_in_trendline[0],
+        None,
+        points_in_trendline[-1],
+        None,
+        is_breakout,
+        breakout_index,
+        None,
+        num_points,
+        m,
+        b,
+        slope,
+        trend_price_at_last,
+        score,
+        global_pt_found,
+        global_max_or_mins,
+        trend_price_at_last + m,
+        None,
+        False,
+        None,
+        0,
+      ]
+
+    for column, value in zip(columns, values):
+      column.append(value)
+
+  if not compact:
+    _fill_trendline_dates(trend_columns, candlestick_data)
+
+  return trend_columns
+
+def _finalize_trendlines(trend_columns, candlestick_data, tt, resolved_config, stats=None):
+  trends_df = _build_trends_df(trend_columns)
+
+  # Mark which of the trendlines are duplicate
+  marking_start = time.perf_counter()
+  trends_df = _mark_duplicates(trends_df, candlestick_data, tt, resolved_config)
+  if stats is not None:
+    stats.timings['duplicate_marking'] = time.perf_counter() - marking_start
+    stats.counters['trendlines'] = len(trends_df)
+    stats.counters['duplicates'] = int((trends_df['is_best_from_duplicate_group'] != True).sum())
+  trends_df = trends_df.sort_values(by='score', ascending=False)
+
+  # Correct data types
+  trends_df["is_breakout"] = trends_df["is_breakout"].astype(bool)
+
+  return trends_df
+
+def _finalize_compact_trendlines(trend_columns, candlestick_data, tt, resolved_config, global_max_or_mins, stats=None):
+  '''
+  Builds the CompactTrendlines for the lines collected by _collect_trendlines(..., compact=True).
+  Duplicates are marked on a frame of the columns _mark_duplicates reads, and rows are put
+  in the order _finalize_trendlines sorts them in, so that to_dataframe() returns the same
+  dataframe
+  '''
+  num_rows = len(trend_columns['score'])
+  marks_df = pd.DataFrame({
+    'slope': np.array(trend_columns['slope'], dtype=float),
+    'price_at_last_date': np.array(trend_columns['price_at_last_date'], dtype=float),
+    'is_breakout': np.array(trend_columns['is_breakout'], dtype=bool),
+    'score': np.array(trend_columns['score'], dtype=float),
+    'duplicate_group_id': pd.Series([None] * num_rows, dtype=object),
+    'is_best_from_duplicate_group': np.zeros(num_rows, dtype=bool),
+    'overall_rank': pd.Series([None] * num_rows, dtype=object),
+    'rank_within_group': np.zeros(num_rows, dtype=np.int64),
+  })
+
+  marking_start = time.perf_counter()
+  marks_df = _mark_duplicates(marks_df, candlestick_data, tt, resolved_config)
+  if stats is not None:
+    stats.timings['duplicate_marking'] = time.perf_counter() - marking_start
+
+  order = marks_df.sort_values(by='score', ascending=False).index.to_numpy()
+
+  columns = {}
+  for name, dtype in COMPACT_COLUMNS:
+    if name in COMPACT_MARK_COLUMNS:
+      values = marks_df[name].to_numpy()
+      if name == 'overall_rank':
+        values = np.where(pd.isna(values), 0, values)
+    else:
+      values = trend_columns[name]
+    columns[name] = np.array(values, dtype=dtype)[order] if num_rows else np.array([], dtype=dtype)
+
+  # Move the points of every row to its sorted position, in one gather
+  point_offsets = np.array(trend_columns['point_offsets'], dtype=np.int64)
+  num_row_points = np.diff(point_offsets)[order]
+  sorted_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+  np.cumsum(num_row_points, out=sorted_offsets[1:])
+  gather = np.arange(sorted_offsets[-1]) + np.repeat(point_offsets[:-1][order] - sorted_offsets[:-1], num_row_points)
+  point_indices = np.array(trend_columns['point_indices'], dtype=np.int32)[gather]
+
+  if stats is not None:
+    stats.counters['trendlines'] = num_rows
+    stats.counters['duplicates'] = int(num_rows - columns['is_best_from_duplicate_group'].sum())
+
+  return CompactTrendlines(
+    trend_type=tt,
+    columns=columns,
+    point_offsets=sorted_offsets,
+    point_indices=point_indices,
+    global_max_or_mins=np.array(global_max_or_mins, dtype=np.int32),
+    index=order.astype(np.int32),
+    candlestick_data=candlestick_data,
+  )
+
+# Number of (j, k) cells evaluated at once by the numpy engine. Bounds the memory
+# used by the per-block trend/error matrices independently of the candle count
+NUMPY_SCAN_BLOCK_SIZE = 1 << 18
+
+def _prefilter_pairs(
+  i,
+  iprice,
+  js,
+  jprices,
+  avg_candle_range,
+  last_index,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+):
+  '''
+  Slopes and intercepts of the lines from (i, iprice) to every (js, jprices), and which
+  of them pass the slope and last price limits, for a whole array of end points at once.
+  Every engine, and the streaming detector, compares the lines given by util.line_through
+  against the thresholds with these same exact comparisons, so they all agree on ties.
+  Their price at candle k is evaluated as iprice + m * (k - i), which stays the same when
+  a sliding window renumbers the candles
+  '''
+  ms, bs = util.line_through(i, iprice, js, jprices)
+  slopes = ms * avg_candle_range
+  trend_prices_at_last = ms * last_index + bs
+  allowed = (slopes <= max_allowable_slope) & (slopes >= min_allowable_slope) & \
+    (trend_prices_at_last <= max_allowable_last_price) & (trend_prices_at_last >= min_allowable_last_price)
+  return ms, bs, allowed
+
+def _count_pairs(
+  stats,
+  ms,
+  bs,
+  avg_candle_range,
+  last_index,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+):
+  # Counts the pairs of a start point that fail the exact slope and last price checks of the scans
+  slopes = ms * avg_candle_range
+  trend_prices_at_last = ms * last_index + bs
+  bad_slope = (slopes > max_allowable_slope) | (slopes < min_allowable_slope)
+  bad_price = (trend_prices_at_last > max_allowable_last_price) | (trend_prices_at_last < min_allowable_last_price)
+
+  stats.counters['pairs_tested'] += len(ms)
+  stats.counters['pairs_pruned_slope'] += int(bad_slope.sum())
+  stats.counters['pairs_pruned_price'] += int((bad_price & ~bad_slope).sum())
+
+def _finish_stats(stats, is_compiled_scan, ignore_breakouts):
+  # Every tested pair is either pruned, short of points or a candidate, or was dropped at its
+  # breakout when ignoring breakouts
+  stats.counters['pairs_rejected_min_points'] = stats.counters['pairs_tested'] - stats.counters['pairs_pruned_slope'] - \
+    stats.counters['pairs_pruned_price'] - stats.counters['candidates'] - (stats.counters['breakouts'] if ignore_breakouts else 0)
+
+  if is_compiled_scan:
+    stats.timings['pair_enumeration'] = None
+    stats.timings['touch_counting'] = None
+  else:
+    stats.timings['pair_enumeration'] = stats.timings['scan'] - stats.timings['touch_counting']
+
+def _kernel_trend_code(trend_type):
+  if trend_type == structs.TrendlineTypes.SUPPORT:
+    return kernels.SUPPORT_CODE
+  elif trend_type == structs.TrendlineTypes.RESISTANCE:
+    return kernels.RESISTANCE_CODE
+  return kernels.OTHER_CODE
+
+def _scan_numba(
+  prices,
+  num_candles,
+  scan_from_index,
+  pivots,
+  trend_type,
+  max_allowable_error_pt_to_trend,
+  breakout_tolerance,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+  avg_candle_range,
+  last_index,
+  min_points_required,
+  first_pt_must_be_pivot,
+  last_pt_must_be_pivot,
+  all_pts_must_be_pivots,
+  ignore_breakouts,
+  stats=None,
+):
+  '''
+  Runs the compiled scan in kernels.scan and yields its lines like the python engine.
+  Breakout lines are dropped inside the kernel when ignore_breakouts is set, as
+  _collect_trendlines would discard them anyway
+  '''
+  scan_start = time.perf_counter()
+  i, j, m, b, breakout, touch_offsets, touches, counts = kernels.scan(
+    prices, np.array(sorted(pivots), dtype=np.int64), scan_from_index, num_candles, last_index,
+    _kernel_trend_code(trend_type),
+    float(max_allowable_error_pt_to_trend), float(breakout_tolerance),
+    float(min_allowable_slope), float(max_allowable_slope),
+    float(min_allowable_last_price), float(max_allowable_last_price),
+    float(avg_candle_range), min_points_required,
+    first_pt_must_be_pivot, last_pt_must_be_pivot, all_pts_must_be_pivots, ignore_breakouts,
+  )
+
+  if stats is not None:
+    stats.timings['scan'] += time.perf_counter() - scan_start
+    for name, count in zip(['pairs_tested', 'pairs_pruned_slope', 'pairs_pruned_price', 'candidates', 'breakouts'], counts.tolist()):
+      stats.counters[name] += count
+
+  for r in range(len(i)):
+    breakout_index = int(breakout[r]) if breakout[r] >= 0 else None
+    yield int(i[r]), int(j[r]), m[r], b[r], touches[touch_offsets[r]:touch_offsets[r + 1]].tolist(), breakout_index
+
+def _scan_numpy(
+  prices,
+  first_index,
+  pivots,
+  trend_type,
+  max_allowable_error_pt_to_trend,
+  breakout_tolerance,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+  avg_candle_range,
+  last_index,
+  min_points_required,
+  first_pt_must_be_pivot,
+  last_pt_must_be_pivot,
+  all_pts_must_be_pivots,
+  ignore_breakouts=False,
+  stats=None,
+):
+  '''
+  Array version of the i/j/k scan in detect. For every start point i, the lines
+  through all end points j are fitted and checked against the limits at once, and
+  touches and breakouts are found for a block of j rows against every k column with
+  array comparisons. The first breakout of a row is the argmax of the block's breaking
+  matrix.
+
+  Yields (i, j, m, b, touches, breakout_index) in the same order as the python
+  engine so that pointset de-duplication keeps the same rows. Like _scan_numba, lines
+  that break out are dropped and no breakout index is searched for when ignore_breakouts
+  is set. Their rows are dropped before touches are counted
+  '''
+  n = len(prices)
+  indeces = np.arange(first_index, first_index + n)
+  is_pivot = np.zeros(n, dtype=bool)
+  is_pivot[np.array(sorted(pivots), dtype=int) - first_index] = True
+  pivot_pos = np.flatnonzero(is_pivot)
+
+  def breaking_cells(trend_prices, k_prices, checked):
+    # Cells of a block where the candle breaks through the line
+    if trend_type == structs.TrendlineTypes.RESISTANCE:
+      excess = k_prices[None, :] - trend_prices
+    elif trend_type == structs.TrendlineTypes.SUPPORT:
+      excess = trend_prices - k_prices[None, :]
+    else:
+      return np.zeros(trend_prices.shape, dtype=bool)
+    return (excess > breakout_tolerance) & checked
+
+  # In pivot-only modes the start, end and checked positions are taken straight from pivot_pos
+  start_positions = pivot_pos if first_pt_must_be_pivot or all_pts_must_be_pivots else range(n)
+
+  for a in start_positions:
+    a = int(a)
+    i = int(indeces[a])
+
+    if last_pt_must_be_pivot:
+      k_pos = pivot_pos[np.searchsorted(pivot_pos, a):]
+    else:
+      k_pos = np.arange(a, n)
+
+    if last_pt_must_be_pivot or all_pts_must_be_pivots:
+      j_pos = pivot_pos[np.searchsorted(pivot_pos, a, side='right'):]
+    else:
+      j_pos = np.arange(a + 1, n)
+    if len(j_pos) == 0:
+      continue
+
+    scan_start = time.perf_counter()
+    js = indeces[j_pos]
+    ms, bs, allowed = _prefilter_pairs(
+      i, prices[a], js, prices[j_pos], avg_candle_range, last_index,
+      min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+    )
+    if stats is not None:
+      _count_pairs(
+        stats, ms, bs, avg_candle_range, last_index,
+        min_allowable_slope, max_allowable_slope, min_allowable_last_price, max_allowable_last_price,
+      )
+    js, ms, bs = js[allowed], ms[allowed], bs[allowed]
+
+    ks = indeces[k_pos]
+    k_prices = prices[k_pos]
+    not_i = ks != i
+
+    rows_per_block = max(1, NUMPY_SCAN_BLOCK_SIZE // max(len(ks), 1))
+    for start in range(0, len(js), rows_per_block):
+      touch_start = time.perf_counter()
+      rows = np.arange(start, min(start + rows_per_block, len(js)))
+
+      trend_prices = prices[a] + ms[rows, None] * (ks - i)[None, :]
+      checked = not_i[None, :] & (ks[None, :] != js[rows, None])
+
+      # Rows that break out are dropped first when ignoring breakouts, as
+      # _collect_trendlines would discard them anyway
+      if ignore_breakouts:
+        has_breakout = breaking_cells(trend_prices, k_prices, checked).any(axis=1)
+        if stats is not None:
+          stats.counters['breakouts'] += int(has_breakout.sum())
+        rows = rows[~has_breakout]
+        trend_prices, checked = trend_prices[~has_breakout], checked[~has_breakout]
+
+      touching = (np.abs(trend_prices - k_prices[None, :]) < max_allowable_error_pt_to_trend) & checked
+
+      # Rows with enough points
+      enough = touching.sum(axis=1) + 2 >= min_points_required
+      rows, trend_prices, checked, touching = rows[enough], trend_prices[enough], checked[enough], touching[enough]
+
+      # First breakout of every row, the column of its first breaking candle
+      if not ignore_breakouts:
+        breaking = breaking_cells(trend_prices, k_prices, checked)
+        has_breakout = breaking.any(axis=1)
+        breakout_indeces = np.where(has_breakout, ks[breaking.argmax(axis=1)], -1).tolist()
+        if stats is not None:
+          stats.counters['breakouts'] += int(has_breakout.sum())
+
+      # Touches of the rows, split per row
+      touch_rows, touch_cols = np.nonzero(touching)
+      touch_ends = np.searchsorted(touch_rows, np.arange(1, len(rows) + 1)).tolist()
+      touch_ks = ks[touch_cols].tolist()
+
+      # Lines of this block, yielded once the block is done so that the time spent by the
+      # consumer is not counted as scan time
+      lines = []
+      touch_from = 0
+      for n_row, row in enumerate(rows.tolist()):
+        touch_to = touch_ends[n_row]
+        breakout_index = None if ignore_breakouts or breakout_indeces[n_row] < 0 else breakout_indeces[n_row]
+        lines.append((i, int(js[row]), ms[row], bs[row], touch_ks[touch_from:touch_to], breakout_index))
+        touch_from = touch_to
+
+      if stats is not None:
+        stats.timings['touch_counting'] += time.perf_counter() - touch_start
+        stats.timings['scan'] += time.perf_counter() - scan_start
+        stats.counters['candidates'] += len(lines)
+      yield from lines
+      scan_start = time.perf_counter()
+
+    if stats is not None:
+      stats.timings['scan'] += time.perf_counter() - scan_start
+
+# Relative padding of the duplicate grouping grid cells, so that float rounding in the cell
+# computation can never put two matching trendlines more than one cell apart
+DUPLICATE_GRID_SLACK = 1e-9
+
+# Relative tolerance of the duplicate grouping thresholds. Lines exactly a threshold apart,
+# as lines through prices on a tick grid often are, are found a little under or over it
+# depending on float rounding, so differences within the tolerance count as matching
+DUPLICATE_TIE_SLACK = 1e-9
+
+def _first_duplicate_matches(slopes, prices, is_breakout, slope_thres, price_thres):
+  '''
+  For every trendline, finds the first other trendline in row order with the same is_breakout
+  whose slope and price are within slope_thres and price_thres (up to DUPLICATE_TIE_SLACK),
+  or -1 if there is none. Trendlines are bucketed into a (slope, price) grid with cells the size of the thresholds,
+  so only the 3x3 cells around a trendline need to be compared against
+  '''
+  first_matches = np.full(len(slopes), -1, dtype=np.int64)
+  if not (slope_thres > 0 and price_thres > 0):
+    return first_matches
+
+  slope_thres = slope_thres * (1 + DUPLICATE_TIE_SLACK)
+  price_thres = price_thres * (1 + DUPLICATE_TIE_SLACK)
+
+  # Non finite slopes or prices never compare as close to anything
+  valid = np.isfinite(slopes) & np.isfinite(prices)
+  slope_cells = np.floor(slopes / (slope_thres * (1 + DUPLICATE_GRID_SLACK)))
+  price_cells = np.floor(prices / (price_thres * (1 + DUPLICATE_GRID_SLACK)))
+
+  cells = {}
+  for idx in np.flatnonzero(valid):
+    cells.setdefault((slope_cells[idx], price_cells[idx], is_breakout[idx]), []).append(idx)
+
+  for (slope_cell, price_cell, breakout), members in cells.items():
+    neighbours = []
+    for slope_offset in (-1, 0, 1):
+      for price_offset in (-1, 0, 1):
+        neighbours.extend(cells.get((slope_cell + slope_offset, price_cell + price_offset, breakout), []))
+    neighbours = np.sort(np.array(neighbours, dtype=np.int64))
+    members = np.array(members, dtype=np.int64)
+
+    # Compare members against their neighbours a block at a time to bound memory
+    block_size = max(1, NUMPY_SCAN_BLOCK_SIZE // len(neighbours))
+    for start in range(0, len(members), block_size):
+      block = members[start:start + block_size]
+      matches = (np.abs(prices[block][:, None] - prices[neighbours][None, :]) < price_thres) & \
+        (np.abs(slopes[block][:, None] - slopes[neighbours][None, :]) < slope_thres) & \
+        (block[:, None] != neighbours[None, :])
+      has_match = matches.any(axis=1)
+      first_matches[block[has_match]] = neighbours[matches[has_match].argmax(axis=1)]
+
+  return first_matches
 
 def _mark_duplicates(trends_df, candlestick_data, trend_type, config):
-  duplicate_grouping_threshold_last_price = config.get("duplicate_grouping_threshold_last_price", DEFAULT_CONFIG['duplicate_grouping_threshold_last_price'])(candlestick_data)
-  duplicate_grouping_threshold_slope = config.get("duplicate_grouping_threshold_slope", DEFAULT_CONFIG['duplicate_grouping_threshold_slope'])(candlestick_data)
+  config = resolve_config(candlestick_data, config)
+  duplicate_grouping_threshold_last_price = config.duplicate_grouping_threshold_last_price
+  duplicate_grouping_threshold_slope = config.duplicate_grouping_threshold_slope
   
   if len(trends_df) == 0: return trends_df
 
@@ -426,80 +1156,76 @@ def _mark_duplicates(trends_df, candlestick_data, trend_type, config):
 
   group_idx = 1000 if trend_type == structs.TrendlineTypes.RESISTANCE else 2000
 
-  # 2D clustering last price and slope to find closely related trendlines
-  for i in range(0, len(trends_df)):
-    best_matching_idx = -1
-    row_i = trends_df.iloc[i]
-    row_last_price = row_i['price_at_last_date']
-    row_slope_angle = row_i['slope']
-    i_is_breakout = row_i['is_breakout']
-
-    for j in range(0, len(trends_df)):
-      if i==j: continue
-
-      row_j = trends_df.iloc[j]
-      sec_row_last_price = row_j['price_at_last_date']
-      sec_row_slope_angle = row_j['slope']
-      j_is_breakout = row_j['is_breakout']
-
-      price_diff = abs(row_last_price - sec_row_last_price)
-      slope_angle_diff = abs(row_slope_angle - sec_row_slope_angle)
-
-      # We determine that row i and row j are a good match for same group
-      if ((price_diff < duplicate_grouping_threshold_last_price) and (slope_angle_diff < duplicate_grouping_threshold_slope)) \
-          and (i_is_breakout == j_is_breakout):
-        best_matching_idx = j
-        break
-
-    if(best_matching_idx != -1):
-      this_row = row_i
-      best_matching_row = trends_df.iloc[best_matching_idx]
-
-      this_row_group = this_row['duplicate_group_id']
-      best_matching_row_group = best_matching_row['duplicate_group_id']
-
-      group_id_for_pair = best_matching_row_group if best_matching_row_group is not None else group_idx
-
-      if best_matching_row_group == None:
-        trends_df.loc[best_matching_row.name, 'duplicate_group_id'] = group_id_for_pair
-
-      if this_row_group == None:
-        trends_df.loc[this_row.name, 'duplicate_group_id'] = group_id_for_pair
-      else:
-        for k in range(0, len(trends_df)):
-          row_k = trends_df.iloc[k]
-          if row_k['duplicate_group_id'] == this_row_group:
-            trends_df.loc[row_k.name, 'duplicate_group_id'] = group_id_for_pair
+  # 2D clustering last price and slope to find closely related trendlines. Every trendline
+  # is paired with the first other trendline (in row order) close enough to it, and the
+  # pairs are merged with union-find. A merged group keeps the id of the group it joins,
+  # or takes the id of the current row if the matching trendline has no group yet
+  first_matches = _first_duplicate_matches(
+    trends_df['slope'].to_numpy(dtype=float),
+    trends_df['price_at_last_date'].to_numpy(dtype=float),
+    trends_df['is_breakout'].to_numpy(dtype=bool),
+    duplicate_grouping_threshold_slope,
+    duplicate_grouping_threshold_last_price,
+  )
+
+  parents = list(range(len(trends_df)))
+  group_ids = [None] * len(trends_df)
+
+  def find(x):
+    while parents[x] != x:
+      parents[x] = parents[parents[x]]
+      x = parents[x]
+    return x
 
+  for i in range(0, len(trends_df)):
+    j = first_matches[i]
+    if j == -1:
+      group_ids[i] = group_idx
     else:
-      trends_df.loc[row_i.name, 'duplicate_group_id'] = group_idx
+      root_i, root_j = find(i), find(j)
+      group_id_for_pair = group_ids[root_j] if group_ids[root_j] is not None else group_idx
+      parents[root_i] = root_j
+      group_ids[root_j] = group_id_for_pair
     group_idx += 1
-  
-  # For all the duplicate groups found, mark best for each group
-  if(len(trends_df) == 1):
-    trends_df.loc[ trends_df.iloc[0].name , 'is_best_from_duplicate_group'] = True
-    trends_df.loc[ trends_df.iloc[0].name , 'overall_rank'] = 1
-    trends_df.loc[ trends_df.iloc[0].name, 'rank_within_group'] = 1
-    return
-
-  best_results = trends_df.sort_values(by='score', ascending=True).groupby(["duplicate_group_id"]).last().reset_index()
-  overall_rank = 1
-
-  for i in range(0, len(best_results)):
-    row = best_results.iloc[i]
-    trends_df.loc[ trends_df['id'] == row['id'] , 'is_best_from_duplicate_group'] = True
-    trends_df.loc[ trends_df['id'] == row['id'] , 'overall_rank'] = overall_rank
-    overall_rank += 1
-
-  # Mark rank within each group
-  dup_groups = trends_df.groupby(["duplicate_group_id"])
-  for group_name, df_group in dup_groups:
-    group_rank = 1
-
-    df_group_sorted = df_group.sort_values(by='score', ascending=False)
-
-    for row_index, row in df_group_sorted.iterrows():
-      trends_df.loc[row_index, 'rank_within_group'] = int(group_rank)
-      group_rank += 1
-
-  return trends_df
\ No newline at end of file
+
+  trends_df['duplicate_group_id'] = pd.Series([group_ids[find(i)] for i in range(len(trends_df))], index=trends_df.index, dtype=object)
+
+  # For all the duplicate groups found, mark best for each group. Overall rank follows the
+  # order of the duplicate group ids
+  best_results = trends_df.sort_values(by='score', ascending=True).drop_duplicates(subset='duplicate_group_id', keep='last')
+  best_results = best_results.sort_values(by='duplicate_group_id', kind='stable')
+
+  overall_rank = np.full(len(trends_df), None, dtype=object)
+  overall_rank[trends_df.index.get_indexer(best_results.index)] = list(range(1, len(best_results) + 1))
+  trends_df['overall_rank'] = overall_rank
+  trends_df.loc[best_results.index, 'is_best_from_duplicate_group'] = True
+
+  # Mark rank within each group, in the order the original per group
+  # sort_values(by='score', ascending=False) gave. That sort is a quicksort, which does not
+  # keep the row order of ties in groups of more than 16 trendlines, so each group is
+  # ordered like pandas orders it (see _descending_order) rather than ranked in one pass
+  group_codes = pd.factorize(trends_df['duplicate_group_id'])[0]
+  scores = trends_df['score'].to_numpy(dtype=float)
+  rows_by_group = np.argsort(group_codes, kind='stable')
+  group_ends = np.searchsorted(group_codes[rows_by_group], np.arange(1, group_codes.max() + 2))
+
+  rank_within_group = np.empty(len(trends_df), dtype=np.int64)
+  group_start = 0
+  for group_end in group_ends.tolist():
+    rows = rows_by_group[group_start:group_end]
+    rank_within_group[rows[_descending_order(scores[rows])]] = np.arange(1, len(rows) + 1)
+    group_start = group_end
+  trends_df['rank_within_group'] = rank_within_group
+
+  return trends_df
+
+def _descending_order(scores):
+  '''
+  Positions of scores from highest to lowest, NaN scores last, in the order of pandas'
+  sort_values(ascending=False): the reversed scores are argsorted with quicksort and the
+  result is reversed again
+  '''
+  is_nan = np.isnan(scores)
+  positions = np.flatnonzero(~is_nan)[::-1]
+  order = positions[scores[positions].argsort(kind='quicksort')][::-1]
+  return np.concatenate([order, np.flatnonzero(is_nan)])
\ No newline at end of file
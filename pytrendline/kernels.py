@@ -0,0 +1,270 @@
+'''
+Optional Numba compiled kernels for pivot detection, the candidate line scan and the pair
+scans of the streaming detector. They only take plain numpy arrays and scalars so that they
+can be compiled in nopython mode, and are cached on disk (numba's cache=True) so that only
+the first run on a machine pays for the compilation. When numba is not installed HAS_NUMBA
+is False and detect, like the streaming detector, falls back to numpy.
+'''
+import numpy as np
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+HAS_NUMBA = numba is not None
+
+# Trend type codes passed to the kernels
+SUPPORT_CODE = 0
+RESISTANCE_CODE = 1
+OTHER_CODE = 2
+
+def _njit(func):
+  return numba.njit(cache=True, nogil=True)(func) if HAS_NUMBA else func
+
+@_njit
+def pivot_mask(prices, trend_code, separation_thres, grouping_thres, scan_from_index):
+  # Same rules as detect._pivot_mask, one point at a time
+  max_number_continuous_pivots = 6
+
+  n = len(prices)
+  is_pivot = np.zeros(n, dtype=np.bool_)
+  is_pivot[0] = True
+  is_pivot[n - 1] = True
+
+  for a in range(1, n - 1):
+    pcur = prices[a]
+
+    j = 1
+    while j < max_number_continuous_pivots and (a + scan_from_index + j) < n - 1:
+      if abs(prices[a + j - 1] - prices[a + j]) < grouping_thres:
+        j += 1
+      else:
+        break
+    pnext = prices[a + j]
+
+    j = 1
+    while j < max_number_continuous_pivots and (a - j) > 0:
+      if abs(prices[a - j + 1] - prices[a - j]) < grouping_thres:
+        j += 1
+      else:
+        break
+    pprev = prices[a - j]
+
+    if trend_code == RESISTANCE_CODE and (pprev > pcur or pnext > pcur):
+      continue
+    elif trend_code == SUPPORT_CODE and (pprev < pcur or pnext < pcur):
+      continue
+
+    prev_gap = abs(pcur - pprev)
+    next_gap = abs(pcur - pnext)
+    if (prev_gap > separation_thres * (1/4) and next_gap > separation_thres * (3/4)) or \
+        (prev_gap > separation_thres * (3/4) and next_gap > separation_thres * (1/4)):
+      is_pivot[a] = True
+
+  return is_pivot
+
+@_njit
+def scan(
+  prices,
+  pivot_positions,
+  scan_from_index,
+  num_candles,
+  last_index,
+  trend_code,
+  max_allowable_error_pt_to_trend,
+  breakout_tolerance,
+  min_allowable_slope,
+  max_allowable_slope,
+  min_allowable_last_price,
+  max_allowable_last_price,
+  avg_candle_range,
+  min_points_required,
+  first_pt_must_be_pivot,
+  last_pt_must_be_pivot,
+  all_pts_must_be_pivots,
+  skip_breakouts,
+):
+  '''
+  The i/j/k scan of detect's python engine over candle positions. Returns the accepted
+  (i, j) pairs in scan order as arrays of i, j, m, b and breakout index (-1 when none),
+  plus their touches in CSR form: the touches of pair r are
+  touches[touch_offsets[r]:touch_offsets[r + 1]]. When skip_breakouts is set, lines that
+  break out are dropped as soon as the breakout is found. Lines and comparisons are the
+  same as in detect's python and numpy engines (see detect._prefilter_pairs).
+
+  Also returns counts, the number of pairs tested, pruned by slope and pruned by last price,
+  of lines returned and of breakouts. Breakouts are the returned lines that break out, or
+  with skip_breakouts, the pairs dropped at their breakout
+  '''
+  is_resistance = trend_code == RESISTANCE_CODE
+  num_pivots = 0
+  while num_pivots < len(pivot_positions) and pivot_positions[num_pivots] < num_candles:
+    num_pivots += 1
+
+  out_i = []
+  out_j = []
+  out_m = []
+  out_b = []
+  out_breakout = []
+  out_touches = []
+  touch_offsets = [0]
+  touches = np.empty(num_candles, dtype=np.int64)
+  counts = np.zeros(5, dtype=np.int64)
+
+  num_starts = num_pivots if (first_pt_must_be_pivot or all_pts_must_be_pivots) else num_candles
+  # Index of the first pivot >= i, advanced as i grows
+  pivot_from = 0
+
+  for s in range(num_starts):
+    i = pivot_positions[s] if (first_pt_must_be_pivot or all_pts_must_be_pivots) else s
+    if scan_from_index > i:
+      continue
+
+    while pivot_from < num_pivots and pivot_positions[pivot_from] < i:
+      pivot_from += 1
+    pivot_after = pivot_from
+    if pivot_after < num_pivots and pivot_positions[pivot_after] == i:
+      pivot_after += 1
+
+    if last_pt_must_be_pivot or all_pts_must_be_pivots:
+      num_ends = num_pivots - pivot_after
+    else:
+      num_ends = num_candles - 1 - i
+    counts[0] += num_ends
+
+    for e in range(num_ends):
+      j = pivot_positions[pivot_after + e] if (last_pt_must_be_pivot or all_pts_must_be_pivots) else i + 1 + e
+
+      # Same formula as util.line_through
+      m = (prices[j] - prices[i]) / (j - i)
+      b = prices[i] - m * i
+
+      slope = m * avg_candle_range
+      trend_price_at_last = m * last_index + b
+      if slope > max_allowable_slope or slope < min_allowable_slope:
+        counts[1] += 1
+        continue
+      if trend_price_at_last > max_allowable_last_price or trend_price_at_last < min_allowable_last_price:
+        counts[2] += 1
+        continue
+
+      num_touches = 0
+      breakout_index = -1
+      num_checks = num_pivots - pivot_from if last_pt_must_be_pivot else num_candles - i
+
+      for c in range(num_checks):
+        k = pivot_positions[pivot_from + c] if last_pt_must_be_pivot else i + c
+        if k == i or k == j:
+          continue
+
+        trend_price_at_k = prices[i] + m * (k - i)
+
+        if breakout_index == -1 and trend_code != OTHER_CODE:
+          excess = prices[k] - trend_price_at_k if is_resistance else trend_price_at_k - prices[k]
+          if excess > breakout_tolerance:
+            breakout_index = k
+            if skip_breakouts:
+              counts[4] += 1
+              break
+
+        if abs(trend_price_at_k - prices[k]) < max_allowable_error_pt_to_trend:
+          touches[num_touches] = k
+          num_touches += 1
+
+      if skip_breakouts and breakout_index != -1:
+        continue
+      if 2 + num_touches < min_points_required:
+        continue
+
+      counts[3] += 1
+      if breakout_index != -1:
+        counts[4] += 1
+      out_i.append(i)
+      out_j.append(j)
+      out_m.append(m)
+      out_b.append(b)
+      out_breakout.append(breakout_index)
+      for t in range(num_touches):
+        out_touches.append(touches[t])
+      touch_offsets.append(len(out_touches))
+
+  return (
+    _to_int_array(out_i), _to_int_array(out_j), _to_float_array(out_m), _to_float_array(out_b),
+    _to_int_array(out_breakout), _to_int_array(touch_offsets), _to_int_array(out_touches), counts,
+  )
+
+@_njit
+def scan_pairs(
+  prices,
+  is_checked,
+  pair_i,
+  pair_j,
+  pair_m,
+  trend_code,
+  max_allowable_error_pt_to_trend,
+  breakout_tolerance,
+  stop_at_breakout,
+):
+  '''
+  Touch counts and first breakouts (-1 when none) of the lines of the given pairs, checked
+  against the candles after i other than j that have is_checked set, for stream._TrendState.
+  Lines are evaluated like in scan. Also returns the threshold ranges these hold for: the
+  largest error of a touch and the smallest error of any other checked candle, and the
+  largest excess before the first breakout and the excess at it.
+
+  With stop_at_breakout, a pair is no longer checked past its first breakout, and its
+  count and touch range only cover the candles up to it
+  '''
+  num_pairs = len(pair_i)
+  n = len(prices)
+  is_resistance = trend_code == RESISTANCE_CODE
+
+  count = np.zeros(num_pairs, dtype=np.int64)
+  breakout = np.full(num_pairs, -1, dtype=np.int64)
+  touch_low = np.full(num_pairs, -np.inf)
+  touch_high = np.full(num_pairs, np.inf)
+  breakout_low = np.full(num_pairs, -np.inf)
+  breakout_high = np.full(num_pairs, np.inf)
+
+  for r in range(num_pairs):
+    i = pair_i[r]
+    j = pair_j[r]
+    m = pair_m[r]
+    for k in range(i + 1, n):
+      if k == j or not is_checked[k]:
+        continue
+
+      trend_price_at_k = prices[i] + m * (k - i)
+      error = abs(trend_price_at_k - prices[k])
+      if error < max_allowable_error_pt_to_trend:
+        count[r] += 1
+        touch_low[r] = max(touch_low[r], error)
+      else:
+        touch_high[r] = min(touch_high[r], error)
+
+      if breakout[r] == -1 and trend_code != OTHER_CODE:
+        excess = prices[k] - trend_price_at_k if is_resistance else trend_price_at_k - prices[k]
+        if excess > breakout_tolerance:
+          breakout[r] = k
+          breakout_high[r] = excess
+          if stop_at_breakout:
+            break
+        else:
+          breakout_low[r] = max(breakout_low[r], excess)
+
+  return count, breakout, touch_low, touch_high, breakout_low, breakout_high
+
+@_njit
+def _to_int_array(values):
+  out = np.empty(len(values), dtype=np.int64)
+  for idx in range(len(values)):
+    out[idx] = values[idx]
+  return out
+
+@_njit
+def _to_float_array(values):
+  out = np.empty(len(values), dtype=np.float64)
+  for idx in range(len(values)):
+    out[idx] = values[idx]
+  return out
@@ -1,19 +1,26 @@
 import os
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
 
-from bokeh.resources import CDN
+import bokeh
+from bokeh.resources import CDN, INLINE, Resources
 from bokeh.models.widgets import Div
 from bokeh.plotting import figure
-from bokeh.models import Label
-from bokeh.embed import file_html
+from bokeh.models import Label, LabelSet, ColumnDataSource, BasicTicker
+from bokeh.embed import components
+from bokeh.embed.bundle import bundle_for_objs_and_resources
+from bokeh.util.paths import bokehjsdir
 
 from datetime import timedelta
 from colour import Color
 
-from math import pi, tan
+from math import pi, tan, ceil
 
 from . import structs
+from . import util
+from .results import with_dataframes
 
 css_hack = '''
 .dataframe {
@@ -72,6 +79,7 @@ class TrendlineFigure():
     self.type = trend_type
 
     self.id = result_row['id']
+    self.pointset_indeces = result_row['pointset_indeces']
     self.pointset_dates = result_row['pointset_dates']
     self.breakout_index = result_row['breakout_index']
     self.is_breakout = result_row['is_breakout']
@@ -79,37 +87,40 @@ class TrendlineFigure():
     self.includes_global_max_or_min = result_row['includes_global_max_or_min']
     self.global_maxs_or_mins = result_row['global_maxs_or_mins']
     self.is_best_from_duplicate_group = result_row['is_best_from_duplicate_group']
+    self.m = result_row.get('m')
+    self.b = result_row.get('b')
     self.plotting_prop_overrides = plotting_prop_overrides
 
-  def plot_figure(self, p, candles_df, opts={}):    
-    pointset_indeces = []
-    for date in self.pointset_dates:
-      pointset_indeces.append( candles_df.loc[candles_df['Date'] == date].index[0] )
+  def get_line_geometry(self, prices, num_candles):
+    '''
+    Points of the trendline (x is the candle index, y its price in prices), the slope and
+    intercept detect found it with, and the index its drawn segment ends at
+    '''
+    pt_set_x = list(self.pointset_indeces)
+    pt_set_y = prices[pt_set_x]
 
-    pt_set_y = []
-    pt_set_x = pointset_indeces
-
-    for pt in pt_set_x:
-      if self.type == structs.TrendlineTypes.RESISTANCE:
-        pt_set_y.append(candles_df.iloc[pt].High)
-      elif self.type == structs.TrendlineTypes.SUPPORT:
-        pt_set_y.append(candles_df.iloc[pt].Low)
-      else:
-        pt_set_y.append(candles_df.iloc[pt].Low)
-
-    # Calculate slope and intersect using first point and last point
-    m, b = np.polyfit([pt_set_x[0], pt_set_x[-1]], [pt_set_y[0], pt_set_y[-1]], 1)
+    m, b = self.m, self.b
+    if m is None or b is None:
+      # Rows without m and b, calculate slope and intersect using first point and last point
+      m, b = util.line_through(pt_set_x[0], pt_set_y[0], pt_set_x[-1], pt_set_y[-1])
 
     if self.is_breakout:
       last_date_index = self.breakout_index + 0.05
-      last_date_trendline_price = m * last_date_index + b
-      p.x([last_date_index], [last_date_trendline_price], line_width=3, size=10, color="red", alpha=0.8)
     else:
-      last_date_index = len(candles_df) - 1
+      last_date_index = num_candles - 1
 
-    tl_vals_at_x = pt_set_y
+    return pt_set_x, pt_set_y, m, b, last_date_index
+
+  def plot_figure(self, p, candles_df, opts={}):
+    # Draws this trendline alone, see _plot_trendlines for drawing many at once
+    col = "High" if self.type == structs.TrendlineTypes.RESISTANCE else "Low"
+    prices = candles_df[col].to_numpy()
+    pt_set_x, tl_vals_at_x, m, b, last_date_index = self.get_line_geometry(prices, len(candles_df))
     tl_y_at_last_date = m * last_date_index + b
 
+    if self.is_breakout:
+      p.x([last_date_index], [tl_y_at_last_date], line_width=3, size=10, color="red", alpha=0.8)
+
     color = self.get_trendline_plot_color()
 
     p.segment(
@@ -124,14 +135,8 @@ class TrendlineFigure():
 
     # Draw plot score label
     if self.is_best_from_duplicate_group:
-      label_text =  "Score " + str(self.id) + " = " + str(round(self.score, 2))
-      if self.is_breakout: label_text += " (breakout at {})".format(self.breakout_index)
-      
-      label_x_pos = last_date_index + 2
-      label_y_pos = tl_y_at_last_date + (2 * m)
-
-      label = Label(x=label_x_pos, y=label_y_pos,
-                 text=label_text,
+      label = Label(x=last_date_index + 2, y=tl_y_at_last_date + (2 * m),
+                 text=self.get_label_text(),
                  border_line_color=color, border_line_alpha=0.8,
                  background_fill_color='white', background_fill_alpha=1.0)
       p.segment(
@@ -149,16 +154,13 @@ class TrendlineFigure():
     p.square(pt_set_x, tl_vals_at_x, size=12, color=color, alpha=0.5)
 
     # Mark global maxs or mins
-    for date in self.global_maxs_or_mins:
-      query = candles_df.loc[candles_df['Date'] == date]
-      if len(query) == 0: continue
-      index = query.iloc[0].name
+    global_maxs_or_mins = list(self.global_maxs_or_mins)
+    p.circle(global_maxs_or_mins, prices[global_maxs_or_mins], size=20, color="gold", alpha=0.3)
 
-      if self.type == structs.TrendlineTypes.RESISTANCE:
-        price = candles_df.iloc[index].High
-      elif self.type == structs.TrendlineTypes.SUPPORT:
-        price = candles_df.iloc[index].Low
-      p.circle(index, price, size=20, color="gold", alpha=0.3)
+  def get_label_text(self):
+    label_text = "Score " + str(self.id) + " = " + str(round(self.score, 2))
+    if self.is_breakout: label_text += " (breakout at {})".format(self.breakout_index)
+    return label_text
 
   def get_trendtype_string(self):
     if self.type == structs.TrendlineTypes.RESISTANCE:
@@ -218,16 +220,123 @@ def _draw_bidirectional_ray(p, x, y, angle, color, width=2, dash="dashed"):
 
 def _highlight_pivots(p, pivots_indexes, col, candles_df):
   # Highlight pivot points
-  pivots_x_vals = []
-  pivots_y_vals = []
-  for pivot_idx in pivots_indexes:
-    pivot_panda_ts = candles_df.iloc[pivot_idx].name
-    pivot_y_val = candles_df.iloc[pivot_idx][col]
-    pivots_x_vals.append(pivot_panda_ts)
-    pivots_y_vals.append(pivot_y_val)
+  pivots_indexes = sorted(pivots_indexes)
+  pivots_x_vals = candles_df.index[pivots_indexes]
+  pivots_y_vals = candles_df[col].to_numpy()[pivots_indexes]
   p.diamond(pivots_x_vals, pivots_y_vals, size=20, line_color="green", fill_alpha=0.1, alpha=0.5)
 
-def plot_graph_bokeh(results):
+def _plot_trendlines(p, trends_df, trend_type, prices, num_candles):
+  '''
+  Draws every trendline in trends_df with one glyph call per kind of mark (segments are
+  split by line dash), instead of several glyphs per trendline. Points are looked up by
+  their pointset_indeces in prices
+  '''
+  if len(trends_df) == 0: return
+
+  segments = {}
+  squares = {'x': [], 'y': [], 'color': []}
+  breakouts = {'x': [], 'y': []}
+  labels = {'x': [], 'y': [], 'text': [], 'border_color': []}
+
+  def add_segment(x0, y0, x1, y1, color, width, dash):
+    segment = segments.setdefault(dash, {'x0': [], 'y0': [], 'x1': [], 'y1': [], 'color': [], 'width': []})
+    for key, value in zip(['x0', 'y0', 'x1', 'y1', 'color', 'width'], [x0, y0, x1, y1, color, width]):
+      segment[key].append(value)
+
+  for result_row in trends_df.to_dict('records'):
+    tf = TrendlineFigure(trend_type, result_row)
+    pt_set_x, tl_vals_at_x, m, b, last_date_index = tf.get_line_geometry(prices, num_candles)
+    tl_y_at_last_date = m * last_date_index + b
+
+    color = tf.get_trendline_plot_color()
+    width = tf.get_trendline_plot_line_width()
+    dash = tf.get_trendline_plot_line_style()
+
+    if tf.is_breakout:
+      breakouts['x'].append(last_date_index)
+      breakouts['y'].append(tl_y_at_last_date)
+
+    add_segment(pt_set_x[0], tl_vals_at_x[0], last_date_index, tl_y_at_last_date, color, width, dash)
+
+    # Score label of the best trendline of each duplicate group
+    if tf.is_best_from_duplicate_group:
+      add_segment(last_date_index, tl_y_at_last_date, last_date_index + 2, tl_y_at_last_date + (m * 2), color, width, dash)
+      labels['x'].append(last_date_index + 2)
+      labels['y'].append(tl_y_at_last_date + (2 * m))
+      labels['text'].append(tf.get_label_text())
+      labels['border_color'].append(color)
+
+    # Points that make up trendline
+    squares['x'].extend(pt_set_x)
+    squares['y'].extend(tl_vals_at_x)
+    squares['color'].extend([color] * len(pt_set_x))
+
+  p.x(breakouts['x'], breakouts['y'], line_width=3, size=10, color="red", alpha=0.8)
+  for dash, segment in segments.items():
+    p.segment(
+      x0=segment['x0'], y0=segment['y0'], x1=segment['x1'], y1=segment['y1'],
+      color=segment['color'], line_width=segment['width'], line_dash=dash,
+    )
+  p.add_layout(LabelSet(
+    x='x', y='y', text='text', source=ColumnDataSource(labels),
+    border_line_color='border_color', border_line_alpha=0.8,
+    background_fill_color='white', background_fill_alpha=1.0,
+  ))
+  p.square(squares['x'], squares['y'], size=12, color=squares['color'], alpha=0.5)
+
+  # Global maxs or mins are the same for every trendline of a trend type
+  global_maxs_or_mins = list(trends_df['global_maxs_or_mins'].iloc[0])
+  p.circle(global_maxs_or_mins, prices[global_maxs_or_mins], size=20, color="gold", alpha=0.3)
+
+def _candle_buckets(candlestick_data, bucket_size):
+  '''
+  Candles aggregated into OHLC buckets of bucket_size consecutive candles, as the columns of
+  a ColumnDataSource. Buckets are placed at the center of the candle indexes they cover, so
+  that trendlines (drawn in candle indexes) still line up with them
+  '''
+  opens = candlestick_data.opens()
+  highs = candlestick_data.highs()
+  lows = candlestick_data.lows()
+  closes = candlestick_data.closes()
+  num_candles = len(highs)
+
+  starts = np.arange(0, num_candles, bucket_size)
+  ends = np.minimum(starts + bucket_size, num_candles)
+
+  bucket_opens = opens[starts]
+  bucket_closes = closes[ends - 1]
+  colors = np.where(bucket_closes > bucket_opens, "#D5E1DD", "#F2583E")
+
+  return {
+    'x': (starts + ends - 1) / 2.0,
+    'open': bucket_opens,
+    'high': np.maximum.reduceat(highs, starts),
+    'low': np.minimum.reduceat(lows, starts),
+    'close': bucket_closes,
+    'color': colors,
+  }
+
+def _nice_tick_interval(min_interval):
+  # Smallest interval of the form 1, 2 or 5 times a power of ten that is at least min_interval
+  magnitude = 1
+  while True:
+    for mantissa in [1, 2, 5]:
+      if mantissa * magnitude >= min_interval:
+        return mantissa * magnitude
+    magnitude *= 10
+
+def _tick_mantissas(tick_interval):
+  '''
+  Mantissas for a BasicTicker with min_interval=tick_interval, where tick_interval is 1, 2 or 5
+  times a power of ten. The ticker picks intervals of a mantissa times a power of ten, and
+  with these every interval it can pick is a multiple of tick_interval
+  '''
+  mantissa = tick_interval
+  while mantissa % 10 == 0:
+    mantissa //= 10
+  return [1, 2, 5] if mantissa == 1 else [1, mantissa]
+
+def plot_graph_bokeh(results, max_candles=None):
   candlestick_data = results["candlestick_data"]
 
   # Plot
@@ -247,13 +356,14 @@ def plot_graph_bokeh(results):
   x_range_right = len(candles_df) + 10
   
   
-  # Plot candlestick chart
-  inc = candles_df.Close > candles_df.Open
-  dec = candles_df.Open > candles_df.Close
-  w = 0.5
+  # Plot candlestick chart. Above max_candles candles, consecutive candles are aggregated into
+  # buckets so that the size of the output stays bounded
+  num_candles = len(candles_df)
+  bucket_size = 1 if max_candles == None else max(1, int(ceil(num_candles / max_candles)))
+  candles_source = ColumnDataSource(_candle_buckets(candlestick_data, bucket_size))
+  w = 0.5 * bucket_size
 
   p = figure(
-    x_axis_type="datetime",
     tools="pan,wheel_zoom,tap,crosshair,hover,poly_draw,reset,save",
     width=1300,
     title=site_title,
@@ -261,27 +371,29 @@ def plot_graph_bokeh(results):
     x_range=(x_range_left, x_range_right),
   )
   
-  p.xaxis.major_label_overrides = {
-    i: date.strftime('%b %d %H:%M') for i, date in enumerate(candles_df['Date'])
-  }
+  # x is the candle index. Ticks are kept to multiples of tick_interval candles, so only those
+  # need a label: the candle's date, or nothing outside the candles
+  tick_interval = _nice_tick_interval(bucket_size)
+  tick_dates = candlestick_data.dates()[::tick_interval]
+  p.xaxis.ticker = BasicTicker(min_interval=tick_interval, mantissas=_tick_mantissas(tick_interval))
+  tick_labels = {x: '' for x in range(-tick_interval, x_range_right + tick_interval, tick_interval)}
+  tick_labels.update({
+    i * tick_interval: date.strftime('%b %d %H:%M') for i, date in enumerate(tick_dates)
+  })
+  p.xaxis.major_label_overrides = tick_labels
 
   p.xaxis.major_label_orientation = pi/4
   p.grid.grid_line_alpha=0.3
-  p.segment(candles_df.index, candles_df.High, candles_df.index, candles_df.Low, color="black")
-  p.vbar(candles_df.index[inc], w, candles_df.Open[inc], candles_df.Close[inc], fill_color="#D5E1DD", line_color="black")
-  p.vbar(candles_df.index[dec], w, candles_df.Open[dec], candles_df.Close[dec], fill_color="#F2583E", line_color="black")
+  p.segment(x0='x', y0='high', x1='x', y1='low', color="black", source=candles_source)
+  p.vbar(x='x', width=w, top='open', bottom='close', fill_color='color', line_color="black", source=candles_source)
 
   # Plot trendlines (support)
   if 'support_trendlines' in results:
-    for _, result_row in results['support_trendlines'].iterrows():
-      tf = TrendlineFigure(structs.TrendlineTypes.SUPPORT, result_row)
-      tf.plot_figure(p, candles_df)
+    _plot_trendlines(p, results['support_trendlines'], structs.TrendlineTypes.SUPPORT, candlestick_data.lows(), len(candles_df))
 
   # Plot trendlines (resistsance)
   if 'resistance_trendlines' in results:
-    for _, result_row in results['resistance_trendlines'].iterrows():
-      tf = TrendlineFigure(structs.TrendlineTypes.RESISTANCE, result_row)
-      tf.plot_figure(p, candles_df)
+    _plot_trendlines(p, results['resistance_trendlines'], structs.TrendlineTypes.RESISTANCE, candlestick_data.highs(), len(candles_df))
 
   # Draw vertical lines at first and last price
   _draw_bidirectional_ray(p, candles_df.index[0] - 0.5, 0, 90, "#bbbbbb")
@@ -299,7 +411,7 @@ def plot_graph_bokeh(results):
 
   return p
 
-def plot_table_bokeh(results):
+def plot_table_bokeh(results, best_of_group_only=False, table_columns=None):
   if results['trend_type'] == structs.TrendlineTypes.BOTH:
     all_results = pd.concat([results['support_trendlines'], results['resistance_trendlines']])
   elif results['trend_type'] == structs.TrendlineTypes.SUPPORT:
@@ -307,8 +419,19 @@ def plot_table_bokeh(results):
   else:
     all_results = results['resistance_trendlines']
 
+  if best_of_group_only:
+    all_results = all_results[all_results['is_best_from_duplicate_group'].astype(bool)]
+
+  if table_columns == None:
+    all_results = all_results.drop(columns='pointset_dates')
+  else:
+    missing_columns = [col for col in table_columns if col not in all_results.columns]
+    if len(missing_columns) > 0:
+      raise Exception("table_columns argument for plot contains unknown columns {}".format(missing_columns))
+    all_results = all_results[table_columns]
+
   if len(all_results) > 0:
-    html_trends_table = all_results.drop(columns='pointset_dates').to_html(border=0, header=True, index=False, justify="left", float_format=lambda x: '%10.3f' % x)
+    html_trends_table = all_results.to_html(border=0, header=True, index=False, justify="left", float_format=lambda x: '%10.3f' % x)
   else:
     html_trends_table = '<p>No trendlines found</p>'
 
@@ -322,30 +445,86 @@ def plot_table_bokeh(results):
 
   return div
 
+def _shared_resources(filedir):
+  '''
+  Resources pointing at a copy of BokehJS in a bokeh-<version> directory next to the HTML
+  files. The copy is made by the first plot written to filedir, and each file is moved in
+  place once complete so that concurrent writers never see a partial file
+  '''
+  static_dirname = 'bokeh-' + bokeh.__version__
+  resources = Resources(mode='server', root_url='./' + static_dirname + '/')
+
+  js_dir = os.path.join(filedir, static_dirname, 'static', 'js')
+  os.makedirs(js_dir, exist_ok=True)
+  for url in resources.js_files:
+    js_filename = url.split('/')[-1]
+    js_path = os.path.join(js_dir, js_filename)
+    if os.path.exists(js_path): continue
+
+    fd, tmp_path = tempfile.mkstemp(dir=js_dir, suffix='.tmp')
+    os.close(fd)
+    shutil.copyfile(os.path.join(bokehjsdir(), 'js', js_filename), tmp_path)
+    os.replace(tmp_path, js_path)
+
+  return resources
+
+def _write_html(filepath, models, resources, title):
+  '''
+  Writes the HTML page of models to filepath piece by piece, with the custom styles in its
+  head, instead of rendering the whole page to a single string first
+  '''
+  script, divs = components(models)
+  bokeh_js, bokeh_css = bundle_for_objs_and_resources(models, resources)
+
+  with open(filepath, 'w') as outfile:
+    outfile.write('<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n')
+    outfile.write('<title>{}</title>\n'.format(title))
+    outfile.write('<style class="custom" type="text/css">{}</style>\n'.format(css_hack))
+    outfile.write(bokeh_css)
+    outfile.write(bokeh_js)
+    outfile.write('</head>\n<body>\n')
+    for div in divs:
+      outfile.write(div)
+      outfile.write('\n')
+    outfile.write(script)
+    outfile.write('\n</body>\n</html>\n')
+
 def plot(
   results=None,
   filedir='.',
   filename='trend_plot.html',
+  max_candles=None, # when set, candles are aggregated into OHLC buckets so that at most this many are drawn
+  resources=structs.PlotResources.CDN, # how the page loads BokehJS, see structs.PlotResources
+  best_of_group_only=False, # only list the best trendline of each duplicate group in the table
+  table_columns=None, # columns listed in the table, defaults to every column but pointset_dates
 ):
   # Validate data
   if results == None or type(results) != dict:
     raise Exception("results argument for plot needs to be output of detect(...)")
 
+  if max_candles != None and (type(max_candles) != int or max_candles < 1):
+    raise Exception("max_candles argument for plot must be a positive integer, received {}".format(max_candles))
+
+  if resources not in structs.VALID_PLOT_RESOURCES:
+    raise Exception("resources argument for plot must be one of {}".format(structs.VALID_PLOT_RESOURCES))
+
+  results = with_dataframes(results)
+
   # Plot candlestick graph with trendlines
-  trend_graph = plot_graph_bokeh(results)
+  trend_graph = plot_graph_bokeh(results, max_candles=max_candles)
 
   # Plot trendline results dataframe below the plot
-  trend_table = plot_table_bokeh(results)
-
-  # Get HTML content
-  filepath = filedir + '/' + filename
-  html_content = file_html(models=(trend_graph, trend_table), resources=(CDN), title="pytrendline results")
+  trend_table = plot_table_bokeh(results, best_of_group_only=best_of_group_only, table_columns=table_columns)
 
-  # Hack in extra styles to HTML
-  html_content = html_content.replace('<head>', '<head><style class="custom" type="text/css">{}</style>'.format(css_hack))
+  if resources == structs.PlotResources.SHARED:
+    bokeh_resources = _shared_resources(filedir)
+  elif resources == structs.PlotResources.INLINE:
+    bokeh_resources = INLINE
+  else:
+    bokeh_resources = CDN
 
   # Write HTML to file
-  with open(filepath, 'w') as outfile:
-    outfile.write(html_content)
-  
+  filepath = filedir + '/' + filename
+  _write_html(filepath, (trend_graph, trend_table), bokeh_resources, "pytrendline results")
+
   return filepath
\ No newline at end of file
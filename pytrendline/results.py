@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+
+from . import structs
+
+# Columns of the trendlines dataframe returned by detect, along with the dtype each column
+# is built with. 'optional' columns hold None for some rows, so they stay object dtype
+# unless every row has a value
+TRENDS_DF_SCHEMA = [
+  ('id', 'object'),
+  ('trendtype', 'object'),
+  ('pointset_indeces', 'object'),
+  ('pointset_dates', 'object'),
+  ('starts_at_index', 'int64'),
+  ('starts_at_date', 'datetime'),
+  ('ends_at_index', 'int64'),
+  ('ends_at_date', 'datetime'),
+  ('is_breakout', 'bool'),
+  ('breakout_index', 'optional'),
+  ('breakout_date', 'optional'),
+  ('num_points', 'int64'),
+  ('m', 'float64'),
+  ('b', 'float64'),
+  ('slope', 'float64'),
+  ('price_at_last_date', 'float64'),
+  ('score', 'float64'),
+  ('includes_global_max_or_min', 'bool'),
+  ('global_maxs_or_mins', 'object'),
+  ('price_at_next_future_date', 'float64'),
+  ('duplicate_group_id', 'object'),
+  ('is_best_from_duplicate_group', 'bool'),
+  ('overall_rank', 'object'),
+  ('rank_within_group', 'int64'),
+]
+TRENDS_DF_COLUMNS = [name for name, _ in TRENDS_DF_SCHEMA]
+
+# Columns kept as arrays by CompactTrendlines, with their dtype. Missing breakout indexes
+# are stored as -1 and the overall rank of trendlines that are not best of their group as 0
+COMPACT_COLUMNS = [
+  ('starts_at_index', np.int32),
+  ('ends_at_index', np.int32),
+  ('is_breakout', np.bool_),
+  ('breakout_index', np.int32),
+  ('num_points', np.int32),
+  ('m', np.float64),
+  ('b', np.float64),
+  ('slope', np.float64),
+  ('price_at_last_date', np.float64),
+  ('score', np.float64),
+  ('includes_global_max_or_min', np.bool_),
+  ('price_at_next_future_date', np.float64),
+  ('duplicate_group_id', np.int32),
+  ('is_best_from_duplicate_group', np.bool_),
+  ('overall_rank', np.int32),
+  ('rank_within_group', np.int32),
+]
+# Compact columns set by duplicate marking rather than when lines are collected
+COMPACT_MARK_COLUMNS = ['duplicate_group_id', 'is_best_from_duplicate_group', 'overall_rank', 'rank_within_group']
+
+def _build_trends_df(trend_columns):
+  '''
+  Turns the per-column buffers collected during detection into the trendlines dataframe
+  in a single allocation, instead of growing the dataframe one row at a time
+  '''
+  if len(trend_columns['id']) == 0:
+    return pd.DataFrame(columns=TRENDS_DF_COLUMNS)
+
+  data = {}
+  for name, kind in TRENDS_DF_SCHEMA:
+    values = trend_columns[name]
+    if kind == 'datetime':
+      data[name] = pd.Series(values)
+    elif kind == 'optional':
+      data[name] = pd.Series(values, dtype=object)
+      if not any(v is None for v in values):
+        data[name] = data[name].infer_objects()
+    elif kind == 'object':
+      data[name] = pd.Series(values, dtype=object)
+    else:
+      data[name] = np.array(values, dtype=kind)
+
+  return pd.DataFrame(data)
+
+def _fill_trendline_dates(trend_columns, candlestick_data):
+  '''
+  Looks up the dates of every kept line's points with a single fancy index into the
+  cached dates of candlestick_data. The breakout date is the date of the line's start
+  '''
+  pointsets = trend_columns['pointset_indeces']
+  if len(pointsets) == 0: return
+
+  dates = candlestick_data.dates()
+  point_dates = list(dates[np.concatenate(pointsets)])
+  ends = np.cumsum([len(pointset) for pointset in pointsets])
+
+  trend_columns['pointset_dates'] = [point_dates[end - len(pointset):end] for pointset, end in zip(pointsets, ends)]
+  trend_columns['starts_at_date'] = list(dates[trend_columns['starts_at_index']])
+  trend_columns['ends_at_date'] = list(dates[trend_columns['ends_at_index']])
+  trend_columns['breakout_date'] = [
+    start_date if is_breakout else None
+    for start_date, is_breakout in zip(trend_columns['starts_at_date'], trend_columns['is_breakout'])
+  ]
+
+class CompactTrendlines():
+  '''
+  Trendlines of one trend type as returned by detect(..., result_format=ResultFormats.COMPACT).
+
+  Rows are in the same order as the trendlines dataframe. Numeric and boolean columns are
+  numpy arrays in columns (see COMPACT_COLUMNS). The points of row r are
+  point_indices[point_offsets[r]:point_offsets[r + 1]]. The global max or min points are
+  stored once in global_max_or_mins. Ids and dates are not stored, to_dataframe() derives
+  them when building the trendlines dataframe
+  '''
+  def __init__(
+    self,
+    trend_type,
+    columns,
+    point_offsets,
+    point_indices,
+    global_max_or_mins,
+    index,
+    candlestick_data,
+  ):
+    self.trend_type = trend_type
+    self.columns = columns
+    self.point_offsets = point_offsets
+    self.point_indices = point_indices
+    self.global_max_or_mins = global_max_or_mins
+    # Row labels of the trendlines dataframe
+    self.index = index
+    self.candlestick_data = candlestick_data
+    self._df = None
+
+  def __len__(self):
+    return len(self.index)
+
+  def pointset(self, row):
+    return self.point_indices[self.point_offsets[row]:self.point_offsets[row + 1]]
+
+  def to_dataframe(self):
+    '''
+    The trendlines dataframe detect returns with the default result format. Built on first
+    use and cached
+    '''
+    if self._df is None:
+      self._df = self._build_dataframe()
+    return self._df
+
+  def _build_dataframe(self):
+    trend_columns = {name: [] for name in TRENDS_DF_COLUMNS}
+    prefix = "R" if self.trend_type == structs.TrendlineTypes.RESISTANCE else "S"
+    global_max_or_mins = self.global_max_or_mins.tolist()
+    num_rows = len(self)
+
+    trend_columns['pointset_indeces'] = [self.pointset(row).tolist() for row in range(num_rows)]
+    trend_columns['id'] = [prefix + "-[" + ",".join(str(p) for p in points) + "]" for points in trend_columns['pointset_indeces']]
+    trend_columns['trendtype'] = [self.trend_type] * num_rows
+    trend_columns['global_maxs_or_mins'] = [global_max_or_mins] * num_rows
+
+    for name, _ in COMPACT_COLUMNS:
+      trend_columns[name] = self.columns[name].tolist()
+    trend_columns['breakout_index'] = [None if index < 0 else index for index in trend_columns['breakout_index']]
+    trend_columns['overall_rank'] = [None if rank == 0 else rank for rank in trend_columns['overall_rank']]
+
+    _fill_trendline_dates(trend_columns, self.candlestick_data)
+
+    trends_df = _build_trends_df(trend_columns)
+    if num_rows == 0:
+      trends_df = trends_df.sort_values(by='score', ascending=False)
+      trends_df["is_breakout"] = trends_df["is_breakout"].astype(bool)
+    else:
+      trends_df.index = pd.Index(self.index.astype(np.int64))
+
+    return trends_df
+
+def with_dataframes(results):
+  '''
+  Returns a copy of the output of detect(...) where compact trendlines are replaced by their
+  trendlines dataframe
+  '''
+  results = dict(results)
+  for key in ['support_trendlines', 'resistance_trendlines']:
+    if isinstance(results.get(key), CompactTrendlines):
+      results[key] = results[key].to_dataframe()
+  return results
@@ -0,0 +1,104 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from . import structs
+
+STORE_COLUMNS = ["Date", "Open", "High", "Low", "Close"]
+STORE_META_FILE = "meta.json"
+
+class CandleStore():
+  '''
+  Candles kept on disk as one .npy file per column in a directory, written with
+  CandleStore.write(...). Columns are opened as read-only memory maps, so building the
+  CandlestickData for a window of dates only reads the pages of that window, and
+  windows over the same store share the pages already read.
+
+  Dates are stored in ascending order as UTC datetime64[ns], along with the timezone they
+  are returned in.
+  '''
+  def __init__(self, directory):
+    meta_path = os.path.join(directory, STORE_META_FILE)
+    if not os.path.exists(meta_path):
+      raise Exception("CandleStore directory '{}' does not contain a {} file. Write it with CandleStore.write(...)".format(
+        directory, STORE_META_FILE
+      ))
+
+    with open(meta_path) as f:
+      meta = json.load(f)
+
+    self.directory = directory
+    self.time_interval = meta["time_interval"]
+    self.tz = meta["tz"]
+    self.columns = {
+      col: np.load(os.path.join(directory, col + ".npy"), mmap_mode="r")
+      for col in STORE_COLUMNS
+    }
+
+  @staticmethod
+  def write(directory, candlestick_data):
+    '''
+    Writes the candles of candlestick_data to directory, which is created if needed
+    '''
+    if type(candlestick_data) != structs.CandlestickData:
+      raise Exception("candlestick_data input provided is of invalid type. See README for instructions")
+
+    dates = candlestick_data.dates()
+    tz = str(dates.tz) if dates.tz is not None else None
+    if tz is not None:
+      dates = dates.tz_convert("UTC").tz_localize(None)
+
+    date_values = dates.to_numpy(dtype="datetime64[ns]")
+    if np.any(date_values[1:] < date_values[:-1]):
+      raise Exception("CandleStore can only store candles in ascending date order")
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "Date.npy"), date_values)
+    np.save(os.path.join(directory, "Open.npy"), candlestick_data.df["Open"].to_numpy(dtype=float))
+    np.save(os.path.join(directory, "High.npy"), candlestick_data.highs())
+    np.save(os.path.join(directory, "Low.npy"), candlestick_data.lows())
+    np.save(os.path.join(directory, "Close.npy"), candlestick_data.closes())
+
+    # Written last, so that a partly written store cannot be opened
+    with open(os.path.join(directory, STORE_META_FILE), "w") as f:
+      json.dump({"time_interval": candlestick_data.time_interval, "tz": tz}, f)
+
+  def __len__(self):
+    return len(self.columns["Date"])
+
+  def window(self, start=None, end=None):
+    '''
+    CandlestickData for the candles dated from start to end, both included. Either bound can
+    be left out. Naive dates are taken to be in the store's timezone
+    '''
+    start_index = 0 if start is None else int(np.searchsorted(self.columns["Date"], self._to_datetime64(start), side="left"))
+    stop_index = len(self) if end is None else int(np.searchsorted(self.columns["Date"], self._to_datetime64(end), side="right"))
+    return self.slice(start_index, stop_index)
+
+  def slice(self, start_index, stop_index):
+    '''
+    CandlestickData for the candles at positions start_index to stop_index (not included)
+    '''
+    dates = self.columns["Date"][start_index:stop_index]
+    if self.tz is not None:
+      dates = pd.DatetimeIndex(dates).tz_localize("UTC").tz_convert(self.tz)
+
+    return structs.CandlestickData.from_arrays(
+      open=self.columns["Open"][start_index:stop_index],
+      high=self.columns["High"][start_index:stop_index],
+      low=self.columns["Low"][start_index:stop_index],
+      close=self.columns["Close"][start_index:stop_index],
+      dates=dates,
+      time_interval=self.time_interval,
+    )
+
+  def _to_datetime64(self, date):
+    date = pd.Timestamp(date)
+    if self.tz is not None:
+      if date.tz is None:
+        date = date.tz_localize(self.tz)
+      date = date.tz_convert("UTC").tz_localize(None)
+    elif date.tz is not None:
+      raise Exception("CandleStore dates have no timezone, received timezone aware date {}".format(date))
+    return date.to_datetime64()
@@ -0,0 +1,681 @@
+import bisect
+
+import numpy as np
+import pandas as pd
+
+from . import structs
+from . import util
+from . import kernels
+from .detect import (
+  DEFAULT_CONFIG,
+  NUMPY_SCAN_BLOCK_SIZE,
+  resolve_config,
+  _kernel_trend_code,
+  _pivot_mask,
+  _find_global_max_or_mins,
+  _collect_trendlines,
+  _finalize_trendlines,
+)
+
+# Columns compared between two results to decide whether a trendline row changed
+CHANGE_COLUMNS = [
+  'num_points',
+  'is_breakout',
+  'breakout_index',
+  'price_at_last_date',
+  'score',
+  'includes_global_max_or_min',
+  'duplicate_group_id',
+  'is_best_from_duplicate_group',
+  'overall_rank',
+  'rank_within_group',
+]
+
+# Buffers of the pairs _TrendState keeps up to date, the pairs that can become trendlines
+# under the current config
+PAIR_FIELDS = [
+  ('i', np.int64),
+  ('j', np.int64),
+  # Line of the pair, given by util.line_through as in the scans of detect(...)
+  ('m', float),
+  ('b', float),
+  # Touch count and first breakout (-1 without breakout) under the current thresholds
+  ('count', np.int64),
+  ('breakout', np.int64),
+  # The closest errors below and above the touch threshold, and the largest excess before the
+  # first breakout and the excess at it. The count and breakout hold for any threshold in between
+  ('touch_low', float),
+  ('touch_high', float),
+  ('breakout_low', float),
+  ('breakout_high', float),
+  # Touch list, filled in the first time the pair is returned and kept up to date afterwards.
+  # Touches are numbered from the first candle ever seen, so the lists hold when a window moves
+  ('touches', object),
+]
+
+# Buffers of the pairs _TrendState has set aside because they cannot become trendlines under
+# the current config: their line is outside the slope or last price limits, an end point is
+# not a pivot where it has to be, or, when ignoring breakouts, the line breaks out. Thresholds
+# are resolved again on every append, so these pairs may come back and a compact record of
+# them is kept rather than nothing. Lines are recomputed from the prices when needed
+PARKED_FIELDS = [
+  ('i', np.int32),
+  ('j', np.int32),
+  # A candle the line breaks through and by how much, or -1 and -inf when none is known.
+  # The pair stays broken as long as the breakout tolerance stays below that excess
+  ('breakout', np.int32),
+  ('excess', float),
+]
+
+class StreamingDetector():
+  '''
+  Incremental version of detect(...) for candles that arrive one at a time.
+
+  Config thresholds are resolved again from all candles seen so far on every append (see
+  self.config), so results() is equivalent to calling detect(...) on those candles with the
+  same config and flags. Every (i, j) pair that can become a trendline keeps its touch count
+  and first breakout along with the range of thresholds they hold for. Appending a candle
+  tests it against those pairs, rescans only the ones whose range no longer contains the new
+  thresholds and scans the pairs that end on it. The other pairs are only checked for whether
+  the new config lets them become trendlines again
+  '''
+  def __init__(
+    self,
+    candlestick_data=None,
+    trend_type=None,
+    first_pt_must_be_pivot=False,
+    last_pt_must_be_pivot=False,
+    all_pts_must_be_pivots=False,
+    trendline_must_include_global_maxmin_pt=False,
+    min_points_required=3,
+    ignore_breakouts=True,
+    config=DEFAULT_CONFIG,
+  ):
+    if candlestick_data == None:
+      raise Exception("No candlestick data provided")
+    elif type(candlestick_data) != structs.CandlestickData:
+      raise Exception("candlestick_data input provided is of invalid type. See README for instructions")
+
+    if trend_type not in [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE, structs.TrendlineTypes.BOTH]:
+      raise Exception("trend_type input provided is of invalid type. See README for instructions")
+
+    self.trend_type = trend_type
+    self.first_pt_must_be_pivot = first_pt_must_be_pivot
+    self.last_pt_must_be_pivot = last_pt_must_be_pivot
+    self.all_pts_must_be_pivots = all_pts_must_be_pivots
+    self.trendline_must_include_global_maxmin_pt = trendline_must_include_global_maxmin_pt
+    self.min_points_required = min_points_required
+    self.ignore_breakouts = ignore_breakouts
+    self.time_interval = candlestick_data.time_interval
+    self._config = config
+
+    df = candlestick_data.df
+    self._size = len(df)
+    capacity = max(2 * self._size, 64)
+    self._prices = {}
+    for col in ['Open', 'High', 'Low', 'Close']:
+      self._prices[col] = np.empty(capacity)
+      self._prices[col][:self._size] = df[col].to_numpy(dtype=float)
+
+    # Dates are kept as nanoseconds since the epoch (UTC for timezone aware dates) next to the prices
+    dates = pd.DatetimeIndex(df.Date)
+    self._tz = dates.tz
+    self._dates = np.empty(capacity, dtype=np.int64)
+    self._dates[:self._size] = dates.asi8
+    self._resolve()
+
+    self._states = []
+    if trend_type != structs.TrendlineTypes.RESISTANCE:
+      self._states.append(_TrendState(structs.TrendlineTypes.SUPPORT))
+    if trend_type != structs.TrendlineTypes.SUPPORT:
+      self._states.append(_TrendState(structs.TrendlineTypes.RESISTANCE))
+    for state in self._states:
+      state.rebuild(self, self._prices[state.col][:self._size])
+
+    self._last_results = self.results()
+
+  def append(self, candle):
+    '''
+    Adds one candle, given as a mapping with Date, Open, High, Low and Close keys, and
+    returns the trendlines that changed. The result has the same keys as detect(...),
+    where each trendlines dataframe only holds new or updated rows (new touches,
+    breakouts, price_at_last_date, score and ranking changes), plus a list of ids
+    under '<support|resistance>_removed' for lines that are no longer returned
+    '''
+    for key in ['Date', 'Open', 'High', 'Low', 'Close']:
+      if key not in candle:
+        raise Exception("StreamingDetector.append requires candle to contain '{}'".format(key))
+
+    self._extend(
+      pd.Timestamp(candle['Date']),
+      float(candle['Open']),
+      float(candle['High']),
+      float(candle['Low']),
+      float(candle['Close']),
+    )
+
+    previous = self._last_results
+    current = self.results()
+    self._last_results = current
+
+    changes = {
+      'trend_type': self.trend_type,
+      'candlestick_data': current['candlestick_data'],
+    }
+    for state in self._states:
+      key = state.prefix + '_trendlines'
+      changed, removed = _diff_trendlines(previous[key], current[key])
+      changes[state.prefix + '_pivots'] = current[state.prefix + '_pivots']
+      changes[key] = changed
+      changes[state.prefix + '_removed'] = removed
+
+    return changes
+
+  def results(self):
+    candlestick_data = self._candles
+    results = {
+      'trend_type': self.trend_type,
+      'candlestick_data': candlestick_data,
+    }
+    for state in self._states:
+      trends_df, pivots = state.trendlines(self, candlestick_data)
+      results[state.prefix + '_pivots'] = pivots
+      results[state.prefix + '_trendlines'] = trends_df
+    return results
+
+  def candlestick_data(self):
+    # Copies, since the buffers are written in place by later appends and slides
+    n = self._size
+    dates = pd.DatetimeIndex(self._dates[:n].view('datetime64[ns]'))
+    if self._tz is not None:
+      dates = dates.tz_localize('UTC').tz_convert(self._tz)
+    return structs.CandlestickData.from_arrays(
+      open=self._prices['Open'][:n].copy(),
+      high=self._prices['High'][:n].copy(),
+      low=self._prices['Low'][:n].copy(),
+      close=self._prices['Close'][:n].copy(),
+      dates=dates,
+      time_interval=self.time_interval,
+    )
+
+  def _resolve(self):
+    # Thresholds of the current candles, resolved as detect(...) resolves them
+    self._candles = self.candlestick_data()
+    self.config = resolve_config(self._candles, self._config)
+
+  def _extend(self, date, open_price, high, low, close):
+    n = self._size
+    if n == len(self._prices['Open']):
+      for col in self._prices:
+        self._prices[col] = np.concatenate([self._prices[col], np.empty(n)])
+      self._dates = np.concatenate([self._dates, np.empty(n, dtype=np.int64)])
+
+    if self._tz is not None and date.tzinfo is None:
+      date = date.tz_localize(self._tz)
+    self._prices['Open'][n] = open_price
+    self._prices['High'][n] = high
+    self._prices['Low'][n] = low
+    self._prices['Close'][n] = close
+    self._dates[n] = date.value
+    self._size += 1
+    self._resolve()
+
+    for state in self._states:
+      state.extend(self, self._prices[state.col][:n + 1])
+
+class SlidingWindowDetector(StreamingDetector):
+  '''
+  Re-detection over a window of candles that moves forward one candle at a time, such as
+  the last 390 candles. The window starts as the candles given to the constructor and keeps
+  that many candles: slide(candle) evicts the oldest one and appends candle.
+
+  The (i, j) pair state of StreamingDetector is kept between windows. Sliding drops the
+  pairs starting at the evicted candle and renumbers the others from the new first candle,
+  instead of re-running detect(...) on each window. Config thresholds are resolved from
+  each window's candles (see self.config), and only the pairs whose threshold ranges
+  leave the new thresholds are rescanned. Each result is equivalent to calling
+  detect(...) on the window's candles with the same config and flags.
+  '''
+  def __init__(self, candlestick_data=None, trend_type=None, **kwargs):
+    super().__init__(candlestick_data=candlestick_data, trend_type=trend_type, **kwargs)
+    self.window_size = self._size
+
+  def slide(self, candle):
+    '''
+    Moves the window forward by one candle, given as a mapping with Date, Open, High, Low and
+    Close keys, and returns the results of the new window in the same format as detect(...)
+    '''
+    for key in ['Date', 'Open', 'High', 'Low', 'Close']:
+      if key not in candle:
+        raise Exception("SlidingWindowDetector.slide requires candle to contain '{}'".format(key))
+
+    self._evict_oldest()
+    self._extend(
+      pd.Timestamp(candle['Date']),
+      float(candle['Open']),
+      float(candle['High']),
+      float(candle['Low']),
+      float(candle['Close']),
+    )
+
+    self._last_results = self.results()
+    return self._last_results
+
+  def append(self, candle):
+    # Row ids are candle positions in the window, which shift on every move, so there is no
+    # meaningful set of changed rows to return
+    raise Exception("SlidingWindowDetector keeps a fixed number of candles, use slide(candle) to move the window")
+
+  def _evict_oldest(self):
+    n = self._size
+    for col in self._prices:
+      self._prices[col][:n - 1] = self._prices[col][1:n]
+    self._dates[:n - 1] = self._dates[1:n]
+    self._size -= 1
+
+    for state in self._states:
+      state.evict_first(self, self._prices[state.col][:n - 1])
+
+class _PairBuffers():
+  '''
+  Columns of pairs with the given fields. They are allocated with spare capacity that doubles
+  when it runs out, so adding the pairs of a new candle does not copy the existing ones
+  '''
+  def __init__(self, fields):
+    self.fields = fields
+    self.size = 0
+    self.buffers = {name: np.empty(0, dtype=dtype) for name, dtype in fields}
+
+  def columns(self):
+    # Views of the buffers over the pairs in use
+    return {name: buffer[:self.size] for name, buffer in self.buffers.items()}
+
+  def add(self, count):
+    # Makes room for count more pairs and returns their rows
+    needed = self.size + count
+    capacity = len(self.buffers[self.fields[0][0]])
+    if needed > capacity:
+      capacity = max(needed, 2 * capacity)
+      for name, dtype in self.fields:
+        grown = np.empty(capacity, dtype=dtype)
+        grown[:self.size] = self.buffers[name][:self.size]
+        self.buffers[name] = grown
+
+    rows = np.arange(self.size, needed)
+    self.size = needed
+    return rows
+
+  def keep(self, mask):
+    # Drops the pairs where mask is not set, keeping the order of the others
+    count = int(mask.sum())
+    for name, buffer in self.buffers.items():
+      buffer[:count] = buffer[:self.size][mask]
+    self.size = count
+
+class _TrendState():
+  '''
+  Pair state for one trend type. Pairs that can become trendlines under the current config
+  are kept in self.pairs (see PAIR_FIELDS) with their touch count and first breakout under
+  the thresholds they were last checked with (self.error_threshold and
+  self.breakout_threshold). All other pairs are parked in self.parked (see PARKED_FIELDS)
+  and checked on every append for whether they can become trendlines again, in which case
+  they are scanned from scratch.
+
+  Lines are evaluated and compared against the thresholds exactly like the scans of
+  detect(...) do, see detect._prefilter_pairs
+  '''
+  def __init__(self, trend_type):
+    self.trend_type = trend_type
+    self.col = "Low" if trend_type == structs.TrendlineTypes.SUPPORT else "High"
+    self.prefix = "support" if trend_type == structs.TrendlineTypes.SUPPORT else "resistance"
+    self.is_pivot = np.zeros(0, dtype=bool)
+    self.error_threshold = None
+    self.breakout_threshold = None
+    # Number of candles evicted from the start of a sliding window
+    self.num_evicted = 0
+
+    self.pairs = _PairBuffers(PAIR_FIELDS)
+    self.parked = _PairBuffers(PARKED_FIELDS)
+
+  def rebuild(self, detector, prices):
+    n = len(prices)
+    self._update_pivots(detector, prices)
+    self._set_thresholds(detector)
+
+    self.pairs.size = 0
+    self.parked.size = 0
+    # Pairs are placed for a block of first candles at a time, which bounds the temporary arrays
+    block_size = max(1, NUMPY_SCAN_BLOCK_SIZE // n)
+    for block_start in range(0, n - 1, block_size):
+      firsts = range(block_start, min(block_start + block_size, n - 1))
+      i = np.concatenate([np.full(n - 1 - first, first) for first in firsts])
+      j = np.concatenate([np.arange(first + 1, n) for first in firsts])
+      self._place(detector, prices, i, j)
+
+  def extend(self, detector, prices):
+    '''
+    Brings the pairs up to date with the candle added at the end of prices and the config
+    resolved with it, then adds the pairs ending on that candle
+    '''
+    n = len(prices) - 1
+    flipped = self._update_pivots(detector, prices)
+    stale = self._set_thresholds(detector)
+
+    if detector.last_pt_must_be_pivot:
+      for k in flipped:
+        stale |= self._apply_k(detector, prices, k, 1 if self.is_pivot[k] else -1, ~stale)
+    stale |= self._apply_k(detector, prices, n, 1, ~stale)
+
+    # Pairs that broke out under the current thresholds are parked as they are, the others
+    # that cannot become trendlines or need a rescan are placed again
+    p = self.pairs.columns()
+    broken = ~stale & (p['breakout'] >= 0) if detector.ignore_breakouts else np.zeros(len(stale), dtype=bool)
+    replaced = stale | ~self._usable(detector, prices, p['i'], p['j'], p['m'], p['b'])
+    self._park(p['i'][broken], p['j'][broken], p['breakout'][broken], p['breakout_high'][broken])
+    i = p['i'][replaced & ~broken]
+    j = p['j'][replaced & ~broken]
+    self.pairs.keep(~(broken | replaced))
+
+    # Parked pairs the current config lets become trendlines again
+    q = self.parked.columns()
+    m, b = util.line_through(q['i'], prices[q['i']], q['j'], prices[q['j']])
+    revived = self._usable(detector, prices, q['i'], q['j'], m, b)
+    if detector.ignore_breakouts:
+      still_broken = q['excess'] > self.breakout_threshold
+      if detector.last_pt_must_be_pivot:
+        still_broken &= self.is_pivot[np.maximum(q['breakout'], 0)]
+      revived &= ~still_broken
+    i = np.concatenate([i, q['i'][revived]])
+    j = np.concatenate([j, q['j'][revived]])
+    self.parked.keep(~revived)
+
+    self._place(detector, prices, i, j)
+    self._place(detector, prices, np.arange(n), np.full(n, n))
+
+  def trendlines(self, detector, candlestick_data):
+    n = detector._size
+    prices = detector._prices[self.col][:n]
+    config = detector.config
+    pivots = set(np.flatnonzero(self.is_pivot[:n]).tolist())
+    p = self.pairs.columns()
+
+    # Kept pairs already pass the limits, pivot rules and, when ignoring breakouts, have no breakout
+    rows = np.flatnonzero(p['count'] + 2 >= detector.min_points_required)
+    rows = rows[np.lexsort((p['j'][rows], p['i'][rows]))]
+    self._fill_touches(detector, prices, rows[[p['touches'][r] is None for r in rows.tolist()]])
+
+    def candidates():
+      for r in rows.tolist():
+        breakout_index = int(p['breakout'][r]) if p['breakout'][r] >= 0 else None
+        touches = p['touches'][r]
+        if self.num_evicted:
+          touches = [k - self.num_evicted for k in touches]
+        yield int(p['i'][r]), int(p['j'][r]), p['m'][r], p['b'][r], touches, breakout_index
+
+    global_max_or_mins = _find_global_max_or_mins(candlestick_data.df[self.col], self.trend_type, config.avg_candle_range)
+    trend_columns = _collect_trendlines(
+      candlestick_data, self.trend_type, prices, candidates(), global_max_or_mins, config,
+      detector.ignore_breakouts, detector.trendline_must_include_global_maxmin_pt,
+    )
+    return _finalize_trendlines(trend_columns, candlestick_data, self.trend_type, config), pivots
+
+  def evict_first(self, detector, prices):
+    '''
+    Drops the pairs starting at the first candle, which left the window, and shifts the
+    indexes of the others down by one. prices are the prices of the window left behind.
+    Intercepts are recomputed for the new indexes, while the prices of the lines at each
+    candle, and so their counts, breakouts and ranges, stay the same
+    '''
+    # No remaining pair covers the evicted candle, so touch counts, breakouts and touch lists still hold
+    for buffers in [self.pairs, self.parked]:
+      buffers.keep(buffers.columns()['i'] > 0)
+      p = buffers.columns()
+      p['i'] -= 1
+      p['j'] -= 1
+      p['breakout'][p['breakout'] >= 0] -= 1
+
+    p = self.pairs.columns()
+    p['b'][:] = prices[p['i']] - p['m'] * p['i']
+    self.num_evicted += 1
+
+    size = len(prices)
+    self.is_pivot[:size] = self.is_pivot[1:size + 1].copy()
+
+  def _update_pivots(self, detector, prices):
+    '''
+    Pivots of prices under the current config. Its thresholds can change with every candle,
+    so all pivots are recomputed. Returns the candles before the last one that changed status
+    '''
+    n = len(prices) - 1
+    if len(self.is_pivot) <= n:
+      self.is_pivot = np.concatenate([self.is_pivot, np.zeros(max(n + 1, 64), dtype=bool)])
+
+    is_pivot = _pivot_mask(
+      prices,
+      self.trend_type,
+      detector.config.pivot_seperation_threshold,
+      detector.config.pivot_grouping_threshold,
+    )
+    flipped = np.flatnonzero(self.is_pivot[:n] != is_pivot[:n]).tolist()
+    self.is_pivot[:n + 1] = is_pivot
+    return flipped
+
+  def _set_thresholds(self, detector):
+    '''
+    Switches to the thresholds of the current config, and returns which kept pairs have a
+    count or breakout that may not hold under them
+    '''
+    error_threshold = detector.config.max_allowable_error_pt_to_trend
+    breakout_threshold = detector.config.breakout_tolerance
+
+    if error_threshold == self.error_threshold and breakout_threshold == self.breakout_threshold:
+      stale = np.zeros(self.pairs.size, dtype=bool)
+    else:
+      self.error_threshold = error_threshold
+      self.breakout_threshold = breakout_threshold
+      stale = self._outside_ranges(np.arange(self.pairs.size))
+    return stale
+
+  def _outside_ranges(self, rows):
+    # Whether the thresholds are outside the ranges of rows. Touches are errors below the
+    # error threshold and breakouts are excesses above the breakout threshold
+    p = self.pairs.columns()
+    return (p['touch_low'][rows] >= self.error_threshold) | \
+      (p['touch_high'][rows] < self.error_threshold) | \
+      (p['breakout_low'][rows] > self.breakout_threshold) | \
+      (p['breakout_high'][rows] <= self.breakout_threshold)
+
+  def _usable(self, detector, prices, i, j, m, b):
+    # Whether the lines of the pairs pass the limits and pivot rules of the current config,
+    # checked like detect._prefilter_pairs does
+    config = detector.config
+    min_slope, max_slope = config.slope_limits(self.trend_type)
+    min_last_price, max_last_price = config.last_price_limits(self.trend_type)
+    slopes = m * config.avg_candle_range
+    prices_at_last = m * (len(prices) - 1) + b
+
+    usable = (slopes <= max_slope) & (slopes >= min_slope) & \
+      (prices_at_last <= max_last_price) & (prices_at_last >= min_last_price)
+    if detector.first_pt_must_be_pivot or detector.all_pts_must_be_pivots:
+      usable &= self.is_pivot[i]
+    if detector.last_pt_must_be_pivot or detector.all_pts_must_be_pivots:
+      usable &= self.is_pivot[j]
+    return usable
+
+  def _place(self, detector, prices, i, j):
+    '''
+    Adds pairs that are in neither buffer. Pairs that cannot become trendlines are parked,
+    the others are scanned and kept, unless they break out while breakouts are ignored
+    '''
+    i = i.astype(np.int64)
+    j = j.astype(np.int64)
+    m, b = util.line_through(i, prices[i], j, prices[j])
+    usable = self._usable(detector, prices, i, j, m, b)
+    self._park(i[~usable], j[~usable], -1, -np.inf)
+    i, j, m, b = i[usable], j[usable], m[usable], b[usable]
+
+    count, breakout, touch_low, touch_high, breakout_low, breakout_high = self._scan(detector, prices, i, j, m)
+    broken = breakout >= 0 if detector.ignore_breakouts else np.zeros(len(i), dtype=bool)
+    self._park(i[broken], j[broken], breakout[broken], breakout_high[broken])
+
+    rows = self.pairs.add(len(i) - int(broken.sum()))
+    p = self.pairs.columns()
+    for name, values in [
+      ('i', i), ('j', j), ('m', m), ('b', b), ('count', count), ('breakout', breakout),
+      ('touch_low', touch_low), ('touch_high', touch_high),
+      ('breakout_low', breakout_low), ('breakout_high', breakout_high),
+    ]:
+      p[name][rows] = values[~broken]
+    p['touches'][rows] = None
+
+  def _park(self, i, j, breakout, excess):
+    rows = self.parked.add(len(i))
+    q = self.parked.columns()
+    q['i'][rows] = i
+    q['j'][rows] = j
+    q['breakout'][rows] = breakout
+    q['excess'][rows] = excess
+
+  def _apply_k(self, detector, prices, k, sign, active):
+    '''
+    Adds (sign=1) or removes (sign=-1) candle k from the touch counts and breakouts of the
+    active pairs whose scan covers it. Returns which pairs need a rescan
+    '''
+    p = self.pairs.columns()
+    stale = np.zeros(self.pairs.size, dtype=bool)
+    rows = np.flatnonzero(active & (p['i'] < k) & (p['j'] != k))
+    if len(rows) == 0: return stale
+
+    price = prices[k]
+    trend_prices = self._trend_prices(prices, rows, k)
+    errors = np.abs(trend_prices - price)
+    excess = self._excess(trend_prices, price)
+    touching = errors < self.error_threshold
+    breaking = excess > self.breakout_threshold
+    before_breakout = (p['breakout'][rows] < 0) | (p['breakout'][rows] > k)
+
+    p['count'][rows] += sign * touching
+    if sign > 0:
+      p['touch_low'][rows] = np.maximum(p['touch_low'][rows], np.where(touching, errors, -np.inf))
+      p['touch_high'][rows] = np.minimum(p['touch_high'][rows], np.where(touching, np.inf, errors))
+      breaks_first = before_breakout & breaking
+      p['breakout'][rows[breaks_first]] = k
+      p['breakout_high'][rows[breaks_first]] = excess[breaks_first]
+      calm = before_breakout & ~breaking
+      p['breakout_low'][rows[calm]] = np.maximum(p['breakout_low'][rows[calm]], excess[calm])
+    else:
+      # Ranges stay valid without the candle, but the first breakout has to be found again
+      stale[rows[p['breakout'][rows] == k]] = True
+
+    for r in rows[touching & ~stale[rows]].tolist():
+      touches = p['touches'][r]
+      if touches is None: continue
+      if sign > 0:
+        bisect.insort(touches, k + self.num_evicted)
+      else:
+        touches.remove(k + self.num_evicted)
+    return stale
+
+  def _scan(self, detector, prices, i, j, m):
+    '''
+    Counts the touches of the lines of pairs (i, j) and finds their first breakouts from
+    scratch, the way the scans of detect(...) check a pair, along with the threshold ranges
+    these hold for. Uses kernels.scan_pairs when numba is installed. When ignoring breakouts
+    the kernel stops at the first breakout, as those pairs are parked
+    '''
+    n = len(prices)
+    is_checked = self.is_pivot[:n] if detector.last_pt_must_be_pivot else np.ones(n, dtype=bool)
+    if kernels.HAS_NUMBA:
+      return kernels.scan_pairs(
+        prices, is_checked, i, j, m, _kernel_trend_code(self.trend_type),
+        float(self.error_threshold), float(self.breakout_threshold), bool(detector.ignore_breakouts),
+      )
+
+    count = np.zeros(len(i), dtype=np.int64)
+    breakout = np.full(len(i), -1, dtype=np.int64)
+    touch_low = np.full(len(i), -np.inf)
+    touch_high = np.full(len(i), np.inf)
+    breakout_low = np.full(len(i), -np.inf)
+    breakout_high = np.full(len(i), np.inf)
+
+    ks = np.arange(n)
+    block_size = max(1, NUMPY_SCAN_BLOCK_SIZE // n)
+    for block_start in range(0, len(i), block_size):
+      block = slice(block_start, block_start + block_size)
+      block_i = i[block]
+      block_rows = np.arange(len(block_i))
+
+      eligible = (ks[None, :] > block_i[:, None]) & (ks[None, :] != j[block][:, None]) & is_checked[None, :]
+      trend_prices = prices[block_i][:, None] + m[block][:, None] * (ks[None, :] - block_i[:, None])
+      errors = np.abs(trend_prices - prices[None, :])
+      excess = self._excess(trend_prices, prices[None, :])
+      touching = eligible & (errors < self.error_threshold)
+      breaking = eligible & (excess > self.breakout_threshold)
+      has_breakout = breaking.any(axis=1)
+      first_breakout = np.where(has_breakout, breaking.argmax(axis=1), n)
+      before_breakout = eligible & (ks[None, :] < first_breakout[:, None])
+
+      count[block] = touching.sum(axis=1)
+      breakout[block] = np.where(has_breakout, first_breakout, -1)
+      touch_low[block] = np.where(touching, errors, -np.inf).max(axis=1)
+      touch_high[block] = np.where(eligible & ~touching, errors, np.inf).min(axis=1)
+      breakout_low[block] = np.where(before_breakout, excess, -np.inf).max(axis=1)
+      breakout_high[block] = np.where(has_breakout, excess[block_rows, np.minimum(first_breakout, n - 1)], np.inf)
+
+    return count, breakout, touch_low, touch_high, breakout_low, breakout_high
+
+  def _fill_touches(self, detector, prices, rows):
+    # Touch lists of rows, found for a block of rows at a time like the counts in _scan
+    p = self.pairs.columns()
+    n = len(prices)
+    ks = np.arange(n)
+    block_size = max(1, NUMPY_SCAN_BLOCK_SIZE // max(n, 1))
+    for block_start in range(0, len(rows), block_size):
+      block = rows[block_start:block_start + block_size]
+      trend_prices = self._trend_prices(prices, block, ks)
+      touching = self._eligible(detector, block, n) & (np.abs(trend_prices - prices[None, :]) < self.error_threshold)
+      touch_rows, touch_ks = np.nonzero(touching)
+      touch_ends = np.searchsorted(touch_rows, np.arange(1, len(block) + 1))
+      touch_ks = (touch_ks + self.num_evicted).tolist()
+
+      touch_start = 0
+      for row, r in enumerate(block.tolist()):
+        p['touches'][r] = touch_ks[touch_start:touch_ends[row]]
+        touch_start = touch_ends[row]
+
+  def _eligible(self, detector, rows, n):
+    # Candles checked for touches and breakouts of each of rows, as in detect(...)
+    p = self.pairs.columns()
+    ks = np.arange(n)
+    eligible = (ks[None, :] > p['i'][rows][:, None]) & (ks[None, :] != p['j'][rows][:, None])
+    if detector.last_pt_must_be_pivot:
+      eligible &= self.is_pivot[:n][None, :]
+    return eligible
+
+  def _trend_prices(self, prices, rows, ks):
+    # Prices of the lines of rows at candles ks, a row per pair when ks is an array
+    p = self.pairs.columns()
+    i = p['i'][rows]
+    if np.ndim(ks) == 0:
+      return prices[i] + p['m'][rows] * (ks - i)
+    return prices[i][:, None] + p['m'][rows][:, None] * (ks[None, :] - i[:, None])
+
+  def _excess(self, trend_prices, prices):
+    # How far prices break through the lines, compared against the breakout tolerance
+    if self.trend_type == structs.TrendlineTypes.RESISTANCE:
+      return prices - trend_prices
+    return trend_prices - prices
+
+def _diff_trendlines(previous, current):
+  previous_rows = {}
+  for row in previous[['id'] + CHANGE_COLUMNS].itertuples(index=False):
+    previous_rows[row[0]] = tuple(row[1:])
+
+  changed = []
+  for position, row in enumerate(current[['id'] + CHANGE_COLUMNS].itertuples(index=False)):
+    if previous_rows.get(row[0]) != tuple(row[1:]):
+      changed.append(position)
+
+  current_ids = set(current['id'])
+  removed = [trend_id for trend_id in previous_rows if trend_id not in current_ids]
+  return current.iloc[changed], removed
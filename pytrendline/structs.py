@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_datetime64_any_dtype as is_datetime
 import datetime
@@ -9,6 +10,94 @@ class TrendlineTypes(object):
   SUPPORT = 'SUPPORT'
   BOTH = 'BOTH'
 
+class ScanEngines(object):
+  PYTHON = 'python'
+  NUMPY = 'numpy'
+  # Compiled with numba when it is installed, otherwise falls back to NUMPY
+  NUMBA = 'numba'
+
+VALID_SCAN_ENGINES = [ScanEngines.PYTHON, ScanEngines.NUMPY, ScanEngines.NUMBA]
+
+class ConcurrencyModes(object):
+  NONE = 'none'
+  # Support pass in a second thread. Only overlaps with ScanEngines.NUMBA, whose kernels release
+  # the GIL, the passes of the other engines run one after the other
+  THREADS = 'threads'
+  # Support scan in a worker process, started once with forkserver (or spawn) and reused
+  PROCESSES = 'processes'
+
+VALID_CONCURRENCY_MODES = [ConcurrencyModes.NONE, ConcurrencyModes.THREADS, ConcurrencyModes.PROCESSES]
+
+class ResultFormats(object):
+  # Trendlines as pandas dataframes
+  DATAFRAME = 'dataframe'
+  # Trendlines as results.CompactTrendlines, see its docstring
+  COMPACT = 'compact'
+
+VALID_RESULT_FORMATS = [ResultFormats.DATAFRAME, ResultFormats.COMPACT]
+
+class PlotResources(object):
+  # BokehJS is loaded from the Bokeh CDN
+  CDN = 'cdn'
+  # BokehJS is embedded in every HTML file
+  INLINE = 'inline'
+  # BokehJS is copied once into the output directory and shared by every HTML file written there
+  SHARED = 'shared'
+
+VALID_PLOT_RESOURCES = [PlotResources.CDN, PlotResources.INLINE, PlotResources.SHARED]
+
+class DetectStats():
+  '''
+  Timings (in seconds) and counters of one SUPPORT or RESISTANCE pass of detect(...),
+  returned when detect is called with collect_stats=True.
+
+  Timings:
+    pivots            - get_pivots
+    scan              - the whole candidate line scan, made of:
+    pair_enumeration  - enumerating (i, j) pairs and checking their slope and last price
+    touch_counting    - counting the touches and breakouts of the pairs that pass
+    dedup             - skipping pointsets already found through another (i, j) pair
+    scoring           - computing the error distances and score of kept lines
+    duplicate_marking - grouping near identical lines and ranking them
+    total             - the whole pass
+
+  The numba engine runs the scan as one compiled call, so it leaves pair_enumeration
+  and touch_counting as None.
+
+  Counters:
+    pairs_tested              - (i, j) pairs enumerated
+    pairs_pruned_slope        - pairs outside the allowed slope
+    pairs_pruned_price        - pairs with an allowed slope but a last price out of range
+    pairs_rejected_min_points - pairs with fewer than min_points_required points
+    candidates                - lines with enough points, before any other rule
+    breakouts                 - candidates that break out. With ignore_breakouts, lines are
+                                dropped by the scan as soon as they break out, so this counts
+                                every pair that breaks out and none of them are candidates
+    pointset_duplicates       - candidates dropped because their pointset was already found
+    trendlines                - trendlines returned
+    duplicates                - returned trendlines that are not best of their duplicate group
+  '''
+  TIMINGS = ['pivots', 'scan', 'pair_enumeration', 'touch_counting', 'dedup', 'scoring', 'duplicate_marking', 'total']
+  COUNTERS = [
+    'pairs_tested', 'pairs_pruned_slope', 'pairs_pruned_price', 'pairs_rejected_min_points',
+    'candidates', 'breakouts', 'pointset_duplicates', 'trendlines', 'duplicates',
+  ]
+
+  def __init__(self, trend_type):
+    self.trend_type = trend_type
+    self.timings = {name: 0.0 for name in DetectStats.TIMINGS}
+    self.counters = {name: 0 for name in DetectStats.COUNTERS}
+
+  def as_dict(self):
+    return {
+      'trend_type': self.trend_type,
+      'timings': dict(self.timings),
+      'counters': dict(self.counters),
+    }
+
+  def __repr__(self):
+    return "DetectStats({})".format(self.as_dict())
+
 class CandlestickData():
   def __init__(
     self,
@@ -18,7 +107,8 @@ class CandlestickData():
     high_col="High", # name of the column containing candle "High" price
     low_col="Low", # name of the column containing candle "Low" price
     close_col="Close", # name of the column containing candle "Close" price
-    datetime_col=None # name of the column containing candle datetime price (use none if datetime is in index)
+    datetime_col=None, # name of the column containing candle datetime price (use none if datetime is in index)
+    copy=True, # set to False to share the data of df instead of copying it
   ):
     # Validate dataframe nonempty and has at least 3 entries
     if df is None or len(df)<3:
@@ -33,12 +123,13 @@ class CandlestickData():
       ))
 
     # Price column names provided exist and are in correct format
+    dtypes = df.dtypes
     for col_name in [open_col, high_col, low_col, close_col]:
-      if col_name not in df.columns:
+      if col_name not in dtypes:
         raise Exception("CandlestickData constructor param df does not contain column '{}'".format(
           col_name
         ))
-      if df[col_name].dtypes != float:
+      if dtypes[col_name] != float:
         raise Exception("CandlestickData constructor param df requires that column '{}' is of type float".format(
           col_name
         ))
@@ -51,33 +142,33 @@ class CandlestickData():
           "Instead received df index of {} type".format(str(type(df.index)))
         )
     else:
-      if datetime_col not in df.columns:
+      if datetime_col not in dtypes:
         raise Exception("CandlestickData constructor param df does not contain datetime_col '{}'".format(
           datetime_col
         ))
-      if not is_datetime(df[datetime_col]):
+      if not is_datetime(dtypes[datetime_col]):
         raise Exception("CandlestickData constructor param df requires that column '{}' be of type datetime, received {}".format(
           datetime_col, df[datetime_col].dtypes
         ))
 
-    # Instantiate
-    self.df = df.copy(deep=True)
-
-    self.df = self.df.rename(columns={
+    # Instantiate. rename returns a new frame, which only copies the data of df when copy is set
+    columns = {
       open_col: "Open",
       high_col: "High",
       low_col: "Low",
       close_col: "Close",
-    })
+    }
+    if datetime_col != None:
+      columns[datetime_col] = "Date"
+    self._arrays = None
+    self.df = df.rename(columns=columns, copy=copy)
 
-    # Force index to be monotinically increasing int
+    # Move a datetime index to the Date column, so that candles are indexed by position.
+    # Only the new frame is changed, df keeps its index
     if datetime_col == None:
-      self.df.set_index(datetime_col)
-      self.df = self.df.rename(columns = {'index':'Date'})
-    else:
-      self.df.rename(columns={datetime_col: "Date"})
-    
-    self.df.reset_index()
+      dates = self.df.index
+      self.df.index = pd.RangeIndex(len(dates))
+      self.df.insert(0, "Date", dates)
 
     self.time_interval = time_interval
     self.open_col = open_col
@@ -86,6 +177,127 @@ class CandlestickData():
     self.close_col = close_col
     self.datetime_col = datetime_col
 
+  @classmethod
+  def from_arrays(
+    cls,
+    open,
+    high,
+    low,
+    close,
+    dates,
+    time_interval="1m", # choose between 1m,3m,5m,10m,15m,30m,1h,1d
+  ):
+    '''
+    Builds CandlestickData straight from price arrays and a datetime64 array (or DatetimeIndex)
+    of candle dates, without building a dataframe. Float64 arrays are used as they are, not
+    copied. df is built from the arrays the first time it is used
+    '''
+    if time_interval not in VALID_TIME_INTERVALS:
+      raise Exception("CandlestickData.from_arrays param time_interval must be one of :\n{}".format(
+        VALID_TIME_INTERVALS
+      ))
+
+    arrays = {}
+    for name, values in [("Open", open), ("High", high), ("Low", low), ("Close", close)]:
+      arrays[name] = np.asarray(values, dtype=float)
+      if arrays[name].ndim != 1:
+        raise Exception("CandlestickData.from_arrays param {} must be a one dimensional array".format(name.lower()))
+
+    if not is_datetime(dates):
+      raise Exception("CandlestickData.from_arrays param dates must be of datetime type, received {}".format(
+        getattr(dates, 'dtype', type(dates))
+      ))
+
+    num_candles = len(dates)
+    if num_candles < 3:
+      raise Exception("CandlestickData.from_arrays needs at least three candles, received {}".format(num_candles))
+    if any(len(values) != num_candles for values in arrays.values()):
+      raise Exception("CandlestickData.from_arrays params open, high, low, close and dates must have the same length")
+
+    candlestick_data = cls.__new__(cls)
+    candlestick_data._df = None
+    candlestick_data._stats = {}
+    candlestick_data._arrays = arrays
+    candlestick_data._arrays["Date"] = dates
+
+    candlestick_data.time_interval = time_interval
+    candlestick_data.open_col = "Open"
+    candlestick_data.high_col = "High"
+    candlestick_data.low_col = "Low"
+    candlestick_data.close_col = "Close"
+    candlestick_data.datetime_col = "Date"
+    return candlestick_data
+
+  @property
+  def df(self):
+    if self._df is None:
+      self._df = pd.DataFrame({
+        "Date": self.dates(),
+        "Open": self._arrays["Open"],
+        "High": self._arrays["High"],
+        "Low": self._arrays["Low"],
+        "Close": self._arrays["Close"],
+      })
+    return self._df
+
+  @df.setter
+  def df(self, df):
+    # Summary statistics are computed lazily and kept until the frame is replaced
+    self._df = df
+    self._arrays = None
+    self._stats = {}
+
+  def invalidate_stats(self):
+    # Call after modifying self.df in place so that cached statistics are recomputed
+    if self._df is not None:
+      self._arrays = None
+    self._stats = {}
+
+  def avg_candle_range(self):
+    if 'avg_candle_range' not in self._stats:
+      if self._df is None:
+        # Same as the pandas mean below, which skips NaN ranges
+        self._stats['avg_candle_range'] = max(np.nanmean(self.highs() - self.lows()), 0.01)
+      else:
+        self._stats['avg_candle_range'] = max((self._df.High - self._df.Low).mean(), 0.01)
+    return self._stats['avg_candle_range']
+
+  def last_close(self):
+    if 'last_close' not in self._stats:
+      self._stats['last_close'] = self.closes()[-1] if self._df is None else self._df.Close.iloc[-1]
+    return self._stats['last_close']
+
+  # Contiguous read-only arrays of the candle columns, created once and indexed by candle position
+  def opens(self):
+    return self._column_array('Open')
+
+  def highs(self):
+    return self._column_array('High')
+
+  def lows(self):
+    return self._column_array('Low')
+
+  def closes(self):
+    return self._column_array('Close')
+
+  def dates(self):
+    # Kept as a DatetimeIndex so that fancy indexing still yields Timestamps (timezone included)
+    if 'dates' not in self._stats:
+      self._stats['dates'] = pd.DatetimeIndex(self._df.Date if self._arrays is None else self._arrays["Date"])
+    return self._stats['dates']
+
+  def _column_array(self, col):
+    key = 'array_' + col
+    if key not in self._stats:
+      if self._arrays is None:
+        values = np.ascontiguousarray(self._df[col].to_numpy(dtype=float))
+      else:
+        # A view, so that the caller's array stays writeable
+        values = np.ascontiguousarray(self._arrays[col]).view()
+      values.flags.writeable = False
+      self._stats[key] = values
+    return self._stats[key]
+
   def time_interval_min(self):
     if 'm' in self.time_interval:
       return int(self.time_interval[:-1])
@@ -16,10 +16,16 @@ def find_maxs_or_mins_in_series(series, kind, tolerance_threshold):
 
 # Find the average distance between High and Low price in a set of candles
 def avg_candle_range(candles):
-  return max((candles.df.High - candles.df.Low).mean(), 0.01)
+  return candles.avg_candle_range()
 
 # Find mean in a list of int or floats
 def mean(ls):
   total = 0
   for n in ls: total+=n
-  return total/len(ls)
\ No newline at end of file
+  return total/len(ls)
+
+# Slope and intercept of the line through (x0, y0) and (x1, y1). Works on scalars and numpy
+# arrays alike, and is the one formula used for the lines of detect, stream and plot
+def line_through(x0, y0, x1, y1):
+  m = (y1 - y0) / (x1 - x0)
+  return m, y0 - m * x0
@@ -27,5 +27,8 @@ setup(
         'datetime>=4.3',
         'bokeh>=2.0.2',
         'colour>=0.1.5',
-    ]
+    ],
+    extras_require={
+        'numba': ['numba>=0.50'],
+    }
 )
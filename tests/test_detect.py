@@ -1,12 +1,20 @@
 import os
+import sys
+import tempfile
+import threading
 
 # Core lib
 import pandas as pd
+import numpy as np
+import pytest
 from dataclasses import dataclass
 
 
 # Lib imports
-from pytrendline import structs, detect, plot
+from pytrendline import structs, kernels, detect, plot, get_pivots, StreamingDetector, SlidingWindowDetector, detect_many, plot_many, CompactTrendlines, CandleStore
+from pytrendline.detect import DEFAULT_CONFIG, DUPLICATE_TIE_SLACK, resolve_config, _mark_duplicates, _pivot_mask, _kernel_trend_code, _scan_numba, _scan_numpy
+from pytrendline.plot import _candle_buckets, _nice_tick_interval, _tick_mantissas
+from pytrendline.results import with_dataframes
 from fixtures import testcases
 
 @dataclass
@@ -259,3 +267,758 @@ def test_findtrends():
       if trend.is_breakout: assert result_trend["breakout_index"] == trend.breakout_index, "Expected trend with id {} to have breakout index at {}".format(trend.trend_id, trend.breakout_index)
       assert result_trend["overall_rank"] == trend.overall_rank, "Expected trend with id {} to have overall_rank of {}, received {}".format(trend.trend_id, trend.overall_rank, result_trend["overall_rank"])
       assert result_trend["rank_within_group"] == trend.rank_within_group, "Expected trend with id {} to have rank_within_group of {}".format(trend.trend_id, trend.rank_within_group)
+
+
+def test_get_pivots():
+  tests = [
+    {"candles": testcases.ONE_PIVOT_LOW_AND_HIGH, "support_pivots": {0, 2, 5}, "resistance_pivots": {0, 3, 5}},
+    {"candles": testcases.NO_PIVOTS_EXCEPT_FOR_START_END, "support_pivots": {0, 5}, "resistance_pivots": {0, 5}},
+  ]
+
+  for test in tests:
+    support_pivots = get_pivots(test["candles"], structs.TrendlineTypes.SUPPORT, 0)
+    resistance_pivots = get_pivots(test["candles"], structs.TrendlineTypes.RESISTANCE, 0)
+
+    assert support_pivots == test["support_pivots"], "Expected support pivots {}, received {}".format(test["support_pivots"], support_pivots)
+    assert resistance_pivots == test["resistance_pivots"], "Expected resistance pivots {}, received {}".format(test["resistance_pivots"], resistance_pivots)
+
+
+def _original_get_pivots(candles, trend_type, scan_from_index):
+  # Pivots found by the original loop of get_pivots, which read the prices one point at a
+  # time through the labels of the series sliced at scan_from_index
+  config = resolve_config(candles, DEFAULT_CONFIG)
+  separation_thres = config.pivot_seperation_threshold
+  grouping_thres = config.pivot_grouping_threshold
+
+  col = "Low" if trend_type == structs.TrendlineTypes.SUPPORT else "High"
+  pseries = candles.df[col][scan_from_index:]
+  pivots = set([])
+  max_number_continuous_pivots = 6
+
+  first_index = pseries.index[0]
+  last_index = pseries.index[-1]
+
+  for i in range(first_index+1,last_index):
+    pcur = pseries[i]
+
+    j = 1
+    while j < max_number_continuous_pivots and (i + j) < len(pseries) - 1:
+      if abs(pseries[i + j - 1] - pseries[i + j]) < grouping_thres:
+        j += 1
+      else:
+        break
+
+    pnext = pseries[i + j]
+
+    j = 1
+    while j < max_number_continuous_pivots and (i - j) > first_index:
+      if abs(pseries[i - j + 1] - pseries[i - j]) < grouping_thres:
+        j += 1
+      else:
+        break
+
+    pprev = pseries[i - j]
+
+    if trend_type == structs.TrendlineTypes.RESISTANCE and \
+      (pprev > pcur or pnext > pcur): continue
+    elif trend_type == structs.TrendlineTypes.SUPPORT and \
+      (pprev < pcur or pnext < pcur): continue
+
+    if abs(pcur - pprev) > separation_thres * (1/4) and abs(pcur - pnext) > separation_thres * (3/4):
+      pivots.add(i)
+    elif abs(pcur - pprev) > separation_thres * (3/4) and abs(pcur - pnext) > separation_thres * (1/4):
+      pivots.add(i)
+
+  # Always include last point and first point as pivots
+  pivots.add(first_index)
+  pivots.add(last_index)
+  return pivots
+
+
+def test_get_pivots_match_original():
+  rng = np.random.RandomState(5)
+
+  for _ in range(100):
+    num_candles = rng.randint(3, 60)
+    close = 100 + np.cumsum(rng.normal(0, 1, num_candles))
+    # Plateaus of repeated prices, and prices rounded to one decimal, make runs of grouped points
+    for t in np.flatnonzero(rng.rand(num_candles) < 0.3):
+      close[t] = close[t - 1] if t > 0 else close[t]
+    spread = np.where(rng.rand(num_candles) < 0.5, 0, rng.uniform(0, 1, num_candles))
+    candles = structs.CandlestickData(
+      df=pd.DataFrame({
+        'Date': pd.date_range('2020-01-01 09:30', periods=num_candles, freq='1min'),
+        'Open': np.round(close, 1),
+        'High': np.round(close + spread, 1),
+        'Low': np.round(close - spread, 1),
+        'Close': np.round(close, 1),
+      }),
+      time_interval='1m',
+      datetime_col="Date",
+    )
+    scan_from_index = rng.randint(0, num_candles - 1)
+
+    for trend_type in [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE]:
+      expected = _original_get_pivots(candles, trend_type, scan_from_index)
+      for engine in structs.VALID_SCAN_ENGINES:
+        pivots = get_pivots(candles, trend_type, scan_from_index, engine=engine)
+        assert pivots == expected, "Expected {} pivots {} from index {} with engine {}, received {}".format(
+          trend_type, sorted(expected), scan_from_index, engine, sorted(pivots)
+        )
+
+
+def _assert_results_equal(expected, actual):
+  for key in ('support_trendlines', 'resistance_trendlines'):
+    if key not in expected: continue
+    assert list(expected[key]['id']) == list(actual[key]['id']), "Expected {} ids to match".format(key)
+    pd.testing.assert_frame_equal(expected[key], actual[key])
+
+  for key in ('support_pivots', 'resistance_pivots'):
+    if key not in expected: continue
+    assert expected[key] == actual[key], "Expected {} to match".format(key)
+
+
+def test_scan_engines_agree():
+  tests = [
+    {"candles": testcases.TWO_SUP_AND_ONE_RES_TREND_1d, "ignore_breakouts": False},
+    {"candles": testcases.NO_TREND_DUE_BREAKOUT_5m, "ignore_breakouts": False},
+    {"candles": testcases.RANDOM_WALK_1m},
+    {"candles": testcases.RANDOM_WALK_1m, "last_pt_must_be_pivot": True, "ignore_breakouts": False},
+    {"candles": testcases.RANDOM_WALK_1m, "all_pts_must_be_pivots": True, "min_points_required": 2},
+    {"candles": testcases.RANDOM_WALK_1m, "trendline_must_include_global_maxmin_pt": True},
+    {
+      "candles": testcases.RANDOM_WALK_1m,
+      "ignore_breakouts": False,
+      "config": {
+        "min_allowable_support_slope": lambda candles: 0.0,
+        "max_allowable_resistance_slope": lambda candles: 0.0,
+      },
+    },
+  ]
+
+  for test in tests:
+    kwargs = dict(test)
+    candles = kwargs.pop("candles")
+
+    expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, engine=structs.ScanEngines.PYTHON, **kwargs)
+
+    # The numba engine falls back to numpy when numba is not installed
+    for engine in [structs.ScanEngines.NUMPY, structs.ScanEngines.NUMBA]:
+      actual = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, engine=engine, **kwargs)
+      _assert_results_equal(expected, actual)
+
+
+def test_threshold_ties_agree_across_engines():
+  # Prices on a 0.1 grid put many candles exactly max_allowable_error_pt_to_trend away from
+  # lines, and many lines exactly duplicate_grouping_threshold_last_price apart
+  config = {
+    "max_allowable_error_pt_to_trend": lambda candles: 0.10,
+    "duplicate_grouping_threshold_last_price": lambda candles: 0.40,
+  }
+  tests = [
+    {"candles": testcases.RANDOM_WALK_1m, "ignore_breakouts": False},
+    {"candles": testcases.get_random_walk_candlestick_data('1m', 90, seed=3)},
+    {"candles": testcases.get_random_walk_candlestick_data('1m', 90, seed=3), "ignore_breakouts": False, "last_pt_must_be_pivot": True},
+    {"candles": testcases.get_random_walk_candlestick_data('1m', 60, seed=2), "min_points_required": 4, "ignore_breakouts": False},
+  ]
+
+  for test in tests:
+    kwargs = dict(test)
+    candles = kwargs.pop("candles")
+
+    expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, engine=structs.ScanEngines.PYTHON, config=config, **kwargs)
+    for engine in [structs.ScanEngines.NUMPY, structs.ScanEngines.NUMBA]:
+      actual = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, engine=engine, config=config, **kwargs)
+      _assert_results_equal(expected, actual)
+
+
+def _original_duplicate_group_ids(slopes, prices, is_breakout, trend_type, slope_thres, price_thres):
+  # Group ids as assigned by the original O(n^2) clustering in _mark_duplicates, with
+  # differences within DUPLICATE_TIE_SLACK of the thresholds counted as matching
+  slope_thres = slope_thres * (1 + DUPLICATE_TIE_SLACK)
+  price_thres = price_thres * (1 + DUPLICATE_TIE_SLACK)
+  group_ids = [None] * len(slopes)
+  group_idx = 1000 if trend_type == structs.TrendlineTypes.RESISTANCE else 2000
+
+  for i in range(len(slopes)):
+    best_matching_idx = -1
+    for j in range(len(slopes)):
+      if i == j: continue
+      if abs(prices[i] - prices[j]) < price_thres and abs(slopes[i] - slopes[j]) < slope_thres and is_breakout[i] == is_breakout[j]:
+        best_matching_idx = j
+        break
+
+    if best_matching_idx != -1:
+      this_row_group = group_ids[i]
+      best_matching_row_group = group_ids[best_matching_idx]
+      group_id_for_pair = best_matching_row_group if best_matching_row_group is not None else group_idx
+
+      if best_matching_row_group is None:
+        group_ids[best_matching_idx] = group_id_for_pair
+
+      if this_row_group is None:
+        group_ids[i] = group_id_for_pair
+      else:
+        group_ids = [group_id_for_pair if group_id == this_row_group else group_id for group_id in group_ids]
+    else:
+      group_ids[i] = group_idx
+    group_idx += 1
+
+  return group_ids
+
+
+def _original_ranks_within_group(trends_df):
+  # Ranks of the original loop, which sorted the rows of each group by descending score
+  ranks = pd.Series(0, index=trends_df.index)
+  for group_id, df_group in trends_df.groupby('duplicate_group_id'):
+    group_rank = 1
+    for row_index, row in df_group.sort_values(by='score', ascending=False).iterrows():
+      ranks[row_index] = group_rank
+      group_rank += 1
+  return list(ranks)
+
+
+def test_duplicate_groups_match_original():
+  slope_thres, price_thres = 0.1, 0.4
+  config = {
+    "duplicate_grouping_threshold_slope": lambda candles: slope_thres,
+    "duplicate_grouping_threshold_last_price": lambda candles: price_thres,
+  }
+  rng = np.random.default_rng(0)
+
+  for trial in range(100):
+    num_rows = int(rng.integers(2, 80))
+    trend_type = structs.TrendlineTypes.SUPPORT if trial % 2 else structs.TrendlineTypes.RESISTANCE
+
+    # Clusters of lines around a few (slope, price) centers, rounded on every other trial so
+    # that some differences land exactly on the thresholds
+    centers = rng.normal(0, 1, (int(rng.integers(1, 6)), 2))
+    cluster = rng.integers(0, len(centers), num_rows)
+    slopes = centers[cluster, 0] + rng.normal(0, 0.05, num_rows)
+    prices = centers[cluster, 1] * 3 + 100 + rng.normal(0, 0.3, num_rows)
+    if trial % 2 == 0:
+      slopes, prices = np.round(slopes, 1), np.round(prices, 1)
+    is_breakout = rng.random(num_rows) < 0.3
+
+    trends_df = pd.DataFrame({
+      'slope': slopes,
+      'price_at_last_date': prices,
+      'is_breakout': is_breakout,
+      # Few distinct scores, so that groups larger than 16 rows hold ties
+      'score': np.round(rng.random(num_rows), 1),
+      'duplicate_group_id': pd.Series([None] * num_rows, dtype=object),
+      'is_best_from_duplicate_group': np.zeros(num_rows, dtype=bool),
+      'overall_rank': pd.Series([None] * num_rows, dtype=object),
+      'rank_within_group': np.zeros(num_rows, dtype=np.int64),
+    })
+    marked = _mark_duplicates(trends_df, testcases.RANDOM_WALK_1m, trend_type, config)
+
+    expected = _original_duplicate_group_ids(slopes, prices, is_breakout, trend_type, slope_thres, price_thres)
+    assert list(marked['duplicate_group_id']) == expected, "Expected group ids of trial {} to match the original clustering".format(trial)
+    assert list(marked['rank_within_group']) == _original_ranks_within_group(marked), \
+      "Expected ranks within groups of trial {} to break ties like the original".format(trial)
+
+  # Lines a threshold apart group together whichever way rounding went
+  num_rows = 3
+  trends_df = pd.DataFrame({
+    'slope': [0.7, 0.8, 0.6],
+    'price_at_last_date': [100.0, 100.4, 99.6],
+    'is_breakout': np.zeros(num_rows, dtype=bool),
+    'score': [1.0, 2.0, 3.0],
+    'duplicate_group_id': pd.Series([None] * num_rows, dtype=object),
+    'is_best_from_duplicate_group': np.zeros(num_rows, dtype=bool),
+    'overall_rank': pd.Series([None] * num_rows, dtype=object),
+    'rank_within_group': np.zeros(num_rows, dtype=np.int64),
+  })
+  marked = _mark_duplicates(trends_df, testcases.RANDOM_WALK_1m, structs.TrendlineTypes.SUPPORT, config)
+  assert len(set(marked['duplicate_group_id'])) == 1, "Expected lines a threshold apart to be grouped"
+
+
+def _original_pivot_scan(candles, trend_type, pivots, first_pt_must_be_pivot, last_pt_must_be_pivot, all_pts_must_be_pivots, min_points_required):
+  # Ids and breakout indeces of the lines found by the original scan, which tested every
+  # index for pivot set membership instead of iterating over the sorted pivots
+  config = resolve_config(candles, DEFAULT_CONFIG)
+  prices = candles.df["Low" if trend_type == structs.TrendlineTypes.SUPPORT else "High"].to_numpy()
+  min_slope, max_slope = config.slope_limits(trend_type)
+  min_last_price, max_last_price = config.last_price_limits(trend_type)
+  last_index = len(prices) - 1
+
+  lines = {}
+  for i in range(len(prices)):
+    if (first_pt_must_be_pivot or all_pts_must_be_pivots) and i not in pivots: continue
+    for j in range(i + 1, len(prices)):
+      if (last_pt_must_be_pivot or all_pts_must_be_pivots) and j not in pivots: continue
+
+      m = (prices[j] - prices[i]) / (j - i)
+      b = prices[i] - m * i
+      slope = m * config.avg_candle_range
+      if slope > max_slope or slope < min_slope: continue
+      if m * last_index + b > max_last_price or m * last_index + b < min_last_price: continue
+
+      points = [i, j]
+      breakout_index = None
+      for k in range(i, len(prices)):
+        if last_pt_must_be_pivot and k not in pivots: continue
+        if k == i or k == j: continue
+        trend_price_at_k = prices[i] + m * (k - i)
+        if breakout_index is None:
+          if trend_type == structs.TrendlineTypes.RESISTANCE and prices[k] - trend_price_at_k > config.breakout_tolerance or \
+              trend_type == structs.TrendlineTypes.SUPPORT and trend_price_at_k - prices[k] > config.breakout_tolerance:
+            breakout_index = k
+        if abs(trend_price_at_k - prices[k]) < config.max_allowable_error_pt_to_trend:
+          points.append(k)
+
+      if len(points) < min_points_required: continue
+      pointset_id = ("R" if trend_type == structs.TrendlineTypes.RESISTANCE else "S") + "-[" + ",".join(str(p) for p in sorted(points)) + "]"
+      lines.setdefault(pointset_id, breakout_index)
+
+  return lines
+
+
+def test_pivot_modes_match_original_scan():
+  fixtures = [
+    testcases.TWO_SUP_AND_ONE_RES_TREND_1d,
+    testcases.NO_TREND_DUE_BREAKOUT_5m,
+    testcases.RANDOM_WALK_1m,
+    testcases.get_random_walk_candlestick_data('1m', 90, seed=3),
+  ]
+  modes = [
+    {"first_pt_must_be_pivot": True},
+    {"last_pt_must_be_pivot": True},
+    {"all_pts_must_be_pivots": True},
+    {"first_pt_must_be_pivot": True, "last_pt_must_be_pivot": True},
+  ]
+
+  for candles in fixtures:
+    for mode in modes:
+      for min_points_required in [2, 3]:
+        flags = dict({"first_pt_must_be_pivot": False, "last_pt_must_be_pivot": False, "all_pts_must_be_pivots": False}, **mode)
+
+        for engine in structs.VALID_SCAN_ENGINES:
+          results = detect(
+            candlestick_data=candles,
+            trend_type=structs.TrendlineTypes.BOTH,
+            min_points_required=min_points_required,
+            ignore_breakouts=False,
+            engine=engine,
+            **flags,
+          )
+
+          for trend_type, prefix in [(structs.TrendlineTypes.SUPPORT, 'support'), (structs.TrendlineTypes.RESISTANCE, 'resistance')]:
+            expected = _original_pivot_scan(candles, trend_type, results[prefix + '_pivots'], min_points_required=min_points_required, **flags)
+            trends_df = results[prefix + '_trendlines']
+            actual = {
+              trend_id: None if pd.isna(breakout_index) else int(breakout_index)
+              for trend_id, breakout_index in zip(trends_df['id'], trends_df['breakout_index'])
+            }
+            assert actual == expected, "Expected {} lines of {} with {} to match the original scan".format(prefix, engine, mode)
+
+
+def test_numba_kernels():
+  pytest.importorskip('numba')
+  candles = testcases.get_random_walk_candlestick_data('1m', 90, seed=3)
+  config = resolve_config(candles, DEFAULT_CONFIG)
+  scan_options = [
+    {},
+    {"ignore_breakouts": True},
+    {"last_pt_must_be_pivot": True},
+    {"all_pts_must_be_pivots": True, "min_points_required": 2},
+    {"first_pt_must_be_pivot": True, "ignore_breakouts": True},
+  ]
+
+  for trend_type in [structs.TrendlineTypes.SUPPORT, structs.TrendlineTypes.RESISTANCE]:
+    prices = candles.lows() if trend_type == structs.TrendlineTypes.SUPPORT else candles.highs()
+
+    # Compiled pivot detection against the numpy version
+    is_pivot = kernels.pivot_mask(prices, _kernel_trend_code(trend_type), float(config.pivot_seperation_threshold), float(config.pivot_grouping_threshold), 0)
+    assert list(is_pivot) == list(_pivot_mask(prices, trend_type, config.pivot_seperation_threshold, config.pivot_grouping_threshold))
+    pivots = set(np.flatnonzero(is_pivot).tolist())
+
+    # Compiled scan against the numpy engine, line by line
+    for options in scan_options:
+      flags = dict({
+        "min_points_required": 3,
+        "first_pt_must_be_pivot": False,
+        "last_pt_must_be_pivot": False,
+        "all_pts_must_be_pivots": False,
+        "ignore_breakouts": False,
+      }, **options)
+      scan_args = (
+        config.max_allowable_error_pt_to_trend, config.breakout_tolerance,
+        *config.slope_limits(trend_type), *config.last_price_limits(trend_type),
+        config.avg_candle_range, len(prices) - 1, flags["min_points_required"],
+        flags["first_pt_must_be_pivot"], flags["last_pt_must_be_pivot"], flags["all_pts_must_be_pivots"], flags["ignore_breakouts"],
+      )
+      compiled = list(_scan_numba(prices, len(prices), 0, pivots, trend_type, *scan_args))
+      expected = list(_scan_numpy(prices, 0, pivots, trend_type, *scan_args))
+
+      assert len(compiled) > 0
+      assert [line[:2] + line[4:] for line in compiled] == [line[:2] + line[4:] for line in expected], \
+        "Expected the compiled scan to find the numpy lines for {} with {}".format(trend_type, options)
+
+  # Both kernels ran compiled, not as their python fallbacks
+  assert kernels.HAS_NUMBA
+  assert len(kernels.pivot_mask.signatures) > 0 and len(kernels.scan.signatures) > 0
+
+
+def test_streaming_detector():
+  tests = [
+    {},
+    {"ignore_breakouts": False},
+    {"last_pt_must_be_pivot": True, "ignore_breakouts": False},
+    # Fixed thresholds, where appends never rescan the existing pairs
+    {"ignore_breakouts": False, "config": {"max_allowable_error_pt_to_trend": lambda candles: 0.1, "breakout_tolerance": lambda candles: 0.1}},
+  ]
+  candles_df = testcases.RANDOM_WALK_1m.df
+  initial_candles = structs.CandlestickData(df=candles_df.iloc[:30].reset_index(drop=True), time_interval='1m', datetime_col="Date")
+
+  for test in tests:
+    detector = StreamingDetector(candlestick_data=initial_candles, trend_type=structs.TrendlineTypes.BOTH, **test)
+    for end in range(31, len(candles_df) + 1):
+      changes = detector.append(candles_df.iloc[end - 1])
+
+      # Every row returned by an append must be part of the full results
+      results = detector.results()
+      assert set(changes['support_trendlines']['id']) <= set(results['support_trendlines']['id'])
+
+      # Thresholds follow the candles seen so far, as in detect(...) with the default config
+      candles = structs.CandlestickData(df=candles_df.iloc[:end].reset_index(drop=True), time_interval='1m', datetime_col="Date")
+      expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, **test)
+      _assert_results_equal(expected, results)
+
+      # Every pair is either kept or parked, and pairs that break out are not kept when ignoring breakouts
+      for state in detector._states:
+        assert state.pairs.size + state.parked.size == end * (end - 1) // 2
+        if test.get("ignore_breakouts", True):
+          assert (state.pairs.columns()['breakout'] < 0).all()
+
+
+def test_sliding_window_detector():
+  tests = [
+    {},
+    {"ignore_breakouts": False},
+    {"last_pt_must_be_pivot": True, "ignore_breakouts": False},
+    {"all_pts_must_be_pivots": True},
+    {"ignore_breakouts": False, "config": {"max_allowable_error_pt_to_trend": lambda candles: 0.1, "breakout_tolerance": lambda candles: 0.1}},
+  ]
+  candles_df = testcases.RANDOM_WALK_1m.df
+  window_size = 25
+  first_window = structs.CandlestickData(df=candles_df.iloc[:window_size].reset_index(drop=True), time_interval='1m', datetime_col="Date")
+
+  for test in tests:
+    detector = SlidingWindowDetector(candlestick_data=first_window, trend_type=structs.TrendlineTypes.BOTH, **test)
+    for start in range(1, len(candles_df) - window_size + 1):
+      results = detector.slide(candles_df.iloc[start + window_size - 1])
+
+      # Every window matches detect(...) run on that window alone, with thresholds resolved from it
+      window = structs.CandlestickData(df=candles_df.iloc[start:start + window_size].reset_index(drop=True), time_interval='1m', datetime_col="Date")
+      expected = detect(candlestick_data=window, trend_type=structs.TrendlineTypes.BOTH, **test)
+      _assert_results_equal(expected, results)
+      assert len(results['candlestick_data'].df) == window_size
+      for state in detector._states:
+        assert state.pairs.size + state.parked.size == window_size * (window_size - 1) // 2
+
+
+def test_detect_many():
+  candlestick_data_by_symbol = {
+    "TWO_SUP_AND_ONE_RES": testcases.TWO_SUP_AND_ONE_RES_TREND_1d,
+    "NO_TREND_DUE_BREAKOUT": testcases.NO_TREND_DUE_BREAKOUT_5m,
+    "RANDOM_WALK": testcases.RANDOM_WALK_1m,
+    "INVALID": "not candlestick data",
+  }
+  # A lambda in config has to reach the workers of workers=2 without being pickled
+  config = {"max_allowable_error_pt_to_trend": lambda candles: 0.10}
+  reported = []
+
+  for workers in [1, 2]:
+    results, errors = detect_many(
+      candlestick_data_by_symbol,
+      workers=workers,
+      progress=lambda symbol, num_done, num_total, error: reported.append(symbol),
+      trend_type=structs.TrendlineTypes.BOTH,
+      ignore_breakouts=False,
+      config=config,
+    )
+
+    # Failing symbols are reported without stopping the others
+    assert list(errors.keys()) == ["INVALID"], "Expected only INVALID to fail, received {}".format(list(errors.keys()))
+    assert set(results.keys()) == {"TWO_SUP_AND_ONE_RES", "NO_TREND_DUE_BREAKOUT", "RANDOM_WALK"}
+
+    for symbol, result in results.items():
+      candles = candlestick_data_by_symbol[symbol]
+      assert result['candlestick_data'] is candles
+      expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, ignore_breakouts=False, config=config)
+      _assert_results_equal(expected, result)
+
+  assert len(reported) == 2 * len(candlestick_data_by_symbol)
+
+
+def test_detect_many_without_fork(monkeypatch):
+  candlestick_data_by_symbol = {
+    "TWO_SUP_AND_ONE_RES": testcases.TWO_SUP_AND_ONE_RES_TREND_1d,
+    "RANDOM_WALK": testcases.RANDOM_WALK_1m,
+  }
+  config = {"max_allowable_error_pt_to_trend": lambda candles: 0.10}
+
+  # Workers are not forked outside Linux, nor while another thread runs. Lambdas in config
+  # cannot reach workers started otherwise, which is reported before any of them starts
+  stop = threading.Event()
+  thread = threading.Thread(target=stop.wait)
+  for platform, start_thread in [("darwin", False), ("linux", True)]:
+    monkeypatch.setattr(sys, "platform", platform)
+    if start_thread:
+      thread.start()
+    try:
+      detect_many(candlestick_data_by_symbol, workers=2, config=config)
+      assert False, "Expected detect_many to reject a config it cannot pickle on {}".format(platform)
+    except Exception as e:
+      assert "picklable" in str(e)
+  stop.set()
+  thread.join()
+  monkeypatch.undo()
+
+  # The same batch runs in this process
+  results, errors = detect_many(candlestick_data_by_symbol, workers=1, config=config)
+  assert errors == {} and set(results.keys()) == set(candlestick_data_by_symbol.keys())
+
+
+def test_concurrent_trend_types():
+  tests = [
+    {"candles": testcases.TWO_SUP_AND_ONE_RES_TREND_1d, "ignore_breakouts": False},
+    {"candles": testcases.RANDOM_WALK_1m, "engine": structs.ScanEngines.NUMPY},
+  ]
+
+  for test in tests:
+    kwargs = dict(test)
+    candles = kwargs.pop("candles")
+    expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, **kwargs)
+
+    for concurrency in [structs.ConcurrencyModes.THREADS, structs.ConcurrencyModes.PROCESSES]:
+      actual = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, concurrency=concurrency, **kwargs)
+      _assert_results_equal(expected, actual)
+
+
+def test_detect_stats():
+  tests = [
+    {"candles": testcases.TWO_SUP_AND_ONE_RES_TREND_1d, "ignore_breakouts": False},
+    {"candles": testcases.RANDOM_WALK_1m},
+    {"candles": testcases.RANDOM_WALK_1m, "last_pt_must_be_pivot": True},
+    {
+      "candles": testcases.RANDOM_WALK_1m,
+      "config": {
+        "min_allowable_support_slope": lambda candles: 0.0,
+        "max_allowable_resistance_slope": lambda candles: 0.0,
+        "max_allowable_support_last_price": lambda candles: candles.last_close(),
+        "min_allowable_resistance_last_price": lambda candles: candles.last_close(),
+      },
+      "expect_pruned": True,
+    },
+  ]
+
+  for test in tests:
+    kwargs = dict(test)
+    candles = kwargs.pop("candles")
+    expect_pruned = kwargs.pop("expect_pruned", False)
+
+    # Stats are only returned when asked for
+    expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, **kwargs)
+    assert 'support_stats' not in expected
+
+    counters = []
+    for engine in structs.VALID_SCAN_ENGINES:
+      results = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, engine=engine, collect_stats=True, **kwargs)
+      _assert_results_equal(expected, results)
+
+      for prefix in ['support', 'resistance']:
+        stats = results[prefix + '_stats']
+        assert stats.counters['trendlines'] == len(results[prefix + '_trendlines'])
+        assert stats.counters['duplicates'] == (results[prefix + '_trendlines']['is_best_from_duplicate_group'] != True).sum()
+        assert stats.counters['pairs_rejected_min_points'] >= 0
+        assert stats.timings['total'] >= stats.timings['scan'] >= 0
+
+        # Slope and last price limits reject pairs before any of their touches are counted
+        if expect_pruned:
+          assert stats.counters['pairs_pruned_slope'] > 0, "Expected {} pairs to be pruned by slope".format(prefix)
+          assert stats.counters['pairs_pruned_price'] > 0, "Expected {} pairs to be pruned by last price".format(prefix)
+          assert stats.counters['pairs_pruned_slope'] + stats.counters['pairs_pruned_price'] < stats.counters['pairs_tested']
+
+      counters.append((results['support_stats'].counters, results['resistance_stats'].counters))
+
+    # Every engine tests, prunes and rejects the same pairs
+    assert all(c == counters[0] for c in counters), "Expected stats counters to match across engines"
+
+
+def test_compact_results():
+  tests = [
+    {"candles": testcases.TWO_SUP_AND_ONE_RES_TREND_1d, "ignore_breakouts": False},
+    {"candles": testcases.NO_TREND_DUE_BREAKOUT_5m},
+    {"candles": testcases.RANDOM_WALK_1m, "ignore_breakouts": False, "min_points_required": 2},
+    {"candles": testcases.RANDOM_WALK_1m, "min_points_required": 50},
+  ]
+
+  for test in tests:
+    kwargs = dict(test)
+    candles = kwargs.pop("candles")
+    expected = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, **kwargs)
+    actual = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH, result_format=structs.ResultFormats.COMPACT, **kwargs)
+
+    for key in ['support_trendlines', 'resistance_trendlines']:
+      compact = actual[key]
+      assert isinstance(compact, CompactTrendlines)
+      assert compact.point_indices.dtype == 'int32'
+      assert all(values.dtype != object for values in compact.columns.values())
+
+      # Points of each row are read from the flat point array
+      for row, pointset in enumerate(expected[key]['pointset_indeces']):
+        assert compact.pointset(row).tolist() == pointset
+
+      # The lazy dataframe matches the default result format, dtypes included
+      pd.testing.assert_frame_equal(expected[key], compact.to_dataframe())
+
+
+def test_candlestick_data_construction():
+  candles_df = testcases.RANDOM_WALK_1m.df
+  expected = detect(candlestick_data=testcases.RANDOM_WALK_1m, trend_type=structs.TrendlineTypes.BOTH)
+
+  shared_df = candles_df.copy()
+  tests = [
+    structs.CandlestickData(df=shared_df, time_interval="1m", datetime_col="Date", copy=False),
+    structs.CandlestickData(df=candles_df.set_index("Date"), time_interval="1m"),
+    structs.CandlestickData(df=candles_df.rename(columns={"Date": "Datetime"}), time_interval="1m", datetime_col="Datetime"),
+    structs.CandlestickData.from_arrays(
+      open=candles_df.Open.to_numpy(),
+      high=candles_df.High.to_numpy(),
+      low=candles_df.Low.to_numpy(),
+      close=candles_df.Close.to_numpy(),
+      dates=candles_df.Date.to_numpy(),
+      time_interval="1m",
+    ),
+  ]
+
+  # copy=False shares the price data of the frame it was given
+  assert np.shares_memory(tests[0].df["High"].to_numpy(), shared_df["High"].to_numpy())
+
+  for candles in tests:
+    actual = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH)
+    _assert_results_equal(expected, actual)
+
+  try:
+    structs.CandlestickData.from_arrays([1.0] * 3, [1.0] * 3, [1.0] * 3, [1.0] * 4, candles_df.Date.to_numpy()[:3])
+    assert False, "Expected from_arrays to reject arrays of different lengths"
+  except Exception as e:
+    assert "same length" in str(e)
+
+
+def test_candle_store():
+  candles_df = testcases.RANDOM_WALK_1m.df
+  window_df = candles_df.iloc[5:36].reset_index(drop=True)
+  expected = detect(
+    candlestick_data=structs.CandlestickData(df=window_df, time_interval="1m", datetime_col="Date"),
+    trend_type=structs.TrendlineTypes.BOTH,
+  )
+
+  with tempfile.TemporaryDirectory() as directory:
+    CandleStore.write(directory, testcases.RANDOM_WALK_1m)
+    store = CandleStore(directory)
+    assert len(store) == len(candles_df)
+
+    candles = store.window(window_df.Date.iloc[0], window_df.Date.iloc[-1])
+
+    # Prices are read through the memory maps rather than copied
+    assert np.shares_memory(candles.highs(), store.columns["High"])
+
+    actual = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH)
+    _assert_results_equal(expected, actual)
+
+def test_plot_max_candles():
+  candles = testcases.RANDOM_WALK_1m
+  candles_df = candles.df
+  results = detect(candlestick_data=candles, trend_type=structs.TrendlineTypes.BOTH)
+
+  # Buckets of 4 candles keep the first open, highest high, lowest low and last close
+  buckets = _candle_buckets(candles, 4)
+  assert len(buckets['x']) == 10
+  assert buckets['x'][0] == 1.5
+  assert buckets['open'][0] == candles_df.Open.iloc[0]
+  assert buckets['high'][0] == candles_df.High.iloc[0:4].max()
+  assert buckets['low'][0] == candles_df.Low.iloc[0:4].min()
+  assert buckets['close'][0] == candles_df.Close.iloc[3]
+
+  # Every interval the x axis ticker can pick is a multiple of the tick interval, so every tick has a label
+  for bucket_size in [1, 2, 3, 7, 30, 400]:
+    tick_interval = _nice_tick_interval(bucket_size)
+    mantissas = _tick_mantissas(tick_interval)
+    intervals = [mantissa * 10 ** power for mantissa in mantissas for power in range(6)]
+    assert all(interval % tick_interval == 0 for interval in intervals if interval >= tick_interval)
+
+  with tempfile.TemporaryDirectory() as filedir:
+    for max_candles in [None, 10]:
+      outf = plot(results=results, filedir=filedir, filename='plot.html', max_candles=max_candles)
+      assert os.path.getsize(outf) > 0
+
+    try:
+      plot(results=results, filedir=filedir, max_candles=0)
+      assert False, "Expected plot to reject max_candles=0"
+    except Exception as e:
+      assert "max_candles" in str(e)
+
+def test_plot_report_options():
+  results = detect(candlestick_data=testcases.RANDOM_WALK_1m, trend_type=structs.TrendlineTypes.BOTH)
+
+  with tempfile.TemporaryDirectory() as filedir:
+    for filename in ['a.html', 'b.html']:
+      plot(
+        results=results,
+        filedir=filedir,
+        filename=filename,
+        resources=structs.PlotResources.SHARED,
+        best_of_group_only=True,
+        table_columns=['id', 'score'],
+      )
+
+    # Both pages load the single copy of BokehJS written to the directory
+    static_dirs = [name for name in os.listdir(filedir) if name.startswith('bokeh-')]
+    assert len(static_dirs) == 1
+    with open(os.path.join(filedir, 'a.html')) as f:
+      html = f.read()
+    assert './{}/static/js/bokeh.min.js'.format(static_dirs[0]) in html
+    assert os.path.exists(os.path.join(filedir, static_dirs[0], 'static', 'js', 'bokeh.min.js'))
+
+    # Custom styles are in the head, and the table only has the requested columns
+    assert html.index('class="custom"') < html.index('</head>')
+    assert 'rank_within_group' not in html
+
+    try:
+      plot(results=results, filedir=filedir, table_columns=['not_a_column'])
+      assert False, "Expected plot to reject unknown table columns"
+    except Exception as e:
+      assert "not_a_column" in str(e)
+
+def test_plot_many():
+  results_by_symbol = {
+    "TWO_SUP_AND_ONE_RES": detect(candlestick_data=testcases.TWO_SUP_AND_ONE_RES_TREND_1d, trend_type=structs.TrendlineTypes.BOTH),
+    "BRK/B": detect(candlestick_data=testcases.RANDOM_WALK_1m, trend_type=structs.TrendlineTypes.BOTH, result_format=structs.ResultFormats.COMPACT),
+    "INVALID": {"trend_type": structs.TrendlineTypes.BOTH},
+  }
+
+  for workers in [1, 2]:
+    with tempfile.TemporaryDirectory() as out_dir:
+      index_path, errors = plot_many(results_by_symbol, out_dir, workers=workers, index_page_size=1)
+
+      # Failing symbols are reported without stopping the others
+      assert list(errors.keys()) == ["INVALID"], "Expected only INVALID to fail, received {}".format(list(errors.keys()))
+      assert os.path.exists(os.path.join(out_dir, "TWO_SUP_AND_ONE_RES.html"))
+      assert os.path.exists(os.path.join(out_dir, "BRK_B.html"))
+
+      # One symbol per index page, highest best score first
+      best_symbol = max(
+        ["TWO_SUP_AND_ONE_RES", "BRK/B"],
+        key=lambda symbol: pd.concat([
+          with_dataframes(results_by_symbol[symbol])[key] for key in ['support_trendlines', 'resistance_trendlines']
+        ])['score'].max()
+      )
+      with open(index_path) as f:
+        index_html = f.read()
+      assert ">{}<".format(best_symbol) in index_html
+      assert 'href="index-2.html"' in index_html
+      assert os.path.exists(os.path.join(out_dir, "index-2.html"))